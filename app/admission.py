@@ -0,0 +1,151 @@
+from __future__ import annotations
+import math, os, time, threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from prometheus_client import Histogram
+
+from .metrics import llm_generation_latency
+
+ADMISSION_CONTROL = (os.getenv("ADMISSION_CONTROL", "1") or "1").lower() not in {"0", "false", "no", "off"}
+QUEUE_MAX_DEPTH = int(os.getenv("QUEUE_MAX_DEPTH", "0") or "0")
+ADMISSION_WINDOW_SEC = float(os.getenv("ADMISSION_WINDOW_SEC", "600") or "600")
+# Accept a task whose latency budget is already lost (202, starting after the backlog) instead of 429.
+ADMISSION_DEFER = (os.getenv("ADMISSION_DEFER", "0") or "0").lower() in {"1", "true", "yes", "on"}
+
+_Totals = Dict[str, Tuple[float, float]]  # model -> (sum, count)
+
+
+def histogram_totals(hist: Histogram) -> _Totals:
+    """Cumulative (sum, count) per model label read from a prometheus histogram."""
+    out: Dict[str, list] = {}
+    for metric in hist.collect():
+        for sample in metric.samples:
+            model = sample.labels.get("model", "")
+            if sample.name.endswith("_sum"):
+                out.setdefault(model, [0.0, 0.0])[0] = float(sample.value)
+            elif sample.name.endswith("_count"):
+                out.setdefault(model, [0.0, 0.0])[1] = float(sample.value)
+    return {m: (v[0], v[1]) for m, v in out.items()}
+
+
+def histogram_quantile(hist: Histogram, q: float, model: Optional[str] = None) -> Tuple[Optional[float], int]:
+    """Estimate the ``q`` quantile (0..1) from cumulative buckets; returns (value, sample count).
+
+    Linear interpolation inside the bucket, like PromQL's histogram_quantile. A quantile that falls
+    in the +Inf bucket is reported as the largest finite bound.
+    """
+    buckets: Dict[float, float] = {}
+    for metric in hist.collect():
+        for sample in metric.samples:
+            if not sample.name.endswith("_bucket"):
+                continue
+            if model is not None and sample.labels.get("model") != model:
+                continue
+            le = float(sample.labels["le"])
+            buckets[le] = buckets.get(le, 0.0) + float(sample.value)
+    if not buckets:
+        return None, 0
+    items = sorted(buckets.items())
+    total = items[-1][1]
+    if total <= 0:
+        return None, 0
+    target = q * total
+    prev_le, prev_count = 0.0, 0.0
+    for le, count in items:
+        if count >= target:
+            if math.isinf(le):
+                return prev_le, int(total)
+            frac = (target - prev_count) / (count - prev_count) if count > prev_count else 1.0
+            return prev_le + (le - prev_le) * frac, int(total)
+        prev_le, prev_count = le, count
+    return prev_le, int(total)
+
+
+class RecentLatency:
+    """Mean of a histogram over roughly the last ``window_sec``.
+
+    Prometheus histograms only expose totals since process start, so we keep a few timestamped
+    snapshots and diff the newest against the oldest one still inside the window.
+    """
+
+    def __init__(self, hist: Histogram, window_sec: float = ADMISSION_WINDOW_SEC):
+        self.hist = hist
+        self.window_sec = max(1.0, float(window_sec))
+        self._snaps: Deque[Tuple[float, _Totals]] = deque()
+        self._lock = threading.Lock()
+
+    def _advance(self) -> Tuple[_Totals, _Totals]:
+        now = time.monotonic()
+        current = histogram_totals(self.hist)
+        with self._lock:
+            if not self._snaps or now - self._snaps[-1][0] >= self.window_sec / 10.0:
+                self._snaps.append((now, current))
+            while len(self._snaps) > 1 and now - self._snaps[1][0] >= self.window_sec:
+                self._snaps.popleft()
+            base = self._snaps[0][1]
+        return current, base
+
+    def mean(self, model: Optional[str] = None) -> Optional[float]:
+        """Recent mean for ``model`` (or all models); falls back to the lifetime mean when idle."""
+        current, base = self._advance()
+        models = [model] if model else list(current)
+        d_sum = d_cnt = t_sum = t_cnt = 0.0
+        for m in models:
+            s, c = current.get(m, (0.0, 0.0))
+            bs, bc = base.get(m, (0.0, 0.0))
+            d_sum += s - bs
+            d_cnt += c - bc
+            t_sum += s
+            t_cnt += c
+        if d_cnt > 0:
+            return d_sum / d_cnt
+        if t_cnt > 0:
+            return t_sum / t_cnt
+        return None
+
+    def snapshot(self) -> Dict[str, Optional[float]]:
+        return {m: (round(v, 2) if (v := self.mean(m)) is not None else None) for m in histogram_totals(self.hist)}
+
+
+generation_latency = RecentLatency(llm_generation_latency)
+
+
+class AdmissionDecision:
+    __slots__ = ("admit", "status_code", "reason", "retry_after", "projected_wait")
+
+    def __init__(self, admit: bool, status_code: int = 200, reason: str = "ok", retry_after: int = 0, projected_wait: float = 0.0):
+        self.admit = admit
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+        self.projected_wait = projected_wait
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "reason": self.reason,
+            "retry_after_seconds": self.retry_after,
+            "projected_wait_seconds": round(self.projected_wait, 1),
+        }
+
+
+def decide(
+    depth: int, projected_wait: float, own_seconds: float, budget_seconds: Optional[float], drain_per_job: float,
+    defer: bool = False,
+) -> AdmissionDecision:
+    """Admit, reject (503, queue full), or for a task that would miss its latency budget either
+    reject (429) or, with ``defer``, admit it as deferred (202): it starts once the backlog ahead drains.
+
+    A full queue is never deferred; that would defeat the depth cap.
+    """
+    if not ADMISSION_CONTROL:
+        return AdmissionDecision(True, projected_wait=projected_wait)
+    if QUEUE_MAX_DEPTH > 0 and depth >= QUEUE_MAX_DEPTH:
+        retry = max(1, math.ceil(drain_per_job * (depth - QUEUE_MAX_DEPTH + 1)))
+        return AdmissionDecision(False, 503, "queue_full", retry, projected_wait)
+    if budget_seconds is not None and projected_wait + own_seconds > budget_seconds:
+        if defer:
+            return AdmissionDecision(True, 202, "deferred", max(1, math.ceil(projected_wait)), projected_wait)
+        retry = max(1, math.ceil(projected_wait + own_seconds - budget_seconds))
+        return AdmissionDecision(False, 429, "deadline_unreachable", retry, projected_wait)
+    return AdmissionDecision(True, projected_wait=projected_wait)
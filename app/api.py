@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
 import html
 import io
 import json
@@ -11,7 +12,7 @@ import zipfile
 from pathlib import Path
 from typing import Dict, List, Optional
 
-from fastapi import APIRouter, Depends, File, Form, Header, HTTPException, Query, Request, UploadFile
+from fastapi import APIRouter, Depends, File, Form, Header, HTTPException, Query, Request, Response, UploadFile
 from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from .schemas import (
@@ -23,14 +24,18 @@ from .schemas import (
 )
 from .settings import settings
 from .sse import StreamHub
+from .status_watch import TaskStatusWatcher
 from .db import get_engine, insert_task, update_task_status, get_task
 from sqlalchemy import text
 from .registry import available_models
 from .bandit import extract_features, feature_hash, get_stats_for_models, estimate_mean
 from .ollama_health import get_ollama_health
+from .residency import residency
+from .chat_sessions import chat_sessions
 from .ratelimit import check_allow, peek_state
+from .admission import decide as admission_decide, QUEUE_MAX_DEPTH, ADMISSION_CONTROL, ADMISSION_DEFER, AdmissionDecision
 from .logging_setup import get_logger
-from .metrics import sse_terminated_total
+from .metrics import sse_terminated_total, admission_decisions_total
 from .memory import search_memories, get_memory, record_upload_bundle
 from .fs_sandbox import resolve_safe_path
 from .java_utils import fix_java_package, fix_java_filename
@@ -41,6 +46,7 @@ router = APIRouter()
 logger = get_logger(__name__)
 log = get_logger("api")
 hub: StreamHub = StreamHub()
+status_watcher = TaskStatusWatcher(hub)
 job_queue = None  # set in main
 
 ZIP_ROOT = Path(os.getenv("ZIP_DIR", "/data/zips"))
@@ -61,6 +67,34 @@ def _ratelimit_guard(x_api_key: str|None):
         raise HTTPException(status_code=429, detail=f"rate limit exceeded; retry in {retry_ms}ms", headers={"Retry-After": str(max(1, int((retry_ms+999)//1000)))})
 
 
+def _admission_guard(q, task: TaskV11) -> AdmissionDecision:
+    """Turn work away while it is still cheap to: queue full (503) or latency budget already lost (429).
+
+    Only an explicitly sent ``constraints.latency_ms`` is treated as a budget, so clients relying on
+    the schema default keep today's queue-everything behaviour. With ``ADMISSION_DEFER`` or
+    ``metadata.on_overload: "defer"`` a lost budget is accepted as deferred (202) instead.
+    """
+    constraints = task.input.constraints
+    budget = constraints.latency_ms / 1000.0 if "latency_ms" in constraints.model_fields_set else None
+    own = q.expected_job_seconds()
+    defer = ADMISSION_DEFER or str((task.metadata or {}).get("on_overload") or "").lower() == "defer"
+    decision = admission_decide(q.queue.qsize(), q.projected_wait_seconds(), own, budget, own / max(1, q.workers), defer=defer)
+    admission_decisions_total.labels(decision=decision.reason).inc()
+    if decision.admit:
+        return decision
+    log.info("task.admission.rejected", {"task_id": str(task.id), **decision.as_dict()})
+    raise HTTPException(
+        status_code=decision.status_code,
+        detail=decision.as_dict(),
+        headers={"Retry-After": str(decision.retry_after)},
+    )
+
+def _fair_client(x_api_key: Optional[str], metadata: Dict) -> str:
+    """Scheduler fairness key: hashed API key, optionally split by metadata.client_id."""
+    base = hashlib.sha256((x_api_key or "anon").encode("utf-8")).hexdigest()[:12]
+    sub = str(metadata.get("client_id") or "").strip()[:64]
+    return f"{base}:{sub}" if sub else base
+
 def require_api_key(x_api_key: Optional[str] = Header(None)):
     if x_api_key != settings.api_key:
         raise HTTPException(status_code=401, detail="Invalid or missing API key")
@@ -113,15 +147,35 @@ async def list_models(language: Optional[str] = None, debug: int = Query(0, ge=0
         enriched.append({**m, "_bandit":{"runs":runs, "mean_estimate": round(estimate_mean(runs, rs), 3)}})
     return {"models": enriched, "_feature_hash": fh, "_features": feats}
 
+@router.get("/v1/models/residency")
+async def model_residency():
+    return residency.snapshot()
+
+@router.post("/v1/models/residency/reconcile", dependencies=[Depends(require_api_key)])
+async def model_residency_reconcile():
+    return await residency.reconcile()
+
+@router.get("/v1/chat/sessions/{session_id}", dependencies=[Depends(require_api_key)])
+async def get_chat_session(session_id: str):
+    session = chat_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired chat session")
+    return session.as_dict()
+
+@router.delete("/v1/chat/sessions/{session_id}", dependencies=[Depends(require_api_key)])
+async def reset_chat_session(session_id: str):
+    return {"session_id": session_id, "dropped": chat_sessions.drop(session_id)}
+
 @router.post("/v1/tasks", dependencies=[Depends(require_api_key)])
-async def submit_task(task: TaskV11, request: Request, x_api_key: str | None = Header(None)):
-    eng = await get_engine()
-    async with eng.begin() as conn:
-        await insert_task(conn, task.id, task.type, task.input.language, "queued", task.prompt_template_version)
+async def submit_task(task: TaskV11, request: Request, response: Response, x_api_key: str | None = Header(None)):
     # robust queue lookup: module global or app.state
     q = job_queue or getattr(request.app.state, 'job_queue', None)
     if q is None:
         raise HTTPException(status_code=503, detail='job queue not ready')
+    admission = _admission_guard(q, task)
+    eng = await get_engine()
+    async with eng.begin() as conn:
+        await insert_task(conn, task.id, task.type, task.input.language, "queued", task.prompt_template_version)
     payload = task.model_dump()
     metadata = payload.get("metadata") or {}
     ctx_ids = metadata.get("memory_context_ids") or []
@@ -162,9 +216,27 @@ async def submit_task(task: TaskV11, request: Request, x_api_key: str | None = H
             )
             metadata.pop("memory_context_ids", None)
     payload["metadata"] = metadata
-    await q.submit(payload)
+    payload["_client"] = _fair_client(x_api_key, metadata)
+    if admission.reason == "deferred":
+        # its budget is lost anyway: schedule it behind the backlog, not ahead of work that can still make it
+        payload["_deadline"] = time.time() + admission.projected_wait + q.expected_job_seconds()
+        response.status_code = 202
+        response.headers["Retry-After"] = str(admission.retry_after)
+        log.info("task.admission.deferred", {"task_id": str(task.id), **admission.as_dict()})
+    leader = await q.submit(payload)
+    if leader is not None:
+        return {"task_id": str(task.id), "coalesced_with": leader}
+    if admission.reason == "deferred":
+        return {"task_id": str(task.id), "deferred": True, "projected_start_seconds": round(admission.projected_wait, 1)}
     return {"task_id": str(task.id)}
 
+@router.get("/v1/queue/stats")
+async def queue_stats(request: Request):
+    q = job_queue or getattr(request.app.state, 'job_queue', None)
+    if q is None:
+        raise HTTPException(status_code=503, detail='job queue not ready')
+    return {**q.stats(), "max_depth": QUEUE_MAX_DEPTH, "admission_control": ADMISSION_CONTROL}
+
 @router.get("/v1/tasks/{task_id}")
 async def get_task_status(task_id: uuid.UUID) -> TaskStatus:
     eng = await get_engine()
@@ -430,12 +502,15 @@ async def workspace_memory_upload(
 
 
 @router.get("/v1/stream/{task_id}")
-async def stream_task(task_id: uuid.UUID, request: Request):
+async def stream_task(task_id: uuid.UUID, request: Request, last_event_id: Optional[int] = Query(None)):
+    # browsers resend the id of the last event they saw when EventSource reconnects
+    resume_from = last_event_id
+    header_id = request.headers.get("last-event-id")
+    if resume_from is None and header_id and header_id.strip().isdigit():
+        resume_from = int(header_id.strip())
+
     async def event_gen():
 
-        last_check = 0.0
-        last_db_check = 0.0
-        db_poll_interval = max(0.5, float(os.getenv("SSE_DB_POLL_INTERVAL", "2.0") or "2.0"))
         final_wait_max = max(1.0, float(os.getenv("SSE_FINAL_WAIT_SECONDS", "20.0") or "20.0"))
         final_retry_interval = max(0.05, float(os.getenv("SSE_FINAL_RETRY_INTERVAL", "0.2") or "0.2"))
 
@@ -461,135 +536,93 @@ async def stream_task(task_id: uuid.UUID, request: Request):
 
         def rebuild_chunk(original: str, data: dict, event_override: Optional[str] = None) -> str:
             event_name = event_override
-            if event_name is None:
-                for line in original.splitlines():
-                    if line.startswith("event: "):
-                        event_name = line[7:].strip()
-                        break
+            id_line = ""
+            for line in original.splitlines():
+                if line.startswith("event: ") and event_name is None:
+                    event_name = line[7:].strip()
+                elif line.startswith("id: "):
+                    id_line = line + "\n"
             payload_text = json.dumps(data)
             if event_name:
-                return f"event: {event_name}\ndata: {payload_text}\n\n"
-            return f"data: {payload_text}\n\n"
-
-        async for chunk in hub.stream(str(task_id), heartbeat_seconds=10):
-            parsed_payload = None
-            event_name = None
-            if chunk.startswith("data: "):
-                raw = chunk[6:].strip()
-                try:
-                    parsed_payload = json.loads(raw)
-                except Exception:
-                    parsed_payload = None
-            elif chunk.startswith("event: "):
-                lines = chunk.splitlines()
-                for line in lines:
+                return f"{id_line}event: {event_name}\ndata: {payload_text}\n\n"
+            return f"{id_line}data: {payload_text}\n\n"
+
+        def closed(reason: str) -> None:
+            try:
+                hub.close(str(task_id))
+            except Exception:
+                pass
+            try:
+                sse_terminated_total.labels(reason=reason).inc()
+            except Exception:
+                pass
+            logger.info("sse_close", extra={"reason":reason,"task_id":str(task_id)})
+
+        # JobQueue pushes every terminal status through the hub. For tasks it does not feed here
+        # (finished before a restart, or run by another replica without SSE_BACKEND=postgres),
+        # the shared watcher looks the status up in one query for all open streams and delivers
+        # it into the hub like any other event.
+        status_watcher.watch(str(task_id))
+        try:
+            awaiting_final = False
+            async for chunk in hub.stream(str(task_id), last_event_id=resume_from):
+                if chunk.startswith("event: heartbeat"):
+                    yield chunk
+                    # shared-timer tick: the only moment a missing final payload is re-checked
+                    if awaiting_final:
+                        payload = await fetch_final_payload()
+                        if payload is not None:
+                            yield rebuild_chunk("event: done\n", payload, "done")
+                            closed("artifacts")
+                            break
+                    continue
+
+                parsed_payload = None
+                event_name = None
+                for line in chunk.splitlines():
                     if line.startswith("event: "):
                         event_name = line[7:].strip()
-                    if line.startswith("data: "):
+                    elif line.startswith("data: "):
                         raw = line[6:].strip()
                         try:
                             parsed_payload = json.loads(raw)
                         except Exception:
                             parsed_payload = None
                         break
-            chunk_to_send = chunk
-
-            # forward chunk to client
-            if parsed_payload and parsed_payload.get("status") == "done":
-                # Merge final payload to ensure readiness
-                final_payload = await wait_for_final_payload()
-                if final_payload is None:
-                    await asyncio.sleep(final_retry_interval)
-                    continue
-                merge_keys = (
-                    "model", "latency_ms", "compile_pass", "test_pass", "tool",
-                    "artifact", "logs", "content", "zip_url", "zip_notes", "follow_up_steps"
-                )
-                for key in merge_keys:
-                    value = parsed_payload.get(key)
-                    if value not in (None, "") and key not in final_payload:
-                        final_payload[key] = value
-                final_payload.setdefault("pending_final", False)
-                chunk_to_send = rebuild_chunk(chunk, final_payload, event_name)
-                parsed_payload = final_payload
-
-            yield chunk_to_send
-
-            if parsed_payload and parsed_payload.get("status") == "done":
-                if parsed_payload.get("pending_final"):
-                    continue
-                try:
-                    hub.close(str(task_id))
-                except Exception:
-                    pass
-                try:
-                    sse_terminated_total.labels(reason="status").inc()
-                except Exception:
-                    pass
-                logger.info("sse_close", extra={"reason":"status","task_id":str(task_id)})
-                break
-            if parsed_payload and parsed_payload.get("status") in {"error", "canceled"}:
-                try:
-                    hub.close(str(task_id))
-                except Exception:
-                    pass
-                try:
-                    sse_terminated_total.labels(reason="status").inc()
-                except Exception:
-                    pass
-                logger.info("sse_close", extra={"reason":"status","task_id":str(task_id)})
-                break
-            # Periodically check for artifacts as a completion signal
-            now = time.time()
-            if now - last_check >= 2.0:
-                last_check = now
-                try:
-                    payload = await fetch_final_payload()
-                    if payload:
-                        chunk_payload = rebuild_chunk("event: done\n", payload, "done")
-                        yield chunk_payload
-                        try:
-                            hub.close(str(task_id))
-                        except Exception:
-                            pass
-                        try:
-                            sse_terminated_total.labels(reason="artifacts").inc()
-                        except Exception:
-                            pass
-                        logger.info("sse_close", extra={"reason":"artifacts","task_id":str(task_id)})
-                        break
-                except Exception:
-                    # artifacts module not available or other error; ignore
-                    pass
-            # Poll DB for terminal status as a reliable fallback
-            if now - last_db_check >= db_poll_interval:
-                last_db_check = now
-                eng = await get_engine()
-                async with eng.begin() as conn:
-                    row = await get_task(conn, task_id)
-                status = (row[1] if row else None)
-                if status in ("done", "error", "canceled"):
-                    if status == "done":
-                        payload = await wait_for_final_payload()
-                        if payload is None:
-                            await asyncio.sleep(final_retry_interval)
-                            continue
-                        chunk_payload = rebuild_chunk("event: done\n", payload, "done")
-                    else:
-                        payload = {"status": status, "note": "db-poll", "pending_final": False}
-                        chunk_payload = rebuild_chunk("event: done\n", payload, "done")
-                    yield chunk_payload
-                    try:
-                        hub.close(str(task_id))
-                    except Exception:
-                        pass
-                    try:
-                        sse_terminated_total.labels(reason="db").inc()
-                    except Exception:
-                        pass
-                    logger.info("sse_close", extra={"reason":"db","task_id":str(task_id)})
+                chunk_to_send = chunk
+
+                # forward chunk to client
+                if parsed_payload and parsed_payload.get("status") == "done":
+                    # Merge final payload to ensure readiness
+                    final_payload = await wait_for_final_payload()
+                    if final_payload is None:
+                        awaiting_final = True  # retried on heartbeats until the artifacts land
+                        continue
+                    merge_keys = (
+                        "model", "latency_ms", "compile_pass", "test_pass", "tool",
+                        "artifact", "logs", "content", "zip_url", "zip_notes", "follow_up_steps"
+                    )
+                    for key in merge_keys:
+                        value = parsed_payload.get(key)
+                        if value not in (None, "") and key not in final_payload:
+                            final_payload[key] = value
+                    final_payload.setdefault("pending_final", False)
+                    chunk_to_send = rebuild_chunk(chunk, final_payload, event_name)
+                    parsed_payload = final_payload
+
+                yield chunk_to_send
+
+                if parsed_payload and parsed_payload.get("status") == "done":
+                    if parsed_payload.get("pending_final"):
+                        continue
+                    closed("db" if parsed_payload.get("note") == "db" else "status")
+                    break
+                if parsed_payload and parsed_payload.get("status") in {"error", "canceled"}:
+                    closed("db" if parsed_payload.get("note") == "db" else "status")
                     break
-        
+        finally:
+            status_watcher.unwatch(str(task_id))
+
     return StreamingResponse(event_gen(), media_type="text/event-stream")
 
 @router.get("/zips/{filename}")
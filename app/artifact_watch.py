@@ -0,0 +1,116 @@
+from __future__ import annotations
+import asyncio, os
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from .logging_setup import get_logger
+
+try:  # ships with uvicorn[standard]; inotify on Linux, native watchers elsewhere
+    from watchfiles import awatch
+except Exception:  # pragma: no cover - optional dependency
+    awatch = None
+
+log = get_logger("artifact_watch")
+
+# Where artifact-driven SSE routes look for <task_id>/result.json.
+ARTIFACT_WATCH_ROOT = os.getenv("ARTIFACTS_DIR", "/app/artifacts")
+# Stat-polling instead of filesystem notifications (network or bind mounts that do not deliver them).
+ARTIFACT_WATCH_POLLING = (os.getenv("ARTIFACT_WATCH_POLLING", "0") or "0").lower() in {"1", "true", "yes", "on"}
+ARTIFACT_WATCH_POLL_SEC = float(os.getenv("ARTIFACT_WATCH_POLL_SEC", "0.5") or "0.5")
+
+RESULT_FILE = "result.json"
+
+
+class ArtifactWatcher:
+    """One filesystem watch on the artifacts root shared by every stream waiting for a result.
+
+    ``wait(task_id, timeout)`` returns as soon as ``<root>/<task_id>/result.json`` exists. While
+    anyone waits, a single background task watches the root (for task directories appearing) and
+    each awaited task's directory (for the result file), non-recursively, through ``watchfiles``
+    (inotify on Linux). Each batch of changes re-checks only the awaited tasks. Without
+    ``watchfiles``, with ``ARTIFACT_WATCH_POLLING=1``, or if the watch cannot be set up, the same
+    task polls every ``poll_sec`` instead, still once for all waiters rather than once per stream.
+    """
+
+    def __init__(self, root: str = ARTIFACT_WATCH_ROOT, polling: bool = ARTIFACT_WATCH_POLLING, poll_sec: float = ARTIFACT_WATCH_POLL_SEC):
+        self.root = Path(root)
+        self.polling = polling or awatch is None
+        self.poll_sec = max(0.05, poll_sec)
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._rewatch = asyncio.Event()
+        self._dirs: Set[str] = set()  # task directories the current watch covers
+        self._task: Optional[asyncio.Task] = None
+
+    def ready(self, task_id: str) -> bool:
+        try:
+            return (self.root / task_id / RESULT_FILE).is_file()
+        except OSError:
+            return False
+
+    async def wait(self, task_id: str, timeout: float) -> bool:
+        """True once the task's result file exists, False if ``timeout`` runs out first."""
+        if self.ready(task_id):
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(task_id, []).append(fut)
+        if task_id not in self._dirs and (self.root / task_id).is_dir():
+            self._rewatch.set()  # its directory is not under watch yet
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            if self.ready(task_id):  # landed while registering
+                return True
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiting = self._waiters.get(task_id, [])
+            if fut in waiting:
+                waiting.remove(fut)
+            if not waiting:
+                self._waiters.pop(task_id, None)
+
+    def _settle(self) -> None:
+        for task_id in [tid for tid in self._waiters if self.ready(tid)]:
+            for fut in self._waiters.pop(task_id, []):
+                if not fut.done():
+                    fut.set_result(True)
+
+    async def _run(self) -> None:
+        polling = self.polling
+        try:
+            while self._waiters:
+                if not polling:
+                    try:
+                        await self._watch()
+                        continue
+                    except Exception as exc:
+                        # until the waiters are all served; the next round tries notifications again
+                        log.warning("artifact_watch.fallback_polling", {"root": str(self.root), "error": str(exc)})
+                        polling = True
+                self._settle()
+                await asyncio.sleep(self.poll_sec)
+        finally:
+            self._dirs = set()
+            self._task = None
+
+    async def _watch(self) -> None:
+        """Watch until the set of directories worth watching changes, or nobody waits any more."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._rewatch.clear()
+        self._dirs = dirs = {tid for tid in self._waiters if (self.root / tid).is_dir()}
+        self._settle()  # anything that landed before the watch was up
+        if not self._waiters:
+            return
+        paths = [self.root, *(self.root / tid for tid in dirs)]
+        async for _changes in awatch(*paths, watch_filter=None, debounce=50, step=50, recursive=False,
+                                     stop_event=self._rewatch, yield_on_timeout=True, rust_timeout=1000):
+            self._settle()
+            if not self._waiters:
+                return
+            if not {tid for tid in self._waiters if (self.root / tid).is_dir()} <= dirs:
+                return  # an awaited directory appeared: watch it too
+
+
+artifact_watcher = ArtifactWatcher()
@@ -0,0 +1,124 @@
+from __future__ import annotations
+import os, threading, time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from .logging_setup import get_logger
+
+log = get_logger("chat_sessions")
+
+CHAT_SESSIONS = (os.getenv("CHAT_SESSIONS", "1") or "1").lower() not in {"0", "false", "no", "off"}
+CHAT_SESSION_TTL_SEC = float(os.getenv("CHAT_SESSION_TTL_SEC", "3600") or "3600")
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "1000") or "1000")
+
+# Same fixed persona the flat chat prompt opens with; it never changes, so it is always cached.
+CHAT_SYSTEM_PROMPT = "You are a friendly engineering assistant. Answer in natural language unless the user clearly asks for code."
+
+Message = Dict[str, str]
+
+
+@dataclass
+class ChatSession:
+    id: str
+    messages: List[Message] = field(default_factory=list)  # user/assistant turns, oldest first
+    turns: int = 0
+    updated_at: float = field(default_factory=time.time)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"session_id": self.id, "turns": self.turns, "messages": list(self.messages), "updated_at": self.updated_at}
+
+
+class ChatSessionStore:
+    """Server-side chat history keyed by ``metadata.session_id``.
+
+    Messages are only ever appended (or dropped from the front when the context is full), so
+    every request in a session resends the exact message prefix Ollama evaluated last time and
+    its prompt cache covers everything but the new turn. Sessions idle for ``ttl_sec`` expire;
+    beyond ``max_sessions`` the least recently used one is dropped. Process memory only: a
+    restart starts every conversation afresh.
+    """
+
+    def __init__(self, ttl_sec: float = CHAT_SESSION_TTL_SEC, max_sessions: int = CHAT_SESSION_MAX):
+        self.ttl_sec = ttl_sec
+        self.max_sessions = max(1, max_sessions)
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._sessions:
+            sid, oldest = next(iter(self._sessions.items()))
+            if now - oldest.updated_at <= self.ttl_sec and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.pop(sid)
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        with self._lock:
+            self._expire(time.time())
+            return self._sessions.get(session_id)
+
+    def history(self, session_id: str, seed: Optional[List[Dict[str, Any]]] = None) -> List[Message]:
+        """Messages so far; an unknown session starts from ``seed`` (a client-sent transcript)."""
+        with self._lock:
+            self._expire(time.time())
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id, _clean(seed or []))
+                self._sessions[session_id] = session
+                self._expire(time.time())
+                if session.messages:
+                    log.info("chat_session.seeded", {"session_id": session_id, "messages": len(session.messages)})
+            self._sessions.move_to_end(session_id)
+            return list(session.messages)
+
+    def fit(self, session_id: str, budget_tokens: int, count: Callable[[List[Message]], int]) -> None:
+        """Drop the oldest turns until the history fits ``budget_tokens``.
+
+        The cut is stored, so later turns share the new (shorter) prefix instead of shifting it again.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return
+            dropped = 0
+            while session.messages and count(session.messages) > budget_tokens:
+                session.messages.pop(0)
+                dropped += 1
+                while session.messages and session.messages[0]["role"] != "user":
+                    session.messages.pop(0)
+                    dropped += 1
+            if dropped:
+                log.info("chat_session.trimmed", {"session_id": session_id, "dropped": dropped, "kept": len(session.messages)})
+
+    def commit(self, session_id: str, user: str, assistant: str) -> None:
+        """Record a finished turn: the user message exactly as sent and the delivered reply."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = ChatSession(session_id)
+            session.messages.append({"role": "user", "content": user})
+            session.messages.append({"role": "assistant", "content": assistant})
+            session.turns += 1
+            session.updated_at = time.time()
+            self._sessions.move_to_end(session_id)
+            self._expire(session.updated_at)
+
+    def drop(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+
+def _clean(transcript: List[Dict[str, Any]]) -> List[Message]:
+    out: List[Message] = []
+    for entry in transcript:
+        if not isinstance(entry, dict):
+            continue
+        content = str(entry.get("content") or "").strip()
+        if content:
+            out.append({"role": "user" if entry.get("role", "user") == "user" else "assistant", "content": content})
+    while out and out[0]["role"] != "user":
+        out.pop(0)
+    return out
+
+
+chat_sessions = ChatSessionStore()
@@ -40,6 +40,39 @@ STATEMENTS = [
       last_updated TIMESTAMPTZ DEFAULT now(),
       PRIMARY KEY (model, feature_hash)
     );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS task_queue (
+      task_id UUID PRIMARY KEY REFERENCES tasks(id) ON DELETE CASCADE,
+      payload JSONB NOT NULL,
+      state TEXT NOT NULL DEFAULT 'queued',
+      priority INT NOT NULL DEFAULT 0,
+      attempts INT NOT NULL DEFAULT 0,
+      max_attempts INT NOT NULL DEFAULT 3,
+      lease_owner TEXT,
+      lease_expires_at TIMESTAMPTZ,
+      available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+      last_error TEXT,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+      updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_task_queue_ready ON task_queue (priority DESC, created_at) WHERE state = 'queued';
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_task_queue_lease ON task_queue (lease_expires_at) WHERE state = 'leased';
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sse_spill (
+      id BIGSERIAL PRIMARY KEY,
+      task_id TEXT NOT NULL,
+      message TEXT NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_sse_spill_created ON sse_spill (created_at);
     """
 ]
 
@@ -7,6 +7,8 @@ _DEFAULT = {
     "success_weight": 1.0,
     "latency_penalty_ms": 0.001,
     "human_score_weight": 0.05,
+    "strategy": "gather",     # or "race": first candidate to pass wins
+    "race_loser": "cancel",   # or "finish": let the loser complete for bandit rewards
 }
 
 _PATH = os.getenv("DUEL_CONFIG_PATH", "./config/duel.yaml")
@@ -0,0 +1,275 @@
+from __future__ import annotations
+import asyncio, json, os, socket, uuid
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .db import get_engine, update_task_status
+from .logging_setup import get_logger
+
+log = get_logger("durable_queue")
+
+QUEUE_BACKEND = (os.getenv("QUEUE_BACKEND", "memory") or "memory").strip().lower()
+PG_QUEUE_VISIBILITY_SEC = float(os.getenv("PG_QUEUE_VISIBILITY_SEC", "60") or "60")
+PG_QUEUE_POLL_SEC = float(os.getenv("PG_QUEUE_POLL_SEC", "1") or "1")
+PG_QUEUE_MAX_ATTEMPTS = int(os.getenv("PG_QUEUE_MAX_ATTEMPTS", "3") or "3")
+PG_QUEUE_RETRY_BACKOFF_SEC = float(os.getenv("PG_QUEUE_RETRY_BACKOFF_SEC", "5") or "5")
+# Dead-lettering and the depth count run on their own timer, once per queue rather than per poll.
+PG_QUEUE_MAINTAIN_SEC = float(os.getenv("PG_QUEUE_MAINTAIN_SEC", "15") or "15")
+
+_CLAIM_SQL = """
+WITH got AS (
+  SELECT task_id FROM task_queue
+  WHERE (state = 'queued' AND available_at <= now())
+     OR (state = 'leased' AND lease_expires_at < now() AND attempts < max_attempts)
+  ORDER BY priority DESC, created_at
+  FOR UPDATE SKIP LOCKED
+  LIMIT 1
+)
+UPDATE task_queue q
+SET state = 'leased',
+    lease_owner = :owner,
+    lease_expires_at = now() + make_interval(secs => CAST(:vis AS DOUBLE PRECISION)),
+    attempts = q.attempts + 1,
+    updated_at = now()
+FROM got
+WHERE q.task_id = got.task_id
+RETURNING q.task_id, q.payload, q.attempts, q.max_attempts
+"""
+
+_REAP_SQL = """
+UPDATE task_queue
+SET state = 'dead',
+    last_error = COALESCE(last_error, 'lease expired'),
+    lease_owner = NULL,
+    updated_at = now()
+WHERE state = 'leased' AND lease_expires_at < now() AND attempts >= max_attempts
+RETURNING task_id, attempts, last_error
+"""
+
+
+def _job_priority(job: Dict[str, Any]) -> int:
+    meta = job.get("metadata") or {}
+    try:
+        return int(job.get("priority", meta.get("priority", 0)) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class PgTaskQueue:
+    """Durable, multi-replica task queue on the ``task_queue`` table.
+
+    Same claim model as ``tools/runner.py`` (``FOR UPDATE SKIP LOCKED``) plus a lease: a claimed
+    row is ``leased`` until ``lease_expires_at``, which a heartbeat keeps pushing forward while the
+    job runs. If the process dies the lease expires and another worker re-claims the job; after
+    ``max_attempts`` claims it is dead-lettered and the task marked ``error``.
+
+    Exposes the subset of ``asyncio.Queue`` that ``JobQueue`` uses (``put``/``get``/``qsize``/
+    ``task_done``) plus ``ack``/``nack``/``release``/``cancel`` for settling a lease.
+    """
+
+    durable = True
+
+    def __init__(
+        self,
+        engine: Optional[AsyncEngine] = None,
+        *,
+        owner: Optional[str] = None,
+        visibility_sec: float = PG_QUEUE_VISIBILITY_SEC,
+        poll_sec: float = PG_QUEUE_POLL_SEC,
+        max_attempts: int = PG_QUEUE_MAX_ATTEMPTS,
+        retry_backoff_sec: float = PG_QUEUE_RETRY_BACKOFF_SEC,
+        maintain_sec: float = PG_QUEUE_MAINTAIN_SEC,
+    ):
+        self._engine = engine
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.visibility_sec = max(0.05, float(visibility_sec))
+        self.poll_sec = max(0.01, float(poll_sec))
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_backoff_sec = max(0.0, float(retry_backoff_sec))
+        self.maintain_sec = max(0.05, float(maintain_sec))
+        self._heartbeats: Dict[str, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._depth = 0
+        self._maintainer: Optional[asyncio.Task] = None
+
+    async def _eng(self) -> AsyncEngine:
+        if self._engine is None:
+            self._engine = await get_engine()
+        return self._engine
+
+    # asyncio.Queue surface -------------------------------------------------
+
+    def qsize(self) -> int:
+        # Shared across replicas, so this is the last maintenance count plus local puts and claims.
+        return self._depth
+
+    def task_done(self) -> None:
+        pass
+
+    async def put(self, job: Dict[str, Any]) -> None:
+        eng = await self._eng()
+        async with eng.begin() as conn:
+            res = await conn.execute(text("""
+                INSERT INTO task_queue (task_id, payload, priority, max_attempts)
+                VALUES (:task_id, CAST(:payload AS JSONB), :priority, :max_attempts)
+                ON CONFLICT (task_id) DO NOTHING
+            """), dict(
+                task_id=str(job["id"]),
+                payload=json.dumps(job, default=str),
+                priority=_job_priority(job),
+                max_attempts=self.max_attempts,
+            ))
+        if res.rowcount == 1:  # a re-put of a queued task inserts nothing
+            self._depth += 1
+        self._wakeup.set()
+
+    async def get(self) -> Dict[str, Any]:
+        if self._maintainer is None or self._maintainer.done():
+            self._maintainer = asyncio.create_task(self._maintain())
+        while True:
+            job = await self.claim()
+            if job is not None:
+                return job
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_sec)
+            except asyncio.TimeoutError:
+                pass
+
+    # lease handling --------------------------------------------------------
+
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        """Claim the next ready job, or re-claim one whose lease expired (or return None)."""
+        eng = await self._eng()
+        async with eng.begin() as conn:
+            row = (await conn.execute(text(_CLAIM_SQL), dict(owner=self.owner, vis=self.visibility_sec))).first()
+        if row is None:
+            return None
+        self._depth = max(0, self._depth - 1)
+        payload = row.payload
+        job = json.loads(payload) if isinstance(payload, (str, bytes)) else dict(payload)
+        task_id = str(row.task_id)
+        job["_attempt"] = int(row.attempts)
+        self._heartbeats[task_id] = asyncio.create_task(self._heartbeat(task_id))
+        log.info("queue.claimed", {"task_id": task_id, "owner": self.owner, "attempt": row.attempts, "max_attempts": row.max_attempts})
+        return job
+
+    async def _heartbeat(self, task_id: str) -> None:
+        interval = self.visibility_sec / 3.0
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                eng = await self._eng()
+                async with eng.begin() as conn:
+                    res = await conn.execute(text("""
+                        UPDATE task_queue
+                        SET lease_expires_at = now() + make_interval(secs => CAST(:vis AS DOUBLE PRECISION)), updated_at = now()
+                        WHERE task_id = :task_id AND state = 'leased' AND lease_owner = :owner
+                    """), dict(task_id=task_id, owner=self.owner, vis=self.visibility_sec))
+                if not res.rowcount:
+                    log.warning("queue.lease_lost", {"task_id": task_id, "owner": self.owner})
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.warning("queue.heartbeat_failed", {"task_id": task_id, "error": str(exc)})
+
+    def _stop_heartbeat(self, task_id: str) -> None:
+        hb = self._heartbeats.pop(task_id, None)
+        if hb is not None and not hb.done():
+            hb.cancel()
+
+    async def _settle(self, task_id: str, sql: str, **params: Any) -> int:
+        self._stop_heartbeat(task_id)
+        eng = await self._eng()
+        async with eng.begin() as conn:
+            res = await conn.execute(text(sql), dict(task_id=task_id, owner=self.owner, **params))
+            return res.rowcount or 0
+
+    async def ack(self, job: Dict[str, Any]) -> None:
+        """The job ran to completion (success or a handled failure): never hand it out again."""
+        await self._settle(str(job["id"]), """
+            UPDATE task_queue SET state = 'done', lease_owner = NULL, lease_expires_at = NULL, updated_at = now()
+            WHERE task_id = :task_id AND lease_owner = :owner
+        """)
+
+    async def nack(self, job: Dict[str, Any], error: str) -> None:
+        """The job crashed: retry after a backoff, or dead-letter once attempts are exhausted."""
+        task_id = str(job["id"])
+        self._stop_heartbeat(task_id)
+        eng = await self._eng()
+        async with eng.begin() as conn:
+            row = (await conn.execute(text("""
+                UPDATE task_queue
+                SET state = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,
+                    available_at = now() + make_interval(secs => CAST(:backoff AS DOUBLE PRECISION) * attempts),
+                    lease_owner = NULL, lease_expires_at = NULL, last_error = :error, updated_at = now()
+                WHERE task_id = :task_id AND lease_owner = :owner
+                RETURNING state, attempts
+            """), dict(task_id=task_id, owner=self.owner, error=error[:2000], backoff=self.retry_backoff_sec))).first()
+            if row is not None and row.state == "dead":
+                await update_task_status(conn, task_id, "error", error=f"dead-lettered after {row.attempts} attempts: {error[:500]}")
+        if row is not None:
+            log.warning("queue.nack", {"task_id": task_id, "state": row.state, "attempt": row.attempts, "error": error[:200]})
+            if row.state == "queued":
+                self._depth += 1
+                self._wakeup.set()
+
+    async def release(self, job: Dict[str, Any]) -> None:
+        """Hand the lease back without waiting for it to expire (e.g. on shutdown)."""
+        self._depth += await self._settle(str(job["id"]), """
+            UPDATE task_queue SET state = 'queued', lease_owner = NULL, lease_expires_at = NULL, updated_at = now()
+            WHERE task_id = :task_id AND lease_owner = :owner AND state = 'leased'
+        """)
+
+    async def cancel(self, task_id: str) -> bool:
+        """Withdraw a job that no replica has claimed yet."""
+        eng = await self._eng()
+        async with eng.begin() as conn:
+            res = await conn.execute(text("""
+                UPDATE task_queue SET state = 'canceled', updated_at = now()
+                WHERE task_id = :task_id AND state = 'queued'
+            """), dict(task_id=str(task_id)))
+        if res.rowcount:
+            self._depth = max(0, self._depth - 1)
+        return bool(res.rowcount)
+
+    async def reap(self) -> List[str]:
+        """Dead-letter jobs whose last allowed lease expired (the worker died on its final attempt)."""
+        eng = await self._eng()
+        async with eng.begin() as conn:
+            rows = (await conn.execute(text(_REAP_SQL))).fetchall()
+            for row in rows:
+                await update_task_status(conn, row.task_id, "error", error=f"dead-lettered after {row.attempts} attempts: {row.last_error}")
+        dead = [str(r.task_id) for r in rows]
+        if dead:
+            log.warning("queue.dead_lettered", {"task_ids": dead})
+        return dead
+
+    async def refresh_depth(self) -> int:
+        eng = await self._eng()
+        async with eng.connect() as conn:
+            depth = await conn.execute(text("SELECT count(*) FROM task_queue WHERE state = 'queued'"))
+            self._depth = int(depth.scalar() or 0)
+        return self._depth
+
+    async def _maintain(self) -> None:
+        """Every ``maintain_sec``: dead-letter exhausted leases and recount the queue, for all workers."""
+        while True:
+            try:
+                await self.reap()
+                await self.refresh_depth()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.warning("queue.maintain_failed", {"owner": self.owner, "error": str(exc)})
+            await asyncio.sleep(self.maintain_sec)
+
+    async def close(self) -> None:
+        if self._maintainer is not None and not self._maintainer.done():
+            self._maintainer.cancel()
+        self._maintainer = None
+        for task_id in list(self._heartbeats):
+            self._stop_heartbeat(task_id)
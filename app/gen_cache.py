@@ -0,0 +1,131 @@
+from __future__ import annotations
+import asyncio, hashlib, json, os, threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from .logging_setup import get_logger
+from .metrics import gen_cache_requests_total, gen_cache_bytes
+
+log = get_logger("gen_cache")
+
+GEN_CACHE_ENABLED = (os.getenv("GEN_CACHE_ENABLED", "0") or "0").lower() not in {"0", "false", "no", "off"}
+GEN_CACHE_DIR = Path(os.getenv("GEN_CACHE_DIR", "/data/gen_cache"))
+GEN_CACHE_MAX_BYTES = int(os.getenv("GEN_CACHE_MAX_BYTES", str(256 * 1024 * 1024)) or "0")
+
+# Ollama final-chunk fields worth replaying on a hit (token counts feed the UI and bandit logs).
+_META_KEYS = ("prompt_eval_count", "eval_count", "prompt_tokens", "completion_tokens")
+
+
+def cache_key(model: str, prompt: str, num_ctx: int, num_predict: int, temperature: float) -> str:
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    raw = json.dumps([model, prompt_hash, int(num_ctx), int(num_predict), round(float(temperature), 4)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """Content-addressed store of finished generations on disk, bounded by ``max_bytes``.
+
+    One JSON file per key under ``root/<key[:2]>/``. Recency lives in an in-memory ``OrderedDict``
+    seeded from file mtimes on first use (hits touch the file, so the order survives restarts) and
+    the least recently used entries are deleted once the total size exceeds the budget.
+    """
+
+    def __init__(self, root: Path = GEN_CACHE_DIR, max_bytes: int = GEN_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max(0, int(max_bytes))
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def _load_index(self) -> None:
+        if self._loaded:
+            return
+        entries = []
+        if self.root.exists():
+            for p in self.root.glob("*/*.json"):
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, p.stem, st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._bytes += size
+        self._loaded = True
+        gen_cache_bytes.set(self._bytes)
+
+    def _evict(self) -> None:
+        while self._index and self._bytes > self.max_bytes:
+            key, size = self._index.popitem(last=False)
+            self._bytes -= size
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                log.warning("gen_cache.evict_failed", {"key": key, "error": str(exc)})
+            gen_cache_requests_total.labels(result="evicted").inc()
+        gen_cache_bytes.set(self._bytes)
+
+    def get_sync(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                gen_cache_requests_total.labels(result="miss").inc()
+                return None
+            path = self._path(key)
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+                os.utime(path)
+            except (OSError, ValueError):
+                self._bytes -= self._index.pop(key, 0)
+                gen_cache_requests_total.labels(result="miss").inc()
+                return None
+            self._index.move_to_end(key)
+            gen_cache_requests_total.labels(result="hit").inc()
+            return entry
+
+    def put_sync(self, key: str, text: str, meta: Optional[Dict[str, Any]] = None) -> None:
+        body = json.dumps({
+            "text": text,
+            "meta": {k: v for k, v in (meta or {}).items() if k in _META_KEYS},
+        }, ensure_ascii=False).encode("utf-8")
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._load_index()
+            path = self._path(key)
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix(".tmp")
+                tmp.write_bytes(body)
+                os.replace(tmp, path)
+            except OSError as exc:
+                log.warning("gen_cache.write_failed", {"key": key, "error": str(exc)})
+                return
+            self._bytes += len(body) - self._index.pop(key, 0)
+            self._index[key] = len(body)
+            gen_cache_requests_total.labels(result="stored").inc()
+            self._evict()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def put(self, key: str, text: str, meta: Optional[Dict[str, Any]] = None) -> None:
+        await asyncio.to_thread(self.put_sync, key, text, meta)
+
+
+gen_cache = GenerationCache()
+
+
+def cache_enabled_for(job: Dict[str, Any]) -> bool:
+    """Env opt-in; ``metadata.gen_cache`` can only opt a task out, never past the operator's setting."""
+    if not GEN_CACHE_ENABLED:
+        return False
+    flag = (job.get("metadata") or {}).get("gen_cache")
+    return flag is None or str(flag).lower() not in {"0", "false", "no", "off"}
@@ -0,0 +1,141 @@
+from __future__ import annotations
+import asyncio, os, time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set
+
+from ..logging_setup import get_logger
+from ..metrics import ollama_backend_healthy, ollama_backend_inflight
+from .http_pool import async_client, timeout, traced
+
+log = get_logger("ollama_backends")
+
+# Comma-separated Ollama base URLs; falls back to the single OLLAMA_HOST.
+OLLAMA_HOSTS = [
+    h.strip().rstrip("/")
+    for h in (os.getenv("OLLAMA_HOSTS") or os.getenv("OLLAMA_HOST", "http://localhost:11434")).split(",")
+    if h.strip()
+]
+OLLAMA_BACKEND_PROBE_SEC = float(os.getenv("OLLAMA_BACKEND_PROBE_SEC", "5") or "5")
+OLLAMA_BACKEND_COOLDOWN_SEC = float(os.getenv("OLLAMA_BACKEND_COOLDOWN_SEC", "15") or "15")
+
+
+@dataclass
+class Backend:
+    url: str
+    healthy: bool = True
+    inflight: int = 0
+    loaded: Set[str] = field(default_factory=set)
+    down_until: float = 0.0
+    probed_at: float = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.healthy or now >= self.down_until
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"url": self.url, "healthy": self.healthy, "inflight": self.inflight, "loaded": sorted(self.loaded)}
+
+
+class BackendPool:
+    """Routes Ollama calls across several hosts.
+
+    Each backend's health and resident models come from ``/api/ps``, probed in the background
+    every ``probe_sec``; in-flight generations are counted locally. ``pick`` prefers a healthy
+    backend that already has the model loaded, then the one with the fewest in-flight requests.
+    A backend that fails a connection is benched for ``cooldown_sec`` (or until a probe succeeds).
+    """
+
+    def __init__(self, urls: Iterable[str], probe_sec: float = OLLAMA_BACKEND_PROBE_SEC, cooldown_sec: float = OLLAMA_BACKEND_COOLDOWN_SEC):
+        self.backends: List[Backend] = [Backend(u.rstrip("/")) for u in urls]
+        if not self.backends:
+            raise ValueError("at least one Ollama backend is required")
+        self.probe_sec = probe_sec
+        self.cooldown_sec = cooldown_sec
+        self._probing: Optional[asyncio.Task] = None
+        self._probed_once = False
+
+    @property
+    def primary(self) -> str:
+        return self.backends[0].url
+
+    async def _probe(self, b: Backend) -> None:
+        try:
+            r = await async_client().get(f"{b.url}/api/ps", timeout=timeout(2.0), extensions=traced("ps"))
+            r.raise_for_status()
+            models = r.json().get("models") or []
+            b.loaded = {str(m.get("model") or m.get("name")) for m in models if m.get("model") or m.get("name")}
+            if not b.healthy:
+                log.info("ollama.backend.recovered", {"backend": b.url})
+            b.healthy = True
+        except Exception as exc:
+            if b.healthy:
+                log.warning("ollama.backend.unhealthy", {"backend": b.url, "error": str(exc)})
+            b.healthy = False
+            b.down_until = time.monotonic() + self.cooldown_sec
+        b.probed_at = time.monotonic()
+        ollama_backend_healthy.labels(backend=b.url).set(1 if b.healthy else 0)
+
+    async def refresh(self) -> None:
+        await asyncio.gather(*(self._probe(b) for b in self.backends))
+        self._probed_once = True
+
+    async def _refresh_if_stale(self) -> None:
+        if len(self.backends) == 1:
+            return  # nothing to choose between; the request itself reports failures
+        if not self._probed_once:
+            await self.refresh()
+            return
+        stale = time.monotonic() - min(b.probed_at for b in self.backends) >= self.probe_sec
+        if stale and (self._probing is None or self._probing.done()):
+            self._probing = asyncio.create_task(self.refresh())
+
+    async def pick(self, model: Optional[str] = None, exclude: Iterable[str] = ()) -> Optional[Backend]:
+        await self._refresh_if_stale()
+        now = time.monotonic()
+        skip = set(exclude)
+        untried = [b for b in self.backends if b.url not in skip]
+        # benched backends are still a last resort, so one flaky host never locks everything out
+        pool = [b for b in untried if b.available(now)] or untried
+        if not pool:
+            return None
+        # resident model first, then least loaded; list order breaks ties (primary first)
+        return min(pool, key=lambda b: (not b.healthy, model is not None and model not in b.loaded, b.inflight))
+
+    def mark_failed(self, b: Backend, error: str) -> None:
+        b.healthy = False
+        b.down_until = time.monotonic() + self.cooldown_sec
+        ollama_backend_healthy.labels(backend=b.url).set(0)
+        log.warning("ollama.backend.failed", {"backend": b.url, "error": error[:200]})
+
+    def note_loaded(self, b: Backend, model: str) -> None:
+        b.loaded.add(model)
+
+    def note_unloaded(self, b: Backend, model: str) -> None:
+        b.loaded.discard(model)
+
+    def get(self, url: str) -> Optional[Backend]:
+        return next((b for b in self.backends if b.url == url), None)
+
+    @asynccontextmanager
+    async def using(self, b: Backend) -> AsyncIterator[Backend]:
+        b.inflight += 1
+        ollama_backend_inflight.labels(backend=b.url).set(b.inflight)
+        try:
+            yield b
+        finally:
+            b.inflight -= 1
+            ollama_backend_inflight.labels(backend=b.url).set(b.inflight)
+
+    def loaded_models(self) -> Set[str]:
+        now = time.monotonic()
+        out: Set[str] = set()
+        for b in self.backends:
+            if b.available(now):
+                out |= b.loaded
+        return out
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [b.as_dict() for b in self.backends]
+
+
+backend_pool = BackendPool(OLLAMA_HOSTS)
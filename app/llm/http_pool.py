@@ -0,0 +1,100 @@
+from __future__ import annotations
+import asyncio, os, threading, time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from ..metrics import ollama_http_pool_wait_seconds, ollama_http_connections_opened_total
+
+OLLAMA_HTTP_MAX_CONNECTIONS = int(os.getenv("OLLAMA_HTTP_MAX_CONNECTIONS", "32") or "32")
+OLLAMA_HTTP_MAX_KEEPALIVE = int(os.getenv("OLLAMA_HTTP_MAX_KEEPALIVE", "16") or "16")
+OLLAMA_HTTP_KEEPALIVE_SEC = float(os.getenv("OLLAMA_HTTP_KEEPALIVE_SEC", "120") or "120")
+OLLAMA_HTTP_CONNECT_TIMEOUT_SEC = float(os.getenv("OLLAMA_HTTP_CONNECT_TIMEOUT_SEC", "5") or "5")
+OLLAMA_HTTP_POOL_TIMEOUT_SEC = float(os.getenv("OLLAMA_HTTP_POOL_TIMEOUT_SEC", "30") or "30")
+
+_async_client: Optional[httpx.AsyncClient] = None
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_client: Optional[httpx.Client] = None
+_sync_lock = threading.Lock()
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OLLAMA_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=OLLAMA_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=OLLAMA_HTTP_KEEPALIVE_SEC,
+    )
+
+
+def timeout(read: Optional[float]) -> httpx.Timeout:
+    """Pool-wide connect/pool timeouts with a per-call read/write timeout (None = unbounded, for streams)."""
+    return httpx.Timeout(read, connect=OLLAMA_HTTP_CONNECT_TIMEOUT_SEC, pool=OLLAMA_HTTP_POOL_TIMEOUT_SEC)
+
+
+def async_client() -> httpx.AsyncClient:
+    """The process-wide Ollama client; recreated if closed or if the running loop changed."""
+    global _async_client, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_loop is not loop:
+        _async_client = httpx.AsyncClient(limits=_limits(), timeout=timeout(None))
+        _async_loop = loop
+    return _async_client
+
+
+def sync_client() -> httpx.Client:
+    """Blocking twin of ``async_client`` for the synchronous registry discovery path."""
+    global _sync_client
+    with _sync_lock:
+        if _sync_client is None or _sync_client.is_closed:
+            _sync_client = httpx.Client(limits=_limits(), timeout=timeout(None))
+        return _sync_client
+
+
+def _pool_tracer(endpoint: str, t0: float):
+    """httpcore trace hook: time until the request got a connection (fresh or from the pool)."""
+    seen = False
+
+    def observe(event: str) -> None:
+        nonlocal seen
+        if event == "connection.connect_tcp.started":
+            ollama_http_connections_opened_total.labels(endpoint=endpoint).inc()
+        if not seen and event in ("connection.connect_tcp.started", "http11.send_request_headers.started", "http2.send_request_headers.started"):
+            seen = True
+            ollama_http_pool_wait_seconds.labels(endpoint=endpoint).observe(time.perf_counter() - t0)
+
+    return observe
+
+
+def traced(endpoint: str) -> Dict[str, Any]:
+    """Request ``extensions`` for the async client that record pool wait per endpoint."""
+    observe = _pool_tracer(endpoint, time.perf_counter())
+
+    async def trace(event: str, info: Dict[str, Any]) -> None:
+        observe(event)
+
+    return {"trace": trace}
+
+
+def traced_sync(endpoint: str) -> Dict[str, Any]:
+    observe = _pool_tracer(endpoint, time.perf_counter())
+
+    def trace(event: str, info: Dict[str, Any]) -> None:
+        observe(event)
+
+    return {"trace": trace}
+
+
+async def open_pool() -> None:
+    async_client()
+
+
+async def close_pool() -> None:
+    global _async_client, _sync_client
+    # a client left over from another (finished) loop cannot be closed from this one: just drop it
+    if _async_client is not None and not _async_client.is_closed and _async_loop is asyncio.get_running_loop():
+        await _async_client.aclose()
+    _async_client = None
+    with _sync_lock:
+        if _sync_client is not None:
+            _sync_client.close()
+        _sync_client = None
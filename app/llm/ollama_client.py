@@ -1,93 +1,217 @@
 from __future__ import annotations
 import os, asyncio, json, time
-from typing import Optional, AsyncIterator, Dict, Any, Set, Tuple
+from typing import Optional, AsyncIterator, Awaitable, Callable, Dict, Any, List, Set, Tuple
 import httpx
 
-OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
+from .http_pool import async_client, timeout, traced
+from .backends import backend_pool
+from ..logging_setup import get_logger
+from ..metrics import ollama_backend_failovers_total, ollama_pulls_total
+
+log = get_logger("ollama_client")
+
+OLLAMA_HOST = backend_pool.primary
 OLLAMA_AUTOPULL = os.getenv("OLLAMA_AUTOPULL", "true").lower() in ("1","true","yes")
 OLLAMA_TAG_CACHE_TTL = float(os.getenv("OLLAMA_TAG_CACHE_TTL", "30") or "30")
+# Once a model is confirmed on a host, skip the tags lookup for this long (a 404 clears it sooner).
+OLLAMA_PRESENCE_TTL_SEC = float(os.getenv("OLLAMA_PRESENCE_TTL_SEC", "3600") or "3600")
+OLLAMA_PULL_PROGRESS_SEC = float(os.getenv("OLLAMA_PULL_PROGRESS_SEC", "1") or "1")
 
 class OllamaError(RuntimeError):
     pass
 
 _TAG_CACHE_LOCK = asyncio.Lock()
-_TAG_CACHE: Dict[str, Any] = {"ts": 0.0, "data": set()}
+_TAG_CACHE: Dict[str, Dict[str, Any]] = {}  # host -> {"ts", "data"}
 
-async def _fetch_tags() -> Set[str]:
-    url = f"{OLLAMA_HOST}/api/tags"
-    async with httpx.AsyncClient(timeout=10.0) as cx:
-        r = await cx.get(url)
-        r.raise_for_status()
-        data = r.json()
-        models = data.get("models") or []
-        out: Set[str] = set()
-        for m in models:
-            s = m.get("model") or ""
-            if s:
-                out.add(str(s))
-        return out
-
-async def _tags() -> Set[str]:
+async def _fetch_tags(host: str = OLLAMA_HOST) -> Set[str]:
+    url = f"{host}/api/tags"
+    r = await async_client().get(url, timeout=timeout(10.0), extensions=traced("tags"))
+    r.raise_for_status()
+    data = r.json()
+    models = data.get("models") or []
+    out: Set[str] = set()
+    for m in models:
+        s = m.get("model") or ""
+        if s:
+            out.add(str(s))
+    return out
+
+async def _tags(host: str = OLLAMA_HOST) -> Set[str]:
     now = time.monotonic()
     async with _TAG_CACHE_LOCK:
-        cached = _TAG_CACHE.get("data") or set()
-        ts = float(_TAG_CACHE.get("ts") or 0.0)
+        entry = _TAG_CACHE.get(host) or {}
+        cached = entry.get("data") or set()
+        ts = float(entry.get("ts") or 0.0)
         if cached and (now - ts) <= OLLAMA_TAG_CACHE_TTL:
             return set(cached)
     tags: Set[str] = set()
     try:
-        tags = await _fetch_tags()
+        tags = await _fetch_tags(host)
     except Exception:
         # best effort: fall back to cached snapshot if available, else re-raise
         async with _TAG_CACHE_LOCK:
-            cached = _TAG_CACHE.get("data") or set()
+            cached = (_TAG_CACHE.get(host) or {}).get("data") or set()
             if cached:
                 return set(cached)
         raise
     async with _TAG_CACHE_LOCK:
-        _TAG_CACHE["data"] = set(tags)
-        _TAG_CACHE["ts"] = time.monotonic()
+        _TAG_CACHE[host] = {"data": set(tags), "ts": time.monotonic()}
     return tags
 
-async def _pull(model: str) -> None:
-    url = f"{OLLAMA_HOST}/api/pull"
-    payload = {"model": model, "stream": False}
-    async with httpx.AsyncClient(timeout=None) as cx:
-        try:
-            r = await cx.post(url, json=payload)
-            r.raise_for_status()
-        except httpx.HTTPStatusError as exc:
-            detail = ""
+async def loaded_models() -> Set[str]:
+    """Models currently resident in Ollama memory (``/api/ps``), across all healthy backends."""
+    await backend_pool.refresh()
+    if not any(b.healthy for b in backend_pool.backends):
+        raise OllamaError("no healthy Ollama backend")
+    return backend_pool.loaded_models()
+
+PullListener = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class _PullFlight:
+    """One in-progress pull of a model on a host; concurrent callers subscribe instead of re-pulling."""
+
+    def __init__(self) -> None:
+        self.listeners: List[PullListener] = []
+        self.task: Optional[asyncio.Task] = None
+        self._last_status = ""
+        self._last_at = 0.0
+
+    async def notify(self, progress: Dict[str, Any]) -> None:
+        status = str(progress.get("status") or "")
+        now = time.monotonic()
+        if status == self._last_status and now - self._last_at < OLLAMA_PULL_PROGRESS_SEC:
+            return
+        self._last_status, self._last_at = status, now
+        for listener in list(self.listeners):
             try:
-                await exc.response.aread()
-                detail = exc.response.text.strip()
+                await listener(progress)
             except Exception:
-                detail = ""
-            msg = f"Ollama pull failed (status={exc.response.status_code})"
-            if detail:
-                msg += f": {detail}"
-            raise OllamaError(msg) from exc
-        # returns {"status":"done"} on completion
+                pass
+
+
+_PULLS: Dict[Tuple[str, str], _PullFlight] = {}
+_PRESENT: Dict[Tuple[str, str], float] = {}  # (host, model) -> monotonic time it was last confirmed
+
+
+def forget_model(model: str, host: str = OLLAMA_HOST) -> None:
+    """Drop cached presence (e.g. Ollama answered 404 for it), so the next ensure_model re-checks."""
+    _PRESENT.pop((host, model), None)
+    entry = _TAG_CACHE.get(host)
+    if entry:
+        entry.get("data", set()).discard(model)
+
+
+async def _pull(model: str, host: str = OLLAMA_HOST, notify: Optional[PullListener] = None) -> None:
+    url = f"{host}/api/pull"
+    payload = {"model": model, "stream": True}
+    try:
+        async with async_client().stream("POST", url, json=payload, timeout=timeout(None), extensions=traced("pull")) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:
+                    raise OllamaError(f"Ollama pull returned unexpected response format: {line[:200]}") from None
+                if obj.get("error"):
+                    raise OllamaError(f"Ollama pull failed: {obj['error']}")
+                if notify is not None:
+                    await notify(obj)
+    except httpx.HTTPStatusError as exc:
+        detail = ""
         try:
-            _ = r.json()
-        except json.JSONDecodeError:
-            detail = r.text.strip()
-            msg = "Ollama pull returned unexpected response format"
-            if detail:
-                msg += f": {detail[:200]}"
-            raise OllamaError(msg) from None
-
-async def ensure_model(model: str) -> None:
+            await exc.response.aread()
+            detail = exc.response.text.strip()
+        except Exception:
+            detail = ""
+        msg = f"Ollama pull failed (status={exc.response.status_code})"
+        if detail:
+            msg += f": {detail}"
+        raise OllamaError(msg) from exc
+
+
+async def _pull_once(model: str, host: str, on_progress: Optional[PullListener]) -> None:
+    """Single-flight pull: the first caller starts it, later callers wait on the same task."""
+    key = (host, model)
+    flight = _PULLS.get(key)
+    if flight is None:
+        flight = _PULLS[key] = _PullFlight()
+        flight.task = asyncio.create_task(_pull(model, host, flight.notify))
+        flight.task.add_done_callback(lambda _t: _PULLS.pop(key, None))
+        ollama_pulls_total.labels(outcome="started").inc()
+        log.info("ollama.pull.started", {"model": model, "host": host})
+    else:
+        ollama_pulls_total.labels(outcome="joined").inc()
+    if on_progress is not None:
+        flight.listeners.append(on_progress)
     try:
-        tags = await _tags()
-        if model in tags:
-            return
-        if not OLLAMA_AUTOPULL:
-            raise OllamaError(f"Model '{model}' not present and autopull disabled")
-        await _pull(model)
+        # shield: a cancelled candidate must not abort a multi-GB download others are waiting on
+        await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        ollama_pulls_total.labels(outcome="failed").inc()
+        raise
+    finally:
+        if on_progress is not None and on_progress in flight.listeners:
+            flight.listeners.remove(on_progress)
+
+
+async def ensure_model(model: str, host: Optional[str] = None, on_progress: Optional[PullListener] = None) -> None:
+    host = host or OLLAMA_HOST
+    seen = _PRESENT.get((host, model))
+    if seen is not None and time.monotonic() - seen <= OLLAMA_PRESENCE_TTL_SEC:
+        return
+    try:
+        tags = await _tags(host)
+        if model not in tags:
+            if not OLLAMA_AUTOPULL:
+                raise OllamaError(f"Model '{model}' not present and autopull disabled")
+            await _pull_once(model, host, on_progress)
+        _PRESENT[(host, model)] = time.monotonic()
     except httpx.HTTPError as e:
         raise OllamaError(f"Ollama error listing/pulling models: {e}") from e
 
+_KEEP_ALIVE: Dict[str, str] = {}  # model -> keep_alive sent with every generate (residency pins)
+
+
+def set_keep_alive(model: str, keep_alive: Optional[str]) -> None:
+    """Pin (or with None, unpin) the ``keep_alive`` generate requests send for ``model``.
+
+    Ollama resets a model's unload timer to each request's ``keep_alive`` (default 5m), so a model
+    preloaded for 30 minutes must keep asking for 30 minutes or the first real request shortens it.
+    """
+    if keep_alive is None:
+        _KEEP_ALIVE.pop(model, None)
+    else:
+        _KEEP_ALIVE[model] = keep_alive
+
+
+async def load_model(model: str, host: str, keep_alive: str) -> None:
+    """Load ``model`` into memory on ``host`` without generating (Ollama's empty-prompt request)."""
+    await ensure_model(model, host)
+    payload = {"model": model, "prompt": "", "stream": False, "keep_alive": keep_alive}
+    try:
+        r = await async_client().post(f"{host}/api/generate", json=payload, timeout=timeout(None), extensions=traced("load"))
+        r.raise_for_status()
+    except httpx.HTTPError as e:
+        raise OllamaError(f"Ollama load of {model} on {host} failed: {e}") from e
+
+
+async def unload_model(model: str, host: str) -> None:
+    """Ask ``host`` to evict ``model`` from memory now (``keep_alive: 0``)."""
+    payload = {"model": model, "prompt": "", "stream": False, "keep_alive": 0}
+    try:
+        r = await async_client().post(f"{host}/api/generate", json=payload, timeout=timeout(30.0), extensions=traced("unload"))
+        r.raise_for_status()
+    except httpx.HTTPError as e:
+        raise OllamaError(f"Ollama unload of {model} on {host} failed: {e}") from e
+
+# Failures that mean "this host is unreachable", as opposed to Ollama answering with an error.
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+
 async def generate_stream(
     model: str,
     prompt: str,
@@ -95,18 +219,49 @@ async def generate_stream(
     num_ctx: Optional[int] = None,
     num_predict: Optional[int] = None,
     temperature: Optional[float] = 0.2,
+    on_pull: Optional[PullListener] = None,
 ) -> AsyncIterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
     """
     Yields chunks from /api/generate stream:
       {"response": "<text>", "done": false}
       ...
       {"done": true, "total_duration": ..., "eval_count": ...}
+
+    The request goes to the least-loaded backend that already has ``model`` resident. If a
+    backend cannot be reached before the first chunk arrives, the next one is tried. ``on_pull``
+    receives Ollama's pull progress objects if the model has to be downloaded first.
+    """
+    payload = _payload(model, num_ctx, num_predict, temperature)
+    payload["prompt"] = prompt
+    async for obj, final in _stream("generate", model, payload, on_pull):
+        yield obj, final
+
+
+async def chat_stream(
+    model: str,
+    messages: List[Dict[str, str]],
+    *,
+    num_ctx: Optional[int] = None,
+    num_predict: Optional[int] = None,
+    temperature: Optional[float] = 0.2,
+    on_pull: Optional[PullListener] = None,
+) -> AsyncIterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
+    """``generate_stream`` for /api/chat: same chunk shape, with ``message.content`` as ``response``.
+
+    Ollama keeps the evaluated prompt of the last request per runner slot, so a conversation
+    resent with an unchanged message prefix only pays prompt evaluation for the new turn.
     """
-    await ensure_model(model)
-    url = f"{OLLAMA_HOST}/api/generate"
+    payload = _payload(model, num_ctx, num_predict, temperature)
+    payload["messages"] = messages
+    async for obj, final in _stream("chat", model, payload, on_pull):
+        if not obj.get("done"):
+            obj = {"response": (obj.get("message") or {}).get("content") or "", "done": False}
+        yield obj, final
+
+
+def _payload(model: str, num_ctx: Optional[int], num_predict: Optional[int], temperature: Optional[float]) -> Dict[str, Any]:
     payload: Dict[str, Any] = {
         "model": model,
-        "prompt": prompt,
         "stream": True,
         "options": {}
     }
@@ -116,37 +271,77 @@ async def generate_stream(
         payload["options"]["num_predict"] = int(num_predict)
     if temperature is not None:
         payload["options"]["temperature"] = float(temperature)
+    if model in _KEEP_ALIVE:
+        payload["keep_alive"] = _KEEP_ALIVE[model]
+    return payload
+
 
-    async with httpx.AsyncClient(timeout=None) as cx:
+async def _stream(
+    endpoint: str,
+    model: str,
+    payload: Dict[str, Any],
+    on_pull: Optional[PullListener],
+) -> AsyncIterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
+    tried: list[str] = []
+    refetched = False
+    retry_on = None
+    while True:
+        if retry_on is not None:
+            backend, retry_on = retry_on, None
+        else:
+            backend = await backend_pool.pick(model, exclude=tried)
+            if backend is None:
+                raise OllamaError(f"no reachable Ollama backend for {model} (tried: {', '.join(tried) or 'none'})")
+            tried.append(backend.url)
+        started = False
         try:
-            async with cx.stream("POST", url, json=payload) as r:
-                r.raise_for_status()
-                final: Optional[Dict[str, Any]] = None
-                async for line in r.aiter_lines():
-                    if not line:
-                        continue
-                    try:
-                        obj = json.loads(line)
-                    except json.JSONDecodeError:
-                        continue
-                    if obj.get("done"):
-                        final = obj
-                        yield obj, final
-                        final = None
-                    else:
-                        yield obj, final
-                if final:
-                    yield {}, final
-        except httpx.HTTPStatusError as exc:
-            detail = ""
-            try:
-                await exc.response.aread()
-                detail = exc.response.text.strip()
-            except Exception:
+            async with backend_pool.using(backend):
+                await ensure_model(model, backend.url, on_pull)
+                url = f"{backend.url}/api/{endpoint}"
+                async with async_client().stream("POST", url, json=payload, timeout=timeout(None), extensions=traced(endpoint)) as r:
+                    r.raise_for_status()
+                    final: Optional[Dict[str, Any]] = None
+                    async for line in r.aiter_lines():
+                        if not line:
+                            continue
+                        try:
+                            obj = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        started = True
+                        if obj.get("done"):
+                            final = obj
+                            backend_pool.note_loaded(backend, model)
+                            yield obj, final
+                            final = None
+                        else:
+                            yield obj, final
+                    if final:
+                        yield {}, final
+            return
+        except (OllamaError, httpx.HTTPError) as exc:
+            if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 404 and not started:
+                # presence cache was stale (model deleted / host rebuilt): re-check and pull once
+                forget_model(model, backend.url)
+                if not refetched:
+                    refetched, retry_on = True, backend
+                    continue
+            connect_failure = isinstance(exc, _CONNECT_ERRORS) or isinstance(exc.__cause__, _CONNECT_ERRORS)
+            if connect_failure and not started:
+                backend_pool.mark_failed(backend, str(exc))
+                ollama_backend_failovers_total.labels(backend=backend.url).inc()
+                continue
+            if isinstance(exc, OllamaError):
+                raise
+            if isinstance(exc, httpx.HTTPStatusError):
                 detail = ""
-            msg = f"Ollama generate failed (status={exc.response.status_code})"
-            if detail:
-                msg += f": {detail[:200]}"
-            raise OllamaError(msg) from exc
-        except httpx.HTTPError as exc:
-            raise OllamaError(f"Ollama generate request error: {exc}") from exc
+                try:
+                    await exc.response.aread()
+                    detail = exc.response.text.strip()
+                except Exception:
+                    detail = ""
+                msg = f"Ollama {endpoint} failed (status={exc.response.status_code})"
+                if detail:
+                    msg += f": {detail[:200]}"
+                raise OllamaError(msg) from exc
+            raise OllamaError(f"Ollama {endpoint} request error: {exc}") from exc
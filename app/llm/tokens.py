@@ -0,0 +1,84 @@
+from __future__ import annotations
+import math, os
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+# num_ctx values a request may use. Ollama restarts the model runner whenever num_ctx changes,
+# so sizing snaps to a few buckets instead of following the prompt length exactly.
+TOKEN_CTX_BUCKETS = sorted({
+    int(b) for b in (os.getenv("TOKEN_CTX_BUCKETS", "2048,4096,8192,16384,32768") or "").split(",") if b.strip().isdigit()
+}) or [2048, 4096, 8192]
+# Headroom on the prompt estimate; char-ratio estimates are off by ~10% on code-heavy prompts.
+TOKEN_ESTIMATE_MARGIN = float(os.getenv("TOKEN_ESTIMATE_MARGIN", "0.15") or "0.15")
+_MIN_NUM_PREDICT = 256
+
+Tokenizer = Callable[[str], int]
+
+# Average characters per token by model family (BPE vocab size drives most of the difference).
+# Unknown families use the lowest ratio, i.e. the most tokens, so estimates err towards a bigger ctx.
+_CHARS_PER_TOKEN: Dict[str, float] = {
+    "llama3": 4.0,
+    "llama": 3.3,
+    "codellama": 3.2,
+    "mistral": 3.3,
+    "mixtral": 3.3,
+    "qwen": 3.7,
+    "deepseek": 3.4,
+    "gemma": 3.9,
+    "phi": 3.3,
+    "starcoder": 3.4,
+}
+_DEFAULT_CHARS_PER_TOKEN = 3.2
+_TOKENIZERS: Dict[str, Tokenizer] = {}
+
+
+def register_tokenizer(family: str, tokenizer: Tokenizer) -> None:
+    """Use ``tokenizer`` (text -> token count) for models whose name starts with ``family``."""
+    _TOKENIZERS[family.lower()] = tokenizer
+
+
+def model_family(model: str) -> str:
+    """``"qwen2.5-coder:14b"`` -> ``"qwen"``: the longest known family prefix of the model name."""
+    name = str(model or "").split(":", 1)[0].rsplit("/", 1)[-1].lower()
+    known = [f for f in (*_TOKENIZERS, *_CHARS_PER_TOKEN) if name.startswith(f)]
+    return max(known, key=len) if known else name
+
+
+def estimate_tokens(model: str, text: str) -> int:
+    if not text:
+        return 0
+    family = model_family(model)
+    tokenizer = _TOKENIZERS.get(family)
+    if tokenizer is not None:
+        return int(tokenizer(text))
+    return math.ceil(len(text) / _CHARS_PER_TOKEN.get(family, _DEFAULT_CHARS_PER_TOKEN))
+
+
+@dataclass
+class ContextPlan:
+    num_ctx: int
+    num_predict: int
+    prompt_tokens: int     # estimate, before the margin
+    truncated: bool = False  # the prompt alone does not fit the model's context; Ollama will cut it
+
+
+def _buckets(max_ctx: int) -> List[int]:
+    return sorted({b for b in TOKEN_CTX_BUCKETS if b < max_ctx} | {max_ctx})
+
+
+def plan_context(model: str, prompt: str, num_predict: int, max_ctx: int) -> ContextPlan:
+    """Smallest ctx bucket that holds the prompt plus ``num_predict``, capped at ``max_ctx``.
+
+    When even ``max_ctx`` is too small the output budget shrinks first (down to 256 tokens);
+    only then is the plan marked ``truncated``.
+    """
+    prompt_tokens = estimate_tokens(model, prompt)
+    reserved = math.ceil(prompt_tokens * (1.0 + TOKEN_ESTIMATE_MARGIN))
+    max_ctx = max(1, int(max_ctx))
+    need = reserved + num_predict
+    num_ctx = next((b for b in _buckets(max_ctx) if b >= need), max_ctx)
+    truncated = False
+    if need > num_ctx:
+        num_predict = max(min(num_predict, _MIN_NUM_PREDICT), num_ctx - reserved)
+        truncated = reserved + num_predict > num_ctx
+    return ContextPlan(num_ctx=num_ctx, num_predict=num_predict, prompt_tokens=prompt_tokens, truncated=truncated)
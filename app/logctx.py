@@ -11,6 +11,7 @@ def set_request_id(v: str|None): _request_id.set(v)
 def set_route(v: str|None):      _route.set(v)
 def set_task_id(v: str|None):    _task_id.set(v)
 def set_candidate(v: str|None):  _candidate.set(v)
+def get_candidate() -> str|None: return _candidate.get()
 
 def ctx_snapshot() -> Dict[str,str|None]:
     return {
@@ -1,5 +1,10 @@
 from __future__ import annotations
 import asyncio
+from .llm.http_pool import open_pool as open_ollama_pool, close_pool as close_ollama_pool
+from .residency import residency, RESIDENCY_ENABLED
+from .sse import SSE_HEARTBEAT_SEC
+from .sse_pg import PgStreamBackend, SSE_BACKEND
+from .artifact_watch import artifact_watcher
 class BodySizeLimitASGI:
     """ASGI wrapper enforcing max HTTP request body size (default 10MiB)."""
     def __init__(self, app, max_bytes=None):
@@ -54,7 +59,7 @@ from .queue import JobQueue
 from .db import init_db
 from .logging_setup import setup_json_logging, get_logger
 from .middleware import RequestIDMiddleware
-from .registry import available_models
+from .registry import available_models, refresh_registry, run_registry_refresher
 from .llm.ollama_client import ensure_model, OllamaError
 from .settings import settings
 setup_json_logging()
@@ -78,6 +83,12 @@ app.include_router(bandit_stats_router)
 app.include_router(bandit_ui_router)
 @app.on_event("startup")
 async def _startup():
+    await open_ollama_pool()
+    try:
+        await refresh_registry(force_discovery=True)
+    except Exception as exc:
+        log.warning("registry.initial_refresh_failed", {"err": str(exc)})
+    app.state.registry_refresher = asyncio.create_task(run_registry_refresher())
     try:
         await init_db()
         log.info("db.init_ok")
@@ -85,6 +96,9 @@ async def _startup():
         log.error("db.init_failed", {"err": str(exc)})
         raise
     await _ensure_primary_models()
+    if SSE_BACKEND == "postgres":
+        # SSE events reach clients connected to any API worker or replica
+        await hub.attach(PgStreamBackend())
     # create and start the queue
     jobq = JobQueue(hub)
     await jobq.start()
@@ -93,8 +107,24 @@ async def _startup():
     # also set module global for older call sites
     from . import api as api_module
     api_module.job_queue = jobq
-    asyncio.create_task(_warm_default_models())
+    if RESIDENCY_ENABLED:
+        app.state.residency_manager = asyncio.create_task(residency.run())
+    else:
+        asyncio.create_task(_warm_default_models())
     log.info("startup complete")
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    for name in ("registry_refresher", "residency_manager"):
+        bg = getattr(app.state, name, None)
+        if bg is not None:
+            bg.cancel()
+    jobq = getattr(app.state, "job_queue", None)
+    if jobq is not None:
+        await jobq.stop()
+    await hub.detach()
+    await close_ollama_pool()
 @app.get("/")
 async def root():
     return {"ok": True, "service": "macs-api"}
@@ -278,35 +308,23 @@ def _sse_event(obj) -> bytes:
         return f"data: {json.dumps(obj, ensure_ascii=False)}\n\n".encode("utf-8")
     except Exception:
         return b"data: {\"status\":\"error\",\"note\":\"json-dump\"}\n\n"
-def _artifact_root(task_id: str) -> Path:
-    base = os.getenv("ARTIFACTS_DIR", "/app/artifacts")
-    return Path(base) / task_id
-def _stream_gen(task_id: str):
-    root = _artifact_root(task_id)
-    # Immediate early-exit if artifacts already present
-    try:
-        if root.exists() and root.is_dir():
+async def _stream_gen(task_id: str):
+    # Waits on the shared artifacts watcher instead of sleeping in a threadpool thread (30s cap)
+    deadline = time.monotonic() + 30.0
+    while True:
+        remaining = deadline - time.monotonic()
+        if await artifact_watcher.wait(task_id, max(0.0, min(SSE_HEARTBEAT_SEC, remaining))):
             yield _sse_event({"status":"done","note":"artifacts-present"})
             return
-    except Exception:
-        pass
-    # Keepalive loop (30s): half-second pings, exit when artifacts appear
-    for _ in range(60):
-        try:
-            if root.exists() and root.is_dir():
-                yield _sse_event({"status":"done","note":"artifacts-present"})
-                return
-        except Exception:
-            pass
+        if remaining <= SSE_HEARTBEAT_SEC:
+            break
         # comment line keeps the connection alive without spamming JSON
         yield b": keep-alive\n\n"
-        time.sleep(0.5)
     # Timed out without artifacts
     yield _sse_event({"status":"timeout","note":"no-artifacts"})
-    return
 _app = globals().get("app")
 if _app is not None:
-    def _tasks_stream(task_id: str):
+    async def _tasks_stream(task_id: str):
         return StreamingResponse(_stream_gen(task_id), media_type="text/event-stream")
     _app.add_api_route("/v1/tasks/{task_id}/stream", _tasks_stream, methods=["GET"])
 # --- Attach SSE+status router (idempotent) ---
@@ -1,5 +1,5 @@
 from __future__ import annotations
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 router_route_count = Counter("router_route_count", "Routes taken by router", ["model","language"])
 compile_pass_total = Counter("compile_pass_total", "Compile successes")
@@ -10,13 +10,78 @@ duel_rule_decisions_total = Counter("duel_rule_decisions_total","Duel decisions
 
 http_latency = Histogram("http_request_duration_seconds","HTTP latencies",["route","method"])
 sse_terminated_total = Counter("sse_terminated_total","SSE terminations",["reason"])
+# LLM calls take seconds to minutes; the prometheus default buckets stop at 10s.
+LLM_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0, 120.0, 300.0, float("inf"))
 llm_first_token_latency = Histogram(
     "llm_first_token_latency_seconds",
     "Latency from request start until first token is received",
     ["model"],
+    buckets=LLM_LATENCY_BUCKETS,
 )
 llm_generation_latency = Histogram(
     "llm_generation_latency_seconds",
     "Total time spent streaming model output per request",
     ["model"],
+    buckets=LLM_LATENCY_BUCKETS,
 )
+job_queue_depth = Gauge("job_queue_depth", "Jobs waiting in the JobQueue")
+job_workers_busy = Gauge("job_workers_busy", "JobQueue workers currently running a job")
+job_workers_total = Gauge("job_workers_total", "Size of the JobQueue worker pool")
+model_slots_capacity = Gauge("model_slots_capacity", "Concurrent generation slots per model", ["model"])
+model_slots_in_use = Gauge("model_slots_in_use", "Generation slots currently held per model", ["model"])
+model_slots_waiting = Gauge("model_slots_waiting", "Candidates waiting for a generation slot per model", ["model"])
+model_slot_wait_seconds = Histogram(
+    "model_slot_wait_seconds",
+    "Time a candidate waited for a free generation slot",
+    ["model"],
+)
+scheduler_picks_total = Counter("scheduler_picks_total", "Jobs dequeued by scheduler decision", ["scheduler", "reason"])
+ollama_model_swaps_total = Counter("ollama_model_swaps_total", "Generations that had to load model weights first", ["model"])
+ollama_model_swap_seconds_total = Counter(
+    "ollama_model_swap_seconds_total",
+    "Seconds spent loading model weights before generating",
+    ["model"],
+)
+admission_decisions_total = Counter("admission_decisions_total", "POST /v1/tasks admission outcomes", ["decision"])
+task_deadline_total = Counter("task_deadline_total", "Finished jobs by whether they met constraints.latency_ms", ["outcome"])
+task_deadline_degraded_total = Counter("task_deadline_degraded_total", "Strategy degradations applied to fit a deadline", ["action"])
+duel_hedge_total = Counter("duel_hedge_total", "Hedged duels by whether/why the second candidate was launched", ["outcome"])
+tot_branches_total = Counter("tot_branches_total", "Tree-of-thought branch outcomes", ["outcome"])
+task_coalesced_total = Counter("task_coalesced_total", "Submissions attached to an identical in-flight task")
+gen_cache_requests_total = Counter("gen_cache_requests_total", "Generation cache lookups and writes", ["result"])
+gen_cache_bytes = Gauge("gen_cache_bytes", "Bytes held by the on-disk generation cache")
+ollama_http_pool_wait_seconds = Histogram(
+    "ollama_http_pool_wait_seconds",
+    "Time an Ollama request waited for a connection (pooled keep-alive or freshly opened)",
+    ["endpoint"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+ollama_http_connections_opened_total = Counter("ollama_http_connections_opened_total", "New TCP connections opened to Ollama", ["endpoint"])
+ollama_backend_inflight = Gauge("ollama_backend_inflight", "Generations in flight per Ollama backend", ["backend"])
+ollama_backend_healthy = Gauge("ollama_backend_healthy", "1 if the Ollama backend answered its last probe", ["backend"])
+ollama_backend_failovers_total = Counter("ollama_backend_failovers_total", "Generations moved off a backend after a connection failure", ["backend"])
+ollama_pulls_total = Counter("ollama_pulls_total", "Model pulls started, joined by concurrent callers, or failed", ["outcome"])
+model_residency_actions_total = Counter("model_residency_actions_total", "Residency manager preloads, evictions and skipped preloads", ["action"])
+model_preload_seconds = Histogram(
+    "model_preload_seconds",
+    "Time to load model weights into memory ahead of traffic",
+    ["model"],
+    buckets=LLM_LATENCY_BUCKETS,
+)
+llm_prompt_tokens = Histogram(
+    "llm_prompt_tokens",
+    "Prompt tokens per generation as reported by Ollama",
+    ["model"],
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536),
+)
+llm_ctx_utilization = Histogram(
+    "llm_ctx_utilization_ratio",
+    "Share of num_ctx taken by prompt plus output tokens",
+    ["model"],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+sse_hub_tasks = Gauge("sse_hub_tasks", "Tasks with an SSE replay buffer in the StreamHub")
+sse_hub_buffered_bytes = Gauge("sse_hub_buffered_bytes", "Bytes of events held in StreamHub replay buffers")
+sse_pg_notify_total = Counter("sse_pg_notify_total", "SSE events sent through Postgres NOTIFY, inline or spilled to sse_spill, or failed", ["kind"])
+sse_status_watch_tasks = Gauge("sse_status_watch_tasks", "Tasks with open SSE streams registered with the status watcher")
+sse_status_watch_queries_total = Counter("sse_status_watch_queries_total", "Batched task-status lookups issued for open SSE streams")
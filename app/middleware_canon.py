@@ -66,6 +66,10 @@ class SSECanonicalizerMiddleware:
           out: List[str]=[]
           saw_terminal=False; saw_done_marker=False
           for evtxt in parts:
+            # StreamHub frames lead with "id: N"; canonicalize the data line and keep the id
+            idline=""
+            if evtxt.startswith("id:") and "\n" in evtxt:
+              idline,evtxt=evtxt.split("\n",1); idline+="\n"
             if evtxt.startswith("data:"):
               payload=evtxt[5:].lstrip()
               if payload=="[DONE]":
@@ -80,11 +84,11 @@ class SSECanonicalizerMiddleware:
                     obj["status"]="error"; obj.setdefault("note","timeout"); saw_terminal=True
                   if st in ("done","error","canceled") or str(obj.get("note","")).lower()=="artifacts-present":
                     saw_terminal=True
-                  out.append("data: "+json.dumps(obj,ensure_ascii=False)+"\n\n")
+                  out.append(idline+"data: "+json.dumps(obj,ensure_ascii=False)+"\n\n")
                 except Exception:
-                  out.append(evtxt+"\n\n")
+                  out.append(idline+evtxt+"\n\n")
             else:
-              out.append(evtxt+"\n\n")
+              out.append(idline+evtxt+"\n\n")
           if saw_terminal:
             if not saw_done_marker:
               out.append("data: [DONE]\n\n")
@@ -0,0 +1,141 @@
+from __future__ import annotations
+import asyncio, time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Deque, Dict, Optional
+
+from .registry import RegistrySnapshot, model_parallel_sessions, registry_snapshot
+from .metrics import model_slots_capacity, model_slots_in_use, model_slots_waiting, model_slot_wait_seconds
+from .logging_setup import get_logger
+
+log = get_logger("model_slots")
+
+
+class _FairSlot:
+    """Counting semaphore that hands a released slot to the oldest waiter (FIFO, no barging)."""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, int(capacity))
+        self.in_use = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for fut in self._waiters if not fut.done())
+
+    async def acquire(self) -> None:
+        if self.in_use < self.capacity and not self.waiting:
+            self.in_use += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # the slot was handed over just before we were canceled: pass it on
+                self.release()
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+
+    def resize(self, capacity: int) -> None:
+        """Takes effect as slots free up: a smaller capacity retires them, a larger one admits waiters."""
+        self.capacity = max(1, int(capacity))
+        while self.in_use < self.capacity and self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_use += 1
+                fut.set_result(None)
+
+    def release(self) -> None:
+        if self.in_use > self.capacity:  # shrunk while held: retire this slot instead of passing it on
+            self.in_use -= 1
+            return
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)  # ownership moves to the waiter; in_use is unchanged
+                return
+        self.in_use = max(0, self.in_use - 1)
+
+
+class ModelSlots:
+    """Per-model slot scheduler gating Ollama generations.
+
+    Slot counts come from ``num_parallel_sessions`` in ``config/models.yaml``; candidates
+    beyond that wait in arrival order instead of piling more requests onto Ollama. When the
+    registry installs a new snapshot (``models.yaml`` edited), every known model is re-sized.
+    """
+
+    def __init__(self, sizer: Callable[[str], int] = model_parallel_sessions, source: Callable[[], RegistrySnapshot] = registry_snapshot):
+        self._sizer = sizer
+        self._source = source
+        self._sized_for: Optional[RegistrySnapshot] = None
+        self._slots: Dict[str, _FairSlot] = {}
+
+    def _capacity(self, model: str) -> int:
+        try:
+            return int(self._sizer(model))
+        except Exception:
+            return 1
+
+    def _resize_on_swap(self) -> None:
+        try:
+            current = self._source()
+        except Exception:
+            return
+        if current is self._sized_for:
+            return
+        self._sized_for = current
+        for model, slot in self._slots.items():
+            capacity = max(1, self._capacity(model))
+            if capacity != slot.capacity:
+                slot.resize(capacity)
+                model_slots_capacity.labels(model=model).set(slot.capacity)
+                log.info("model_slots.resized", {"model": model, "capacity": slot.capacity})
+
+    def _slot(self, model: str) -> _FairSlot:
+        self._resize_on_swap()
+        slot = self._slots.get(model)
+        if slot is None:
+            slot = _FairSlot(self._capacity(model))
+            self._slots[model] = slot
+            model_slots_capacity.labels(model=model).set(slot.capacity)
+            log.info("model_slots.created", {"model": model, "capacity": slot.capacity})
+        return slot
+
+    def saturated(self, model: str) -> bool:
+        slot = self._slot(model)
+        return slot.in_use >= slot.capacity or slot.waiting > 0
+
+    @asynccontextmanager
+    async def acquire(self, model: str) -> AsyncIterator[float]:
+        """Hold one generation slot for `model`; yields the seconds spent waiting for it."""
+        slot = self._slot(model)
+        started = time.monotonic()
+        model_slots_waiting.labels(model=model).inc()
+        try:
+            await slot.acquire()
+        finally:
+            model_slots_waiting.labels(model=model).dec()
+        waited = time.monotonic() - started
+        model_slot_wait_seconds.labels(model=model).observe(waited)
+        model_slots_in_use.labels(model=model).set(slot.in_use)
+        try:
+            yield waited
+        finally:
+            slot.release()
+            model_slots_in_use.labels(model=model).set(slot.in_use)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {
+            model: {"capacity": slot.capacity, "in_use": slot.in_use, "waiting": slot.waiting}
+            for model, slot in self._slots.items()
+        }
+
+
+model_slots = ModelSlots()
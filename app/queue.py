@@ -1,34 +1,45 @@
 from __future__ import annotations
 from .bandit_client import record as bandit_record
-import asyncio, time, json, textwrap, os, re, traceback, posixpath, copy
-from typing import Dict, Any, List, Tuple, Optional
+import asyncio, time, json, textwrap, os, re, traceback, posixpath, copy, shutil, hashlib, itertools
+from typing import Callable, Dict, Any, List, Tuple, Optional
 from dataclasses import dataclass, field
 from pathlib import Path
 from fnmatch import fnmatch
 from .sse import StreamHub
-from .registry import available_models, get_mode_defaults
-from .db import get_engine, update_task_status
+from .registry import available_models, get_mode_defaults, routed_models, set_route_builder
+from .db import get_engine, update_task_status, get_task
 from .metrics import (
     router_route_count, compile_pass_total, test_smoke_pass_total,
     duel_selection_decisions_total, duel_rule_decisions_total,
     llm_first_token_latency, llm_generation_latency,
+    job_queue_depth, job_workers_busy, job_workers_total, task_deadline_total, task_deadline_degraded_total,
+    ollama_model_swaps_total, ollama_model_swap_seconds_total, duel_hedge_total, tot_branches_total,
+    task_coalesced_total, llm_prompt_tokens, llm_ctx_utilization,
 )
 from sqlalchemy import text
-from .llm.ollama_client import generate_stream, OllamaError
+from .llm.ollama_client import generate_stream, chat_stream, loaded_models, OllamaError
+from .llm.tokens import plan_context, estimate_tokens, TOKEN_ESTIMATE_MARGIN
+from .chat_sessions import chat_sessions, CHAT_SESSIONS, CHAT_SYSTEM_PROMPT
+from .model_slots import model_slots
+from .scheduler import build_scheduler
+from .admission import generation_latency, histogram_quantile
+from .durable_queue import PgTaskQueue, QUEUE_BACKEND
 from .bandit import extract_features, feature_hash, upsert_stat, rank_models
 from .duel_config import get_duel_config
 from .exec_sandbox import run_sandboxed
 from .build_java import build_and_test_java
 from .logging_setup import get_logger
-from .logctx import set_task_id, set_candidate
+from .logctx import set_task_id, set_candidate, get_candidate
 from .fs_sandbox import resolve_safe_path, WORKSPACE_ROOT
 from .java_utils import fix_java_package, fix_java_filename
 from .workspace_io import ensure_merge_tree
+from .gen_cache import gen_cache, cache_enabled_for, cache_key as cache_key_for
+from .residency import residency
 
 # additions
 from .bandit_store import record_event as bandit_record_event
-from .artifacts import write_result
-from .zips import write_zip
+from .artifacts import write_result, _resolve_root
+from .zips import write_zip, ZIP_ROOT
 from .memory import record_completion
 from .settings import settings
 
@@ -113,6 +124,30 @@ COMPONENT_CLASS_HINTS = {
 CANDIDATE_TIMEOUT_SEC = int(os.getenv("CANDIDATE_TIMEOUT_SEC", "180"))
 DUEL_TIMEOUT_SEC = int(os.getenv("DUEL_TIMEOUT_SEC", "120"))
 FORCE_DUEL = (os.getenv("FORCE_DUEL", "0") or "0").lower() in ("1", "true", "yes")
+# Duel strategy: "gather" waits for both candidates, "race" returns the first that qualifies.
+DUEL_STRATEGY = (os.getenv("DUEL_STRATEGY", "") or "").strip().lower()
+# Race loser: "cancel" it, or "finish" it in the background for bandit rewards only.
+DUEL_RACE_LOSER = (os.getenv("DUEL_RACE_LOSER", "") or "").strip().lower()
+# Hedged duels: thresholds are learned per model from the latency histograms once they have
+# HEDGE_MIN_SAMPLES observations; until then the first-token fallback applies.
+HEDGE_FIRST_TOKEN_MS = float(os.getenv("HEDGE_FIRST_TOKEN_MS", "8000") or "8000")
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.9") or "0.9")
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20") or "20")
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", "2") or "2")
+# Seed for queue wait estimates until a lane has finished a few jobs.
+QUEUE_ETA_DEFAULT_SEC = float(os.getenv("QUEUE_ETA_DEFAULT_SEC", "30") or "30")
+# Position events: only the head of the queue is tracked, recomputed at most once per interval.
+QUEUE_POSITION_LIMIT = int(os.getenv("QUEUE_POSITION_LIMIT", "50") or "50")
+QUEUE_POSITION_INTERVAL_SEC = float(os.getenv("QUEUE_POSITION_INTERVAL_SEC", "1") or "1")
+_ETA_ALPHA = 0.3
+# Deadline-aware execution: fit strategy/timeouts to input.constraints.latency_ms.
+DEADLINE_AWARE = (os.getenv("DEADLINE_AWARE", "0") or "0").lower() in ("1", "true", "yes")
+DEADLINE_MIN_TIMEOUT_SEC = float(os.getenv("DEADLINE_MIN_TIMEOUT_SEC", "10") or "10")
+_DUEL_BUDGET_FACTOR = 1.5    # a duel shares slots/builds between two candidates
+_SEARCH_BUDGET_FACTOR = 3.0  # tot_beam / tiered_refine run several generations
+_MIN_NUM_PREDICT = 256
+# Ollama reports load_duration on every generation; above this it was a cold load / model swap.
+OLLAMA_SWAP_THRESHOLD_SEC = float(os.getenv("OLLAMA_SWAP_THRESHOLD_SEC", "0.5") or "0.5")
 
 ZIP_INCLUDE_REPO = (os.getenv("ZIP_INCLUDE_REPO", "1") or "1").lower() not in ("0", "false", "no", "")
 ZIP_MAX_FILES = int(os.getenv("ZIP_MAX_FILES", "400"))
@@ -139,6 +174,80 @@ TOT_TEST_WEIGHT = float(os.getenv("TOT_TEST_WEIGHT", "1.5") or "1.5")
 TOT_LINT_WEIGHT = float(os.getenv("TOT_LINT_WEIGHT", "0.4") or "0.4")
 TOT_SMOKE_WEIGHT = float(os.getenv("TOT_SMOKE_WEIGHT", "0.4") or "0.4")
 TOT_LATENCY_PENALTY = float(os.getenv("TOT_LATENCY_PENALTY", "0.0005") or "0.0005")
+# Wall-clock budget per ToT depth (0 = unbounded); unfinished branches are cancelled.
+TOT_DEPTH_BUDGET_SEC = float(os.getenv("TOT_DEPTH_BUDGET_SEC", "0") or "0")
+# Concurrent builds/lint/smoke runs per process (candidates and ToT branches share it).
+BUILD_CONCURRENCY = int(os.getenv("BUILD_CONCURRENCY", "2") or "2")
+_TOT_PRUNE_TICK_SEC = 0.5
+# Identical submissions (same inputs + repo fingerprint) attach to the in-flight task instead of re-running.
+COALESCE_TASKS = (os.getenv("COALESCE_TASKS", "1") or "1").lower() not in {"0", "false", "no", "off"}
+# Token deltas on the task's SSE stream, batched into frames of at most one event per interval.
+SSE_TOKEN_DELTAS = (os.getenv("SSE_TOKEN_DELTAS", "1") or "1").lower() not in {"0", "false", "no", "off"}
+SSE_DELTA_INTERVAL_MS = float(os.getenv("SSE_DELTA_INTERVAL_MS", "50") or "50")
+_COALESCE_VOLATILE_META = {"client_id", "request_id", "trace_id"}
+
+
+def _candidate_output_names(task_id: str, tot_suffix: Optional[str] = None, shadow_model: Optional[str] = None) -> Tuple[str, str]:
+    """(merge-tree key, zip name) a candidate writes to: race losers and ToT branches get private ones."""
+    if shadow_model:
+        merge_key = f"{task_id}/shadow-{re.sub(r'[^A-Za-z0-9_.-]', '_', shadow_model)}"
+    elif tot_suffix:
+        merge_key = f"{task_id}/{tot_suffix}"
+    else:
+        merge_key = str(task_id)
+    return merge_key, f"{task_id}_{tot_suffix}" if tot_suffix else str(task_id)
+
+
+def _tot_max_score() -> float:
+    """Best score a ToT branch can reach before its latency penalty."""
+    return TOT_COMPILE_WEIGHT + TOT_TEST_WEIGHT + TOT_LINT_WEIGHT + TOT_SMOKE_WEIGHT
+
+
+@dataclass
+class CandidateProgress:
+    """Milestones a running candidate signals to whoever is watching it (hedged duels)."""
+    first_token: asyncio.Event = field(default_factory=asyncio.Event)
+    generated: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class _DeltaFrames:
+    """Forwards generated text as ``{"type": "delta"}`` events, at most one per frame interval.
+
+    The first piece goes out immediately so the first visible token costs no extra latency.
+    ``muted`` is asked on every flush: a candidate can become invisible while it streams (a race
+    or hedge loser that keeps running once the winner has answered).
+    """
+
+    def __init__(self, publish, task_id: str, candidate: str, tier: Optional[str] = None, interval_ms: float = SSE_DELTA_INTERVAL_MS,
+                 muted: Optional[Callable[[], bool]] = None):
+        self._publish = publish
+        self._muted = muted
+        self._task_id = task_id
+        self._candidate = candidate
+        self._tier = tier
+        self._interval = max(0.0, interval_ms) / 1000.0
+        self._parts: List[str] = []
+        self._last = 0.0
+        self.seq = 0
+
+    async def add(self, piece: str) -> None:
+        self._parts.append(piece)
+        if time.monotonic() - self._last >= self._interval:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._parts:
+            return
+        if self._muted is not None and self._muted():
+            self._parts = []
+            return
+        payload = {"type": "delta", "candidate": self._candidate, "seq": self.seq, "delta": "".join(self._parts)}
+        if self._tier:
+            payload["tier"] = self._tier
+        self._parts = []
+        self._last = time.monotonic()
+        self.seq += 1
+        await self._publish(self._task_id, json.dumps(payload))
 
 
 @dataclass
@@ -148,6 +257,17 @@ class _ToTNode:
     result: Optional[Dict[str, Any]] = None
 
 
+@dataclass
+class _ToTBranch:
+    node: _ToTNode
+    plan: Dict[str, Any]
+    plan_idx: int
+    plan_text: str
+    variant: Dict[str, Any]
+    started: Optional[float] = None
+    latency_ms: Optional[float] = None
+
+
 CODE_BLOCK_RE = re.compile(r"```([\w.+-]*)\n([\s\S]*?)```", re.MULTILINE)
 FILE_LINE_RE = re.compile(r"^\s*(?:[-*•+\d.)>\s]*)?(?:file|path)\s*[:=]\s*([^\s`]+)", re.IGNORECASE | re.MULTILINE)
 FILE_INLINE_RE = re.compile(r"(?:^|\b)(?:file|path)\s*[:=]\s*([^\s`]+)", re.IGNORECASE)
@@ -430,6 +550,56 @@ def _collect_repo_snapshot(job: Dict[str, Any]) -> Tuple[Dict[str, str], List[st
         log.debug("zip.repo.snapshot.empty", {"path": rel})
     return collected, notes, base_prefix or None, repo_dir
 
+def _repo_fingerprint(job: Dict[str, Any]) -> Optional[str]:
+    """Path, size and mtime of every file the repo snapshot would include (no file reads).
+
+    None without an explicit ``input.repo.path``: the workspace root is shared scratch space
+    (duel merge trees, artifacts), not something the submission pinned. Skipped directories are
+    pruned from the walk rather than filtered afterwards.
+    """
+    repo = (job.get("input") or {}).get("repo") or {}
+    if not str(repo.get("path") or "").strip():
+        return None
+    rel = _normalize_repo_rel(repo.get("path"))
+    repo_dir, ok = resolve_safe_path(rel)
+    if not ok or not repo_dir.exists():
+        return "missing"
+    includes = [str(p).strip() for p in (repo.get("include") or []) if str(p).strip()]
+    excludes = [str(p).strip() for p in (repo.get("exclude") or []) if str(p).strip()]
+    skip_dirs = set(ZIP_SKIP_SEGMENTS) | {"artifacts"}
+    digest = hashlib.sha256()
+    entries: List[str] = []
+    try:
+        for dirpath, dirnames, filenames in os.walk(repo_dir):
+            dirnames[:] = [d for d in dirnames if d not in skip_dirs]
+            base = Path(dirpath)
+            for name in filenames:
+                fs_path = base / name
+                rel_path = fs_path.relative_to(repo_dir).as_posix()
+                if _should_skip_repo_file(rel_path, includes, excludes):
+                    continue
+                st = fs_path.stat()
+                entries.append(f"{rel_path}\0{st.st_size}\0{st.st_mtime_ns}\n")
+    except OSError as exc:
+        # an unreadable tree never matches anything, so nothing gets coalesced onto it
+        return f"error:{exc}:{time.time()}"
+    for entry in sorted(entries):
+        digest.update(entry.encode("utf-8"))
+    return digest.hexdigest()
+
+def _coalesce_key(job: Dict[str, Any]) -> str:
+    """Canonical hash of everything that shapes a task's output."""
+    canonical = {k: job.get(k) for k in (
+        "type", "input", "output_contract", "non_negotiables", "oracle", "routing_hints", "options", "prompt_template_version",
+    )}
+    canonical["metadata"] = {
+        k: v for k, v in (job.get("metadata") or {}).items()
+        if not str(k).startswith("_") and k not in _COALESCE_VOLATILE_META
+    }
+    # chat never reads the repo, so the tree walk would only cost latency on the submit path
+    canonical["repo"] = None if _infer_mode(job) == "chat" else _repo_fingerprint(job)
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
 def _rebase_generated_files(
     generated: Dict[str, str],
     repo_files: Dict[str, str],
@@ -603,6 +773,94 @@ def _infer_mode(job: Dict[str, Any]) -> str:
         return "planner"
     return "chat"
 
+def _priority_lane(job: Dict[str, Any]) -> str:
+    mode = _infer_mode(job)
+    if mode in ("chat", "clarify"):
+        return "chat"
+    strategy = str(((job.get("metadata") or {}).get("strategy") or (job.get("routing_hints") or {}).get("strategy") or "")).strip().lower()
+    if mode == "code" and strategy == "tot_beam":
+        return "tot_beam"
+    return "code"
+
+def _duel_strategy(job: Dict[str, Any], cfg: Dict[str, Any]) -> str:
+    hints = job.get("routing_hints") or {}
+    meta = job.get("metadata") or {}
+    value = str(hints.get("duel_strategy") or meta.get("duel_strategy") or DUEL_STRATEGY or cfg.get("strategy") or "gather").strip().lower()
+    return value if value in ("race", "hedge") else "gather"
+
+def _hedge_thresholds(model: str) -> Tuple[float, Optional[float]]:
+    """(first-token limit, generation limit) in seconds for hedging ``model``; the latter is None until learned."""
+    first, n = histogram_quantile(llm_first_token_latency, HEDGE_QUANTILE, model)
+    first_limit = first if first is not None and n >= HEDGE_MIN_SAMPLES else HEDGE_FIRST_TOKEN_MS / 1000.0
+    gen, n = histogram_quantile(llm_generation_latency, HEDGE_QUANTILE, model)
+    gen_limit = gen if gen is not None and n >= HEDGE_MIN_SAMPLES else None
+    return first_limit, gen_limit
+
+def _race_loser_policy(job: Dict[str, Any], cfg: Dict[str, Any]) -> str:
+    meta = job.get("metadata") or {}
+    value = str(meta.get("race_loser") or DUEL_RACE_LOSER or cfg.get("race_loser") or "cancel")
+    return "finish" if value.strip().lower() == "finish" else "cancel"
+
+def _race_qualifies(res: Dict[str, Any]) -> bool:
+    """A race is won by passing tests, or by compiling when the candidate had no test run (non-Java code)."""
+    if res.get("test_pass"):
+        return True
+    ran_tests = str(res.get("tool") or "").startswith(("maven", "gradle"))
+    return bool(res.get("compile_pass")) and not ran_tests and not res.get("missing_components")
+
+def _candidate_reward(res: Dict[str, Any]) -> float:
+    return 1.0 if res.get("test_pass") else (0.5 if res.get("compile_pass") else 0.0)
+
+def _job_deadline(job: Dict[str, Any], now: Optional[float] = None) -> float:
+    """Absolute (epoch) deadline from input.constraints.latency_ms, counted from submission."""
+    constraints = ((job.get("input") or {}).get("constraints") or {})
+    try:
+        latency_ms = float(constraints.get("latency_ms") or 60000)
+    except (TypeError, ValueError):
+        latency_ms = 60000.0
+    return (now if now is not None else time.time()) + latency_ms / 1000.0
+
+def _plan_for_deadline(remaining: float, est: float, is_duel: bool, strategy: str) -> Dict[str, Any]:
+    """Degradations that let a job fit its remaining budget, cheapest quality loss first."""
+    degraded: List[str] = []
+    plan: Dict[str, Any] = {"remaining_sec": round(remaining, 1), "est_sec": round(est, 1), "degraded": degraded}
+    if is_duel and remaining < _DUEL_BUDGET_FACTOR * est:
+        degraded.append("single")
+    if strategy in ("tot_beam", "tiered_refine") and remaining < _SEARCH_BUDGET_FACTOR * est:
+        degraded.append("skip_search")
+    if remaining < est:
+        degraded.append("fast_model")
+        degraded.append("short_output")
+        plan["num_predict_scale"] = max(0.25, remaining / est) if est > 0 else 1.0
+    return plan
+
+def _deadline_num_predict(job: Dict[str, Any], num_predict: int) -> int:
+    """Cap num_predict by constraints.max_tokens and shrink it when the deadline plan says so."""
+    constraints = ((job.get("input") or {}).get("constraints") or {})
+    try:
+        max_tokens = int(constraints.get("max_tokens") or 0)
+    except (TypeError, ValueError):
+        max_tokens = 0
+    if max_tokens > 0:
+        num_predict = min(num_predict, max_tokens)
+    scale = float(((job.get("_deadline_plan") or {}).get("num_predict_scale")) or 1.0)
+    if scale < 1.0:
+        num_predict = min(num_predict, max(_MIN_NUM_PREDICT, int(num_predict * scale)))
+    return num_predict
+
+def _language_hint_for_mode(mode: str, language: str) -> Optional[str]:
+    if mode == "chat":
+        return None
+    if mode in ("docs", "planner"):
+        return mode
+    return language
+
+def _route_candidates(mode: str, language: Optional[str]) -> List[Dict[str, Any]]:
+    """Registry route builder: the ordered candidate list the router uses for (mode, language)."""
+    return _order_models_for_mode(mode, available_models(_language_hint_for_mode(mode, language)), language)
+
+set_route_builder(_route_candidates)
+
 def _clarify_message(job: Dict[str, Any]) -> str:
     goal = str((job.get("input") or {}).get("goal", "")).strip()
     snippet = goal if goal else "your request"
@@ -1003,6 +1261,104 @@ def _component_coverage(files_map: Dict[str, str], components: List[str]) -> Tup
     missing = [c for c, ok in coverage.items() if not ok]
     return coverage, missing
 
+def _chat_context_sections(job: dict) -> Tuple[str, str]:
+    """Memory and uploaded-repo snippets for a chat turn, as prompt sections (possibly empty)."""
+    meta = job.get("metadata") or {}
+    inp = job.get("input") or {}
+    memory_snippets = []
+    for idx, entry in enumerate(meta.get("memory_context") or [], start=1):
+        summary = str(entry.get("summary") or "").strip()
+        goal = str(entry.get("goal") or "").strip()
+        model = str(entry.get("model") or "").strip()
+        if not summary and not goal:
+            continue
+        snippet_lines = []
+        header = f"{idx}. Prior task"
+        if goal:
+            header += f" (goal: {goal})"
+        if model:
+            header += f" [model: {model}]"
+        snippet_lines.append(header)
+        files_payload = entry.get("files") or {}
+        file_map = {}
+        if isinstance(files_payload, dict):
+            maybe_files = files_payload.get("files")
+            if isinstance(maybe_files, dict):
+                file_map = {str(k): str(v) for k, v in maybe_files.items()}
+        artifact_preview = str(files_payload.get("artifact_preview") or "")
+        artifact_rel = str(files_payload.get("artifact") or "")
+
+        if summary:
+            trimmed = summary[:800]
+            snippet_lines.append(trimmed)
+        if artifact_rel and artifact_preview:
+            snippet_lines.append(f"Artifact ({artifact_rel}):\n{artifact_preview[:800]}")
+        if file_map:
+            snippet_lines.append("Files excerpt:")
+            for rel, content in list(file_map.items())[:5]:
+                snippet_lines.append(f"- {rel}:\n{content[:800]}")
+        memory_snippets.append("\n".join(snippet_lines))
+    memory_section = ""
+    if memory_snippets:
+        memory_section = (
+            "User-provided code/context (from uploads and prior runs):\n"
+            f"{chr(10).join(memory_snippets)}\n\n"
+            "Always treat these snippets as the authoritative reference for this request.\n\n"
+        )
+    repo_section_prompt = ""
+    repo_spec = inp.get("repo") or {}
+    repo_path_raw = str(repo_spec.get("path") or "").strip()
+    repo_snippets: List[Tuple[str, str]] = []
+    if repo_path_raw:
+        normalized_repo = _normalize_repo_rel(repo_path_raw)
+        if normalized_repo and normalized_repo != ".":
+            repo_snippets = _collect_repo_prompt_snippets({**repo_spec, "path": normalized_repo})
+    if repo_snippets:
+        lines: List[str] = ["Uploaded repository snippets:"]
+        for rel, snippet in repo_snippets:
+            lines.append(f"- {rel}:\n{snippet}")
+        repo_section_prompt = "\n".join(lines) + "\n\n"
+    return memory_section, repo_section_prompt
+
+
+def _chat_turn_instruction(goal: str) -> str:
+    if _is_codey_prompt(goal):
+        return "When the user requests code, files, scaffolds, or archives, emit the actual file contents. For every file, add a line 'File: relative/path.ext' followed by a fenced code block."
+    return "Unless the user requests code, respond conversationally without creating file listings."
+
+
+def _chat_session_id(job: dict) -> Optional[str]:
+    if not CHAT_SESSIONS:
+        return None
+    return str((job.get("metadata") or {}).get("session_id") or "").strip() or None
+
+
+def _build_chat_messages(job: dict, session_id: str, model: str, budget_tokens: int) -> Tuple[List[Dict[str, str]], str]:
+    """/api/chat messages for a session turn: fixed system prompt, stored history, then the new turn.
+
+    Only the last message is new, so Ollama re-evaluates just that. Context snippets already
+    sent earlier in the session are not repeated; the history is trimmed from the front to fit.
+    Returns the messages and the user turn as sent (committed to the session once delivered).
+    """
+    meta = job.get("metadata") or {}
+    goal = str((job.get("input") or {}).get("goal", "Provide assistance.")).strip()
+    transcript = list(meta.get("conversation") or [])
+    if transcript and isinstance(transcript[-1], dict) and transcript[-1].get("role", "user") == "user" \
+            and str(transcript[-1].get("content") or "").strip() == goal:
+        transcript = transcript[:-1]  # legacy clients include the turn being asked
+    history = chat_sessions.history(session_id, seed=transcript)
+    sent = "\n".join(m["content"] for m in history if m["role"] == "user")
+    sections = "".join(sec for sec in _chat_context_sections(job) if sec and sec.strip() not in sent)
+    user_turn = f"{sections}{goal}\n\n({_chat_turn_instruction(goal)})"
+    system = {"role": "system", "content": CHAT_SYSTEM_PROMPT}
+    turn = {"role": "user", "content": user_turn}
+    chat_sessions.fit(
+        session_id, budget_tokens,
+        lambda msgs: estimate_tokens(model, "\n".join(m["content"] for m in [system, *msgs, turn])),
+    )
+    return [system, *chat_sessions.history(session_id), turn], user_turn
+
+
 def _build_prompt(job: dict) -> str:
     mode = job.get("_mode", "code")
     inp = job.get("input") or {}
@@ -1022,68 +1378,8 @@ def _build_prompt(job: dict) -> str:
             history_items.append(f"{label}: {content}")
         history_block = "\n".join(history_items)
         history_section = f"Conversation so far:\n{history_block}\n\n" if history_block else ""
-        memory_snippets = []
-        for idx, entry in enumerate(meta.get("memory_context") or [], start=1):
-            summary = str(entry.get("summary") or "").strip()
-            goal = str(entry.get("goal") or "").strip()
-            model = str(entry.get("model") or "").strip()
-            if not summary and not goal:
-                continue
-            snippet_lines = []
-            header = f"{idx}. Prior task"
-            if goal:
-                header += f" (goal: {goal})"
-            if model:
-                header += f" [model: {model}]"
-            snippet_lines.append(header)
-            files_payload = entry.get("files") or {}
-            file_map = {}
-            if isinstance(files_payload, dict):
-                maybe_files = files_payload.get("files")
-                if isinstance(maybe_files, dict):
-                    file_map = {str(k): str(v) for k, v in maybe_files.items()}
-            artifact_preview = str(files_payload.get("artifact_preview") or "")
-            artifact_rel = str(files_payload.get("artifact") or "")
-
-            if summary:
-                trimmed = summary[:800]
-                snippet_lines.append(trimmed)
-            if artifact_rel and artifact_preview:
-                snippet_lines.append(f"Artifact ({artifact_rel}):\n{artifact_preview[:800]}")
-            if file_map:
-                snippet_lines.append("Files excerpt:")
-                for rel, content in list(file_map.items())[:5]:
-                    snippet_lines.append(f"- {rel}:\n{content[:800]}")
-            memory_snippets.append("\n".join(snippet_lines))
-        memory_section = ""
-        if memory_snippets:
-            memory_section = (
-                "User-provided code/context (from uploads and prior runs):\n"
-                f"{chr(10).join(memory_snippets)}\n\n"
-                "Always treat these snippets as the authoritative reference for this request.\n\n"
-            )
-        repo_section_prompt = ""
-        repo_spec = inp.get("repo") or {}
-        repo_path_raw = str(repo_spec.get("path") or "").strip()
-        repo_snippets: List[Tuple[str, str]] = []
-        if repo_path_raw:
-            normalized_repo = _normalize_repo_rel(repo_path_raw)
-            if normalized_repo and normalized_repo != ".":
-                repo_snippets = _collect_repo_prompt_snippets({**repo_spec, "path": normalized_repo})
-        if repo_snippets:
-            lines: List[str] = ["Uploaded repository snippets:"]
-            for rel, snippet in repo_snippets:
-                lines.append(f"- {rel}:\n{snippet}")
-            repo_section_prompt = "\n".join(lines) + "\n\n"
-        codey = _is_codey_prompt(goal)
-        instructions: List[str] = []
-        instructions.append("You are a friendly engineering assistant. Answer in natural language unless the user clearly asks for code.")
-        if codey:
-            instructions.append(
-                "When the user requests code, files, scaffolds, or archives, emit the actual file contents. For every file, add a line 'File: relative/path.ext' followed by a fenced code block."
-            )
-        else:
-            instructions.append("Unless the user requests code, respond conversationally without creating file listings.")
+        memory_section, repo_section_prompt = _chat_context_sections(job)
+        instructions = [CHAT_SYSTEM_PROMPT, _chat_turn_instruction(goal)]
         return textwrap.dedent(f"""
         {' '.join(instructions)}
         {memory_section}{repo_section_prompt}{history_section}Latest user message: {goal}
@@ -1203,15 +1499,76 @@ def _tail(s: str, nbytes: int = 2000) -> str:
     return enc[-nbytes:].decode("utf-8", errors="ignore")
 
 class JobQueue:
-    def __init__(self, hub: StreamHub):
-        self.queue: asyncio.Queue[dict] = asyncio.Queue()
+    def __init__(self, hub: StreamHub, workers: Optional[int] = None):
+        # QUEUE_BACKEND=postgres: jobs live in the shared task_queue table and survive restarts
+        self.queue: asyncio.Queue[dict] = PgTaskQueue() if QUEUE_BACKEND == "postgres" else build_scheduler()
+        self.durable = bool(getattr(self.queue, "durable", False))
         self.hub = hub
-        self._task = None
-        # Track inflight tasks for cancel
+        self.workers = max(1, int(workers if workers is not None else QUEUE_WORKERS))
+        self._workers: List[asyncio.Task] = []
+        self._busy_workers = 0
+        # Track inflight tasks for cancel; keyed by task id so concurrent workers never share entries
         self._inflight: Dict[str, List[asyncio.Task]] = {}
         self._start_times: Dict[str, float] = {}
+        # Tasks waiting in the queue, and those canceled before a worker picked them up
+        self._queued: set[str] = set()
+        self._canceled: set[str] = set()
+        # Queue position / wait estimates published on each task's stream
+        self._lane_durations: Dict[str, float] = {}
+        self._last_position: Dict[str, int] = {}
+        self._positions_at = float("-inf")
+        self._positions_timer: Optional[asyncio.Task] = None
+        # Race-duel losers finishing in the background: (task_id, model) -> silent, no shared outputs
+        self._shadow: set[Tuple[str, str]] = set()
+        self._background: set[asyncio.Task] = set()
+        # Maven/Gradle builds and ToT lint/smoke runs are CPU/RAM heavy; cap them per process
+        self._build_slots = asyncio.Semaphore(max(1, BUILD_CONCURRENCY))
+        # coalescing: key -> leader task id, leader task id -> follower payloads
+        self._coalesce_leaders: Dict[str, str] = {}
+        self._followers: Dict[str, List[dict]] = {}
+
+    def _refresh_gauges(self) -> None:
+        try:
+            job_queue_depth.set(self.queue.qsize())
+            job_workers_busy.set(self._busy_workers)
+            job_workers_total.set(len(self._workers))
+        except Exception:
+            pass
+
+    def _track(self, task_id: str, *tasks: asyncio.Task) -> None:
+        """Register child tasks for cancellation; cancel them right away if the job was canceled meanwhile."""
+        bucket = self._inflight.get(task_id)
+        for t in tasks:
+            if bucket is None:
+                t.cancel()
+            else:
+                bucket.append(t)
+
+    def _job_canceled(self, task_id: str, *tasks: asyncio.Task) -> bool:
+        """True once ``cancel`` dropped the job from ``_inflight`` or one of its candidates was cancelled.
+
+        Strategies that turn a cancelled candidate into a failed result check this first, so a user
+        cancel is not scored and answered like a timeout.
+        """
+        return task_id not in self._inflight or any(t.cancelled() for t in tasks)
+
+    def _delta_frames(self, task_id: str, model_str: str, tier: Optional[str] = None) -> _DeltaFrames:
+        # checked per flush: this candidate may lose the race while it is still generating
+        return _DeltaFrames(self._publish, task_id, model_str, tier=tier, muted=lambda: self._is_shadow(task_id))
+
+    def _is_shadow(self, task_id: str) -> bool:
+        """True inside a race-duel loser that keeps running after the task was answered."""
+        return bool(self._shadow) and (task_id, get_candidate()) in self._shadow
+
+    async def _publish(self, task_id: str, message: str) -> None:
+        """Publish to the task's stream and to every submission coalesced onto it."""
+        await self.hub.publish(task_id, message)
+        for follower in self._followers.get(task_id, ()):
+            await self.hub.publish(str(follower.get("id")), message)
 
     async def _publish_status(self, task_id: str, message: str, stage: Optional[str] = None, include_elapsed: bool = True) -> None:
+        if self._is_shadow(task_id):
+            return
         payload = {"status": "running", "message": message}
         if include_elapsed:
             started = self._start_times.get(task_id)
@@ -1219,23 +1576,303 @@ class JobQueue:
                 payload["elapsed_seconds"] = round(max(0.0, time.time() - started), 1)
         if stage:
             payload["stage"] = stage
-        await self.hub.publish(task_id, json.dumps(payload))
+        await self._publish(task_id, json.dumps(payload))
 
     async def start(self):
-        if self._task is None:
-            self._task = asyncio.create_task(self._runner())
+        if not self._workers:
+            for worker_id in range(self.workers):
+                self._workers.append(asyncio.create_task(self._runner(worker_id)))
+            log.info("queue.workers.started", {"workers": self.workers})
+            self._refresh_gauges()
+
+    async def stop(self):
+        """Cancel the workers and wait for them: durable leases of running jobs are handed back."""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        if self._positions_timer is not None and not self._positions_timer.done():
+            self._positions_timer.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        close = getattr(self.queue, "close", None)
+        if close is not None:
+            await close()
+        log.info("queue.workers.stopped", {"workers": len(workers)})
+        self._refresh_gauges()
+
+    async def _predict_model(self, job: dict) -> Optional[str]:
+        """Best guess of the model a job will be routed to (registry order + greedy bandit rank)."""
+        try:
+            mode = _infer_mode(job)
+            if mode == "clarify":
+                return None
+            language = str(((job.get("input") or {}).get("language")) or "general").lower()
+            ordered = routed_models(mode, language)
+            if not ordered:
+                return None
+            try:
+                eng = await get_engine()
+                async with eng.connect() as conn:
+                    ordered = await rank_models(conn, ordered, feature_hash(extract_features(job)), epsilon=0.0)
+            except Exception:
+                pass
+            return _format_model_name(ordered[0]) if ordered else None
+        except Exception as exc:
+            log.debug("scheduler.predict_failed", {"task_id": str(job.get("id")), "error": str(exc)})
+            return None
+
+    async def _refresh_residency(self) -> None:
+        if not getattr(self.queue, "uses_affinity", False) or not self.queue.needs_refresh():
+            return
+        try:
+            self.queue.set_resident(await loaded_models())
+        except Exception as exc:
+            self.queue.set_resident(self.queue.resident)  # keep the last view, retry after the refresh interval
+            log.debug("scheduler.residency_failed", {"error": str(exc)})
+
+    def _avg_duration(self, lane: Optional[str] = None, model: Optional[str] = None) -> float:
+        """Expected run time of one job: lane EWMA, else recent llm_generation_latency, else the default."""
+        if lane and lane in self._lane_durations:
+            return self._lane_durations[lane]
+        if self._lane_durations:
+            return sum(self._lane_durations.values()) / len(self._lane_durations)
+        recent = generation_latency.mean(model) if model else None
+        if recent is None:
+            recent = generation_latency.mean()
+        return recent if recent is not None else QUEUE_ETA_DEFAULT_SEC
+
+    def expected_job_seconds(self) -> float:
+        return self._avg_duration()
+
+    def _job_estimate(self, job: dict) -> float:
+        return self._avg_duration(job.get("_lane"), job.get("_affinity_model"))
+
+    def projected_wait_seconds(self) -> float:
+        """Seconds until a job submitted now would reach a worker."""
+        try:
+            jobs = [j for j in self._pending_jobs() if str(j.get("id")) not in self._canceled]
+        except Exception:
+            jobs = []
+        ahead = sum(self._job_estimate(j) for j in jobs)
+        if not jobs and self.queue.qsize():
+            # Durable queue: contents live in Postgres, so assume average jobs.
+            ahead = self.queue.qsize() * self._avg_duration()
+        return (ahead + 0.5 * self._busy_workers * self._avg_duration()) / self.workers
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.queue.qsize(),
+            "workers": self.workers,
+            "busy_workers": self._busy_workers,
+            "scheduler": type(self.queue).__name__,
+            "projected_wait_seconds": round(self.projected_wait_seconds(), 1),
+            "lane_avg_seconds": {k: round(v, 1) for k, v in self._lane_durations.items()},
+            "model_generation_avg_seconds": generation_latency.snapshot(),
+            "model_slots": model_slots.snapshot(),
+        }
 
-    async def submit(self, task: dict):
+    def _note_duration(self, lane: Optional[str], seconds: float) -> None:
+        lane = lane or "code"
+        prev = self._lane_durations.get(lane)
+        self._lane_durations[lane] = seconds if prev is None else (_ETA_ALPHA * seconds + (1 - _ETA_ALPHA) * prev)
+
+    def _pending_jobs(self, limit: Optional[int] = None) -> List[dict]:
+        pending = getattr(self.queue, "pending", None)
+        if pending is not None:
+            return pending(limit)
+        raw = getattr(self.queue, "_queue", None)
+        return list(itertools.islice(raw, limit)) if raw is not None else []
+
+    async def _publish_queue_positions(self) -> None:
+        """Refresh queue positions now, or once the interval since the last pass has run out.
+
+        Submits and dequeues arrive in bursts; each burst costs one pass instead of one per job.
+        """
+        wait = self._positions_at + QUEUE_POSITION_INTERVAL_SEC - time.monotonic()
+        if wait <= 0:
+            await self._publish_queue_positions_now()
+        elif self._positions_timer is None or self._positions_timer.done():
+            self._positions_timer = asyncio.create_task(self._publish_queue_positions_later(wait))
+
+    async def _publish_queue_positions_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self._publish_queue_positions_now()
+
+    async def _publish_queue_positions_now(self) -> None:
+        """Tell the first ``QUEUE_POSITION_LIMIT`` waiting tasks where they stand, if it changed."""
+        self._positions_at = time.monotonic()
+        try:
+            jobs = self._pending_jobs(QUEUE_POSITION_LIMIT + len(self._canceled))
+        except Exception:
+            return
+        ahead_sec = 0.5 * self._busy_workers * self._avg_duration()
+        position = 0
+        for job in jobs:
+            task_id = str(job.get("id"))
+            if task_id in self._canceled:
+                continue
+            position += 1
+            if position > QUEUE_POSITION_LIMIT:
+                break
+            if self._last_position.get(task_id) != position:
+                self._last_position[task_id] = position
+                await self._publish(task_id, json.dumps({
+                    "status": "queued",
+                    "stage": "queued",
+                    "queue_position": position,
+                    "estimated_wait_seconds": round(ahead_sec / self.workers, 1),
+                    "lane": job.get("_lane"),
+                }))
+            ahead_sec += self._job_estimate(job)
+
+    async def submit(self, task: dict) -> Optional[str]:
+        """Queue ``task``; returns the in-flight task id it was coalesced onto instead, if any."""
+        task_id = str(task.get("id"))
+        if COALESCE_TASKS and not self.durable:
+            # durable queues hand jobs to other replicas, whose streams this process never sees
+            if "_coalesce_key" not in task:
+                task["_coalesce_key"] = await asyncio.to_thread(_coalesce_key, task)
+            leader = self._coalesce_leaders.get(task["_coalesce_key"])
+            if leader is not None and leader != task_id:
+                self._followers.setdefault(leader, []).append(task)
+                task_coalesced_total.inc()
+                log.info("task.coalesced", {"task_id": task_id, "leader": leader})
+                await self.hub.publish(task_id, json.dumps({
+                    "status": "running" if leader in self._inflight else "queued",
+                    "coalesced_with": leader,
+                }))
+                return leader
+            self._coalesce_leaders[task["_coalesce_key"]] = task_id
+        task.setdefault("_deadline", _job_deadline(task))
+        task.setdefault("_lane", _priority_lane(task))
+        task.setdefault("_client", "anon")
+        if getattr(self.queue, "uses_affinity", False):
+            task["_affinity_model"] = await self._predict_model(task)
+        self._queued.add(task_id)
         await self.queue.put(task)
+        self._refresh_gauges()
+        depth = self.queue.qsize()
+        if depth > QUEUE_POSITION_LIMIT:
+            # beyond the tracked head: one rough figure now, exact ones once it moves up
+            await self._publish(task_id, json.dumps({
+                "status": "queued", "stage": "queued", "queue_position": depth, "approximate": True, "lane": task.get("_lane"),
+            }))
+        await self._publish_queue_positions()
+        return None
+
+    def _release_coalesced(self, task_id: str, key: Optional[str]) -> List[dict]:
+        """Stop coalescing onto ``task_id`` and hand back the submissions that were attached to it."""
+        if key and self._coalesce_leaders.get(key) == task_id:
+            self._coalesce_leaders.pop(key, None)
+        return self._followers.pop(task_id, [])
+
+    async def _settle_followers(self, job: dict, eng) -> None:
+        """Give coalesced submissions the leader's outcome, or re-queue them if it never produced one."""
+        leader = str(job.get("id"))
+        followers = self._release_coalesced(leader, job.get("_coalesce_key"))
+        if not followers:
+            return
+        async with eng.connect() as conn:
+            row = await get_task(conn, leader)
+        status = row.status if row is not None else None
+        if status not in ("done", "error"):
+            for follower in followers:
+                await self.submit(follower)
+            return
+        for follower in followers:
+            follower_id = str(follower.get("id"))
+            await asyncio.to_thread(self._mirror_artifacts, leader, follower_id)
+            async with eng.begin() as conn:
+                await update_task_status(conn, follower_id, status, model_used=row.model_used, latency_ms=row.latency_ms)
+            self.hub.close(follower_id)  # it got the leader's terminal event; let its log expire too
+        log.info("task.coalesced.settled", {"task_id": leader, "status": status, "followers": len(followers)})
+
+    @staticmethod
+    def _mirror_artifacts(leader: str, follower: str) -> None:
+        try:
+            src = _resolve_root(leader)
+            if src.exists():
+                shutil.copytree(src, _resolve_root(follower), dirs_exist_ok=True)
+            zip_src = ZIP_ROOT / f"{leader}.zip"
+            if zip_src.exists():
+                shutil.copyfile(zip_src, ZIP_ROOT / f"{follower}.zip")
+        except Exception as exc:
+            log.warning("task.coalesced.mirror_failed", {"task_id": follower, "leader": leader, "error": str(exc)})
 
     async def cancel(self, task_id: str):
+        for leader, followers in self._followers.items():
+            if any(str(f.get("id")) == task_id for f in followers):
+                # only this submission goes away; the shared task keeps running for the others
+                self._followers[leader] = [f for f in followers if str(f.get("id")) != task_id]
+                await self.hub.publish(task_id, json.dumps({"status": "canceled"}))
+                log.info("task.canceled", {"id": task_id, "coalesced_with": leader})
+                return
+        orphans = self._release_coalesced(task_id, None)
+        for key, leader in list(self._coalesce_leaders.items()):
+            if leader == task_id:
+                self._coalesce_leaders.pop(key, None)
+        if task_id in self._queued:
+            self._canceled.add(task_id)
+        if self.durable:
+            try:
+                await self.queue.cancel(task_id)
+            except Exception as exc:
+                log.warning("task.cancel_queue_failed", {"id": task_id, "error": str(exc)})
         tasks = self._inflight.pop(task_id, [])
         for t in tasks:
             if not t.done():
                 t.cancel()
-        await self.hub.publish(task_id, json.dumps({"status":"canceled"}))
+        await self._publish(task_id, json.dumps({"status":"canceled"}))
         log.info("task.canceled", {"id": task_id, "canceled_children": len(tasks)})
         self._start_times.pop(task_id, None)
+        for follower in orphans:
+            await self.submit(follower)
+
+    def _candidate_timeout(self, job: dict, cap: float = CANDIDATE_TIMEOUT_SEC) -> float:
+        """Per-candidate timeout: the env cap, shortened to the remaining deadline budget when deadline-aware."""
+        deadline = job.get("_deadline")
+        if not DEADLINE_AWARE or not deadline:
+            return float(cap)
+        return max(DEADLINE_MIN_TIMEOUT_SEC, min(float(cap), float(deadline) - time.time()))
+
+    async def _apply_deadline_plan(self, job: dict, task_id: str, is_duel: bool, strategy: str) -> Dict[str, Any]:
+        deadline = job.get("_deadline")
+        if not DEADLINE_AWARE or not deadline:
+            return {}
+        plan = _plan_for_deadline(float(deadline) - time.time(), self._job_estimate(job), is_duel, strategy)
+        job["_deadline_plan"] = plan
+        if plan["degraded"]:
+            for action in plan["degraded"]:
+                task_deadline_degraded_total.labels(action=action).inc()
+            log.info("deadline.degraded", {"task_id": task_id, **plan})
+            await self._publish_status(task_id, "Tight deadline: using a faster strategy…", stage="deadline")
+        return plan
+
+    def _pull_reporter(self, task_id: str, model_str: str):
+        """Pull progress callback for generate_stream: surfaces model downloads on the task's stream."""
+        async def report(progress: Dict[str, Any]) -> None:
+            total, done = progress.get("total"), progress.get("completed")
+            pct = f" {int(done * 100 / total)}%" if total and done is not None else ""
+            step = str(progress.get("status") or "").strip()
+            await self._publish_status(
+                task_id,
+                f"Downloading {model_str}{pct}" + (f" ({step})…" if step else "…"),
+                stage="pulling-model",
+            )
+        return report
+
+    def _record_model_load(self, model_str: str, meta: Optional[Dict[str, Any]]) -> None:
+        """Count model swaps from Ollama's load_duration and tell the scheduler the model is resident."""
+        try:
+            load_sec = float((meta or {}).get("load_duration") or 0) / 1e9
+        except (TypeError, ValueError):
+            load_sec = 0.0
+        if load_sec >= OLLAMA_SWAP_THRESHOLD_SEC:
+            ollama_model_swaps_total.labels(model=model_str).inc()
+            ollama_model_swap_seconds_total.labels(model=model_str).inc(load_sec)
+            log.info("model.swap", {"model": model_str, "load_ms": int(load_sec * 1000)})
+        note_loaded = getattr(self.queue, "note_loaded", None)
+        if note_loaded is not None:
+            note_loaded(model_str)
 
     async def _write_primary(self, rel_path: str, candidate_dir: Path, generated: str) -> Path:
         rel_path = rel_path.lstrip("/").replace("..","_")
@@ -1265,7 +1902,7 @@ class JobQueue:
         except Exception:
             pass
 
-    async def _run_candidate_inner(self, job: dict, candidate: Dict[str, Any], task_id: str) -> Dict[str, Any]:
+    async def _run_candidate_inner(self, job: dict, candidate: Dict[str, Any], task_id: str, progress: Optional[CandidateProgress] = None) -> Dict[str, Any]:
         """Inner function that we can time-limit with wait_for."""
         model_str = _format_model_name(candidate)
         set_candidate(model_str)
@@ -1308,14 +1945,20 @@ class JobQueue:
             rel_primary = "main.txt"
 
         # prompt + stream
-        prompt = _build_prompt(job)
-        ctx = int(candidate.get("ctx_size", 8192) or 8192)
-        if mode in {"chat", "docs", "planner"}:
-            ctx = min(ctx, 4096)
-            num_predict = 1024
+        num_predict = _deadline_num_predict(job, 1024 if mode in {"chat", "docs", "planner"} else 2048)
+        ctx_cap = int(candidate.get("ctx_size", 8192) or 8192)
+        chat_sid = _chat_session_id(job) if mode == "chat" else None
+        chat_messages: Optional[List[Dict[str, str]]] = None
+        if chat_sid:
+            budget = int((ctx_cap - num_predict) / (1.0 + TOKEN_ESTIMATE_MARGIN))
+            chat_messages, chat_turn = _build_chat_messages(job, chat_sid, model_str, budget)
+            prompt = json.dumps(chat_messages, ensure_ascii=False)  # for sizing and the cache key
         else:
-            ctx = min(ctx, 6144)
-            num_predict = 2048
+            prompt = _build_prompt(job)
+        ctx_plan = plan_context(model_str, prompt, num_predict, ctx_cap)
+        ctx, num_predict = ctx_plan.num_ctx, ctx_plan.num_predict
+        if ctx_plan.truncated:
+            log.warning("candidate.prompt.truncated", {"task_id": task_id, "model": model_str, "prompt_tokens_est": ctx_plan.prompt_tokens, "num_ctx": ctx})
         buf_parts: List[str] = []
         first_token_at: Optional[float] = None
         chunk_count = 0
@@ -1324,78 +1967,135 @@ class JobQueue:
         last_meta: Optional[Dict[str, Any]] = None
         codey_request = mode == "chat" and _is_codey_prompt(goal_text)
 
-        try:
-            async for chunk, final_meta in generate_stream(
-                model_str,
-                prompt,
-                num_ctx=ctx,
-                num_predict=num_predict,
-                temperature=0.2,
-            ):
-                if final_meta:
-                    last_meta = final_meta
-                if final_meta and prompt_tokens is None:
-                    prompt_tokens = int(final_meta.get("prompt_eval_count" or "prompt_tokens") or 0)
-                    completion_tokens = int(final_meta.get("eval_count" or "completion_tokens") or 0)
-                if "response" in chunk and not chunk.get("done"):
-                    text_piece = chunk.get("response") or ""
-                    if text_piece:
-                        if first_token_at is None:
-                            first_token_at = time.time()
-                            try:
-                                llm_first_token_latency.labels(model=model_str).observe(first_token_at - t0)
-                            except Exception:
-                                pass
-                        chunk_count += 1
-                    buf_parts.append(text_piece)
-            generated = "".join(buf_parts).strip()
-            total_duration = time.time() - t0
+        frames: Optional[_DeltaFrames] = None
+        if SSE_TOKEN_DELTAS and not tot_suffix and not self._is_shadow(task_id):
+            # ToT branches are speculative and race losers are invisible: neither streams
+            frames = self._delta_frames(task_id, model_str, tier_suffix)
+
+        temperature = 0.2
+        cache_key = cache_key_for(model_str, prompt, ctx, num_predict, temperature) if cache_enabled_for(job) else None
+        cached = await gen_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            # replay: no model slot, no latency samples (they would skew admission and hedging)
+            generated = str(cached.get("text") or "").strip()
+            last_meta = cached.get("meta") or {}
+            prompt_tokens = int(last_meta.get("prompt_eval_count") or last_meta.get("prompt_tokens") or 0)
+            completion_tokens = int(last_meta.get("eval_count") or last_meta.get("completion_tokens") or 0)
+            if progress is not None:
+                progress.first_token.set()
+                progress.generated.set()
+            log.info("candidate.cache.hit", {"task_id": task_id, "model": model_str, "chars": len(generated)})
+            await self._publish_status(task_id, f"Reusing a cached {model_str} generation…", stage="generating")
+            if frames is not None and generated:
+                await frames.add(generated)
+        else:
             try:
-                llm_generation_latency.labels(model=model_str).observe(total_duration)
-            except Exception:
-                pass
-            if prompt_tokens is None and last_meta:
-                prompt_tokens = int(
-                    last_meta.get("prompt_eval_count")
-                    or last_meta.get("prompt_tokens")
-                    or 0
-                )
-            if completion_tokens is None and last_meta:
-                completion_tokens = int(
-                    last_meta.get("eval_count")
-                    or last_meta.get("completion_tokens")
-                    or 0
-                )
-            if first_token_at is not None:
-                log.info(
-                    "candidate.stream.complete",
-                    {
-                        "task_id": task_id,
-                        "model": model_str,
-                        "first_token_ms": int((first_token_at - t0) * 1000),
-                        "total_ms": int(total_duration * 1000),
-                        "chunks": chunk_count,
-                    },
+                residency.note_use(model_str)
+                if model_slots.saturated(model_str):
+                    await self._publish_status(task_id, f"Waiting for a free {model_str} slot…", stage="queued-model")
+                async with model_slots.acquire(model_str):
+                    gen_t0 = time.time()
+                    if chat_messages is not None:
+                        stream = chat_stream(
+                            model_str,
+                            chat_messages,
+                            num_ctx=ctx,
+                            num_predict=num_predict,
+                            temperature=temperature,
+                            on_pull=self._pull_reporter(task_id, model_str),
+                        )
+                    else:
+                        stream = generate_stream(
+                            model_str,
+                            prompt,
+                            num_ctx=ctx,
+                            num_predict=num_predict,
+                            temperature=temperature,
+                            on_pull=self._pull_reporter(task_id, model_str),
+                        )
+                    async for chunk, final_meta in stream:
+                        if final_meta:
+                            last_meta = final_meta
+                        if final_meta and prompt_tokens is None:
+                            prompt_tokens = int(final_meta.get("prompt_eval_count" or "prompt_tokens") or 0)
+                            completion_tokens = int(final_meta.get("eval_count" or "completion_tokens") or 0)
+                        if "response" in chunk and not chunk.get("done"):
+                            text_piece = chunk.get("response") or ""
+                            if text_piece:
+                                if first_token_at is None:
+                                    first_token_at = time.time()
+                                    if progress is not None:
+                                        progress.first_token.set()
+                                    try:
+                                        llm_first_token_latency.labels(model=model_str).observe(first_token_at - gen_t0)
+                                    except Exception:
+                                        pass
+                                chunk_count += 1
+                                if frames is not None:
+                                    await frames.add(text_piece)
+                            buf_parts.append(text_piece)
+                    if frames is not None:
+                        await frames.flush()
+                generated = "".join(buf_parts).strip()
+                total_duration = time.time() - gen_t0
+                if progress is not None:
+                    progress.first_token.set()
+                    progress.generated.set()
+                self._record_model_load(model_str, last_meta)
+                try:
+                    llm_generation_latency.labels(model=model_str).observe(total_duration)
+                except Exception:
+                    pass
+                if prompt_tokens is None and last_meta:
+                    prompt_tokens = int(
+                        last_meta.get("prompt_eval_count")
+                        or last_meta.get("prompt_tokens")
+                        or 0
+                    )
+                if completion_tokens is None and last_meta:
+                    completion_tokens = int(
+                        last_meta.get("eval_count")
+                        or last_meta.get("completion_tokens")
+                        or 0
+                    )
+                if prompt_tokens:
+                    llm_prompt_tokens.labels(model=model_str).observe(prompt_tokens)
+                    llm_ctx_utilization.labels(model=model_str).observe(min(1.0, (prompt_tokens + (completion_tokens or 0)) / ctx))
+                if first_token_at is not None:
+                    log.info(
+                        "candidate.stream.complete",
+                        {
+                            "task_id": task_id,
+                            "model": model_str,
+                            "first_token_ms": int((first_token_at - gen_t0) * 1000),
+                            "total_ms": int(total_duration * 1000),
+                            "chunks": chunk_count,
+                            "num_ctx": ctx,
+                            "prompt_tokens": prompt_tokens,
+                            "prompt_tokens_est": ctx_plan.prompt_tokens,
+                        },
+                    )
+                else:
+                    log.warning(
+                        "candidate.stream.empty",
+                        {"task_id": task_id, "model": model_str, "total_ms": int(total_duration * 1000)},
+                    )
+                if cache_key and generated:
+                    await gen_cache.put(cache_key, generated, last_meta)
+            except OllamaError as e:
+                log.error(
+                    "candidate.ollama_error",
+                    {"task_id": task_id, "model": model_str, "error": str(e)},
                 )
-            else:
-                log.warning(
-                    "candidate.stream.empty",
-                    {"task_id": task_id, "model": model_str, "total_ms": int(total_duration * 1000)},
+                raise
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception(
+                    "candidate.runtime_error",
+                    {"task_id": task_id, "model": model_str, "error": str(e)},
                 )
-        except OllamaError as e:
-            log.error(
-                "candidate.ollama_error",
-                {"task_id": task_id, "model": model_str, "error": str(e)},
-            )
-            raise
-        except asyncio.CancelledError:
-            raise
-        except Exception as e:
-            log.exception(
-                "candidate.runtime_error",
-                {"task_id": task_id, "model": model_str, "error": str(e)},
-            )
-            raise
+                raise
 
         # sanitize + write
         raw_output = generated
@@ -1528,6 +2228,8 @@ class JobQueue:
                 "prompt_tokens": prompt_tokens,
                 "completion_tokens": completion_tokens,
                 "ctx_limit": ctx,
+                # committed to the chat session only if this candidate's reply is the one delivered
+                "_chat_turn": {"session_id": chat_sid, "user": chat_turn, "assistant": generated} if chat_sid and generated else None,
             }
 
         if mode == "code" and rel_primary.endswith(".java"):
@@ -1638,7 +2340,10 @@ class JobQueue:
         if normalized_files_map:
             files_map = normalized_files_map
 
-        merge_rel, merge_root = ensure_merge_tree(str(task_id), base_rel)
+        # a race loser still running stays away from the winner's merge tree and zip; ToT branches
+        # run concurrently and the winner is promoted by _promote_tot_result
+        merge_key, zip_name = _candidate_output_names(task_id, tot_suffix, model_str if self._is_shadow(task_id) else None)
+        merge_rel, merge_root = ensure_merge_tree(merge_key, base_rel)
 
         for rel, data in files_map.items():
             target = merge_root / rel
@@ -1671,7 +2376,8 @@ class JobQueue:
         if mode == "code":
             await self._publish_status(task_id, "Running quick checks…", stage="validating")
             if primary_path.suffix.lower() == ".java":
-                c, t, o, e, tool = await build_and_test_java(dir_path)
+                async with self._build_slots:
+                    c, t, o, e, tool = await build_and_test_java(dir_path)
                 compile_pass, test_pass, out_tail, err_tail, tool_used = c, t, o, e, tool
             else:
                 compile_pass = bool(to_write.strip())
@@ -1710,8 +2416,8 @@ class JobQueue:
                 except UnicodeDecodeError:
                     text_payload = path.read_text(encoding="latin-1", errors="ignore")
                 zip_files[rel_name] = text_payload
-            if zip_files:
-                zip_file = write_zip(str(task_id), zip_files)
+            if zip_files and not self._is_shadow(task_id):
+                zip_file = write_zip(zip_name, zip_files)
                 zip_path = str(zip_file)
                 zip_url = f"/zips/{zip_file.name}"
         except Exception as exc:
@@ -1771,21 +2477,22 @@ class JobQueue:
         # --- end autolog ---
         return __RET__
 
-    async def _run_candidate(self, job: dict, candidate: Dict[str, Any], task_id: str) -> Dict[str, Any]:
+    async def _run_candidate(self, job: dict, candidate: Dict[str, Any], task_id: str, progress: Optional[CandidateProgress] = None) -> Dict[str, Any]:
+        timeout_sec = self._candidate_timeout(job)
         try:
-            return await asyncio.wait_for(self._run_candidate_inner(job, candidate, task_id), timeout=CANDIDATE_TIMEOUT_SEC)
+            return await asyncio.wait_for(self._run_candidate_inner(job, candidate, task_id, progress=progress), timeout=timeout_sec)
         except asyncio.TimeoutError:
-            log.warning("candidate.timeout", {"task_id": task_id, "model": _format_model_name(candidate), "timeout_sec": CANDIDATE_TIMEOUT_SEC})
+            log.warning("candidate.timeout", {"task_id": task_id, "model": _format_model_name(candidate), "timeout_sec": timeout_sec})
             __RET__ = {
                 "model": _format_model_name(candidate),
                 "success": False,
-                "latency_ms": CANDIDATE_TIMEOUT_SEC*1000,
+                "latency_ms": int(timeout_sec*1000),
                 "speed_rank": int(candidate.get("speed_rank", 999)),
                 "human_score": 0,
                 "compile_pass": False,
                 "test_pass": False,
                 "tool": "timeout",
-                "logs": {"build_stdout_tail": "", "build_stderr_tail": f"candidate timed out after {CANDIDATE_TIMEOUT_SEC}s"},
+                "logs": {"build_stdout_tail": "", "build_stderr_tail": f"candidate timed out after {timeout_sec:.0f}s"},
                 "artifact": "",
                 "content": "",
                 "zip_path": None,
@@ -1857,15 +2564,17 @@ class JobQueue:
 
     async def _call_model_text(self, model: Dict[str, Any], prompt: str, *, temperature: float = 0.2) -> str:
         model_str = _format_model_name(model)
-        ctx = int(model.get("ctx_size", 4096) or 4096)
+        ctx = plan_context(model_str, prompt, 1024, int(model.get("ctx_size", 4096) or 4096)).num_ctx
         buf: List[str] = []
+        residency.note_use(model_str)
         try:
-            async for chunk in generate_stream(model_str, prompt, num_ctx=ctx, temperature=temperature):
-                if chunk.get("done"):
-                    break
-                piece = chunk.get("response") or ""
-                if piece:
-                    buf.append(piece)
+            async with model_slots.acquire(model_str):
+                async for chunk, _final in generate_stream(model_str, prompt, num_ctx=ctx, temperature=temperature):
+                    if chunk.get("done"):
+                        break
+                    piece = chunk.get("response") or ""
+                    if piece:
+                        buf.append(piece)
         except OllamaError as exc:
             log.warning("tot.model.error", {"model": model_str, "error": str(exc)})
             return ""
@@ -1972,6 +2681,114 @@ class JobQueue:
         score -= latency * TOT_LATENCY_PENALTY
         return score
 
+    def _tot_variant(self, job: Dict[str, Any], base_goal: str, plan_text: str, suffix: str) -> Dict[str, Any]:
+        variant = copy.deepcopy(job)
+        variant_input = dict(variant.get("input") or {})
+        augmented_goal = base_goal
+        if plan_text:
+            augmented_goal = (
+                f"{base_goal}\n\nFollow this implementation plan precisely:\n{plan_text}\n\n"
+                "Only output the files that changed and avoid restating this plan."
+            )
+        variant_input["goal"] = augmented_goal
+        variant["input"] = variant_input
+        variant_meta = dict(variant.get("metadata") or {})
+        variant_meta["_tot_suffix"] = suffix
+        variant["metadata"] = variant_meta
+        return variant
+
+    async def _evaluate_tot_branches(
+        self,
+        task_id: str,
+        candidate: Dict[str, Any],
+        branches: List[_ToTBranch],
+        incumbent: float,
+        budget_sec: float,
+    ) -> List[Tuple[_ToTBranch, Dict[str, Any], float]]:
+        """Run all branches of one depth concurrently (model/build slots do the throttling).
+
+        A running branch is pruned once even a perfect result could not beat the incumbent given
+        the latency it has already accrued; branches still running when the depth budget is spent
+        are cancelled. Returns ``(branch, result, score)`` in completion order.
+        """
+        async def evaluate(branch: _ToTBranch) -> Tuple[Dict[str, Any], float]:
+            branch.started = time.time()
+            res = await self._run_candidate(branch.variant, candidate, task_id)
+            branch.latency_ms = float(res.get("latency_ms") or 0.0)
+            async with self._build_slots:
+                lint_pass, smoke_pass = await self._run_tot_quality_checks(res)
+            res["lint_pass"] = lint_pass
+            res["smoke_pass"] = smoke_pass
+            score = self._tot_score(res, lint_pass, smoke_pass)
+            res["tot_score"] = score
+            return res, score
+
+        running: Dict[asyncio.Task, _ToTBranch] = {}
+        for branch in branches:
+            t = asyncio.create_task(evaluate(branch))
+            running[t] = branch
+        self._track(task_id, *running)
+        results: List[Tuple[_ToTBranch, Dict[str, Any], float]] = []
+        deadline = time.monotonic() + budget_sec if budget_sec > 0 else None
+        max_score = _tot_max_score()
+        try:
+            while running:
+                tick = _TOT_PRUNE_TICK_SEC
+                if deadline is not None:
+                    tick = min(tick, max(0.0, deadline - time.monotonic()))
+                done, _ = await asyncio.wait(set(running), timeout=tick, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    branch = running.pop(t)
+                    if t.cancelled():
+                        continue
+                    exc = t.exception()
+                    if exc is not None:
+                        tot_branches_total.labels(outcome="failed").inc()
+                        log.warning("tot.candidate.execution_failed", {"task_id": task_id, "error": str(exc)})
+                        continue
+                    res, score = t.result()
+                    tot_branches_total.labels(outcome="evaluated").inc()
+                    results.append((branch, res, score))
+                    incumbent = max(incumbent, score)
+                if deadline is not None and time.monotonic() >= deadline and running:
+                    log.info("tot.depth.budget_exhausted", {"task_id": task_id, "cancelled": len(running), "budget_sec": budget_sec})
+                    for t in running:
+                        t.cancel()
+                    tot_branches_total.labels(outcome="timeout").inc(len(running))
+                    break
+                now = time.time()
+                for t, branch in list(running.items()):
+                    spent_ms = branch.latency_ms if branch.latency_ms is not None else (now - (branch.started or now)) * 1000.0
+                    if max_score - spent_ms * TOT_LATENCY_PENALTY <= incumbent:
+                        t.cancel()
+                        running.pop(t)
+                        tot_branches_total.labels(outcome="pruned").inc()
+                        log.info("tot.branch.pruned", {"task_id": task_id, "plan": branch.plan_idx, "spent_ms": int(spent_ms), "incumbent": round(incumbent, 3)})
+        finally:
+            for t in running:
+                if not t.done():
+                    t.cancel()
+        return results
+
+    def _promote_tot_result(self, task_id: str, res: Dict[str, Any]) -> None:
+        """ToT variants write private merge trees/zips; make the winner's the task's own."""
+        try:
+            zip_path = res.get("zip_path")
+            if zip_path and Path(zip_path).exists():
+                target = Path(zip_path).with_name(f"{task_id}.zip")
+                if Path(zip_path) != target:
+                    shutil.copyfile(zip_path, target)
+                res["zip_path"] = str(target)
+                res["zip_url"] = f"/zips/{target.name}"
+            merge_root = res.get("merge_root")
+            if merge_root and Path(merge_root).exists():
+                _, task_merge = ensure_merge_tree(str(task_id), "")
+                if Path(merge_root) != task_merge:
+                    shutil.copytree(merge_root, task_merge, dirs_exist_ok=True)
+                res["merge_root"] = str(task_merge)
+        except Exception as exc:
+            log.warning("tot.promote_failed", {"task_id": task_id, "error": str(exc)})
+
     async def _run_tot_beam(self, job: Dict[str, Any], candidate: Dict[str, Any], task_id: str) -> Optional[Dict[str, Any]]:
         meta = job.get("metadata") or {}
         try:
@@ -1982,6 +2799,10 @@ class JobQueue:
             max_depth = int(meta.get("tot_max_depth", TOT_MAX_DEPTH_DEFAULT))
         except Exception:
             max_depth = TOT_MAX_DEPTH_DEFAULT
+        try:
+            depth_budget = float(meta.get("tot_depth_budget_sec", TOT_DEPTH_BUDGET_SEC))
+        except Exception:
+            depth_budget = TOT_DEPTH_BUDGET_SEC
         beam_width = max(1, min(beam_width, 5))
         max_depth = max(1, min(max_depth, 5))
 
@@ -1992,65 +2813,53 @@ class JobQueue:
 
         for depth in range(max_depth):
             await self._publish_status(task_id, f"Exploring edit plans (depth {depth + 1}/{max_depth})…", stage="tot-planning")
-            next_frontier: List[_ToTNode] = []
-            for node in frontier:
-                plans = await self._generate_tot_plans(job, candidate, node.history, beam_width)
-                if not plans:
+            plan_lists = await asyncio.gather(
+                *(self._generate_tot_plans(job, candidate, node.history, beam_width) for node in frontier),
+                return_exceptions=True,
+            )
+            branches: List[_ToTBranch] = []
+            for node, plans in zip(frontier, plan_lists):
+                if isinstance(plans, BaseException):
+                    log.warning("tot.plan.generation_failed", {"task_id": task_id, "error": str(plans)})
                     continue
-                await self._publish_status(task_id, f"Evaluating {len(plans)} plan option(s) at depth {depth + 1}…", stage="tot-execute")
-                for plan_idx, plan in enumerate(plans):
+                for plan_idx, plan in enumerate(plans or []):
                     attempt_counter += 1
                     plan_text = self._format_plan_for_goal(plan)
-                    variant = copy.deepcopy(job)
-                    variant_input = variant.get("input") or {}
-                    variant_input = dict(variant_input)
-                    augmented_goal = base_goal
-                    if plan_text:
-                        augmented_goal = (
-                            f"{base_goal}\n\nFollow this implementation plan precisely:\n{plan_text}\n\n"
-                            "Only output the files that changed and avoid restating this plan."
-                        )
-                    variant_input["goal"] = augmented_goal
-                    variant["input"] = variant_input
-                    variant_meta = dict(variant.get("metadata") or {})
-                    variant_meta["_tot_suffix"] = f"tot_{depth}_{plan_idx}_{attempt_counter}"
-                    variant["metadata"] = variant_meta
-                    try:
-                        res = await self._run_candidate(variant, candidate, task_id)
-                    except Exception as exc:
-                        log.exception("tot.candidate.execution_failed", {"task_id": task_id, "error": str(exc)})
-                        continue
-                    lint_pass, smoke_pass = await self._run_tot_quality_checks(res)
-                    res["lint_pass"] = lint_pass
-                    res["smoke_pass"] = smoke_pass
-                    score = self._tot_score(res, lint_pass, smoke_pass)
-                    res["tot_score"] = score
-                    entry = {
-                        "title": plan.get("title") or f"Plan {plan_idx + 1}",
-                        "plan": plan_text[:1000],
-                        "score": score,
-                        "compile_pass": bool(res.get("compile_pass")),
-                        "test_pass": bool(res.get("test_pass")),
-                        "lint_pass": lint_pass,
-                        "smoke_pass": smoke_pass,
-                        "latency_ms": res.get("latency_ms"),
-                    }
-                    child_history = list(node.history) + [entry]
-                    child_node = _ToTNode(history=child_history, score=score, result=res)
-                    next_frontier.append(child_node)
-                    if best_node is None or score > best_node.score:
-                        best_node = _ToTNode(history=child_history, score=score, result=res)
-                        log.info(
-                            "tot.best.update",
-                            {
-                                "task_id": task_id,
-                                "score": round(score, 3),
-                                "compile_pass": res.get("compile_pass"),
-                                "test_pass": res.get("test_pass"),
-                                "lint_pass": lint_pass,
-                                "smoke_pass": smoke_pass,
-                            },
-                        )
+                    variant = self._tot_variant(job, base_goal, plan_text, f"tot_{depth}_{plan_idx}_{attempt_counter}")
+                    branches.append(_ToTBranch(node=node, plan=plan, plan_idx=plan_idx, plan_text=plan_text, variant=variant))
+            if not branches:
+                break
+            await self._publish_status(task_id, f"Evaluating {len(branches)} plan option(s) at depth {depth + 1}…", stage="tot-execute")
+            incumbent = best_node.score if best_node is not None else float("-inf")
+            evaluated = await self._evaluate_tot_branches(task_id, candidate, branches, incumbent, depth_budget)
+
+            next_frontier: List[_ToTNode] = []
+            for branch, res, score in evaluated:
+                entry = {
+                    "title": branch.plan.get("title") or f"Plan {branch.plan_idx + 1}",
+                    "plan": branch.plan_text[:1000],
+                    "score": score,
+                    "compile_pass": bool(res.get("compile_pass")),
+                    "test_pass": bool(res.get("test_pass")),
+                    "lint_pass": res.get("lint_pass"),
+                    "smoke_pass": res.get("smoke_pass"),
+                    "latency_ms": res.get("latency_ms"),
+                }
+                child_history = list(branch.node.history) + [entry]
+                next_frontier.append(_ToTNode(history=child_history, score=score, result=res))
+                if best_node is None or score > best_node.score:
+                    best_node = _ToTNode(history=child_history, score=score, result=res)
+                    log.info(
+                        "tot.best.update",
+                        {
+                            "task_id": task_id,
+                            "score": round(score, 3),
+                            "compile_pass": res.get("compile_pass"),
+                            "test_pass": res.get("test_pass"),
+                            "lint_pass": res.get("lint_pass"),
+                            "smoke_pass": res.get("smoke_pass"),
+                        },
+                    )
             if not next_frontier:
                 break
             next_frontier.sort(key=lambda n: n.score, reverse=True)
@@ -2059,6 +2868,7 @@ class JobQueue:
         if best_node is None or best_node.result is None:
             log.warning("tot.no_winner", {"task_id": task_id})
             return None
+        self._promote_tot_result(task_id, best_node.result)
         return best_node.result
 
     def _resolve_tiered_models(self, job: Dict[str, Any], ordered: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
@@ -2182,7 +2992,7 @@ class JobQueue:
             variant_meta["tier_label"] = label
             variant["metadata"] = variant_meta
             tier_task = asyncio.create_task(self._run_candidate(variant, candidate, task_id))
-            self._inflight[task_id].append(tier_task)
+            self._track(task_id, tier_task)
             res = await tier_task
             res["tier_index"] = idx
             res["tier_label"] = label
@@ -2208,7 +3018,7 @@ class JobQueue:
                 "score": score,
             }
             history_entries.append(history_entry)
-            await self.hub.publish(
+            await self._publish(
                 task_id,
                 json.dumps(
                     {
@@ -2236,168 +3046,536 @@ class JobQueue:
             best_res.setdefault("tier_best_score", best_score)
         return best_res
 
+    def _duel_outcome(self, t: asyncio.Task, name: str, timeout_sec: float) -> Dict[str, Any]:
+        """Result of a finished duel candidate task; cancellations and crashes become failed results."""
+        if t.cancelled():
+            return {"model": name, "success": False, "latency_ms": int(timeout_sec*1000),
+                    "compile_pass": False, "test_pass": False, "tool": "timeout", "logs": {"build_stdout_tail":"","build_stderr_tail":"duel timed out"}, "artifact": ""}
+        exc = t.exception()
+        if exc is not None:
+            return {"model": name, "success": False, "latency_ms": int(timeout_sec*1000),
+                    "compile_pass": False, "test_pass": False, "tool": "error", "logs": {"build_stdout_tail":"","build_stderr_tail":str(exc)[-2000:]}, "artifact": ""}
+        return t.result()
+
+    async def _gather_duel(self, task_id: str, ta: asyncio.Task, tb: asyncio.Task, names: Dict[asyncio.Task, str], timeout_sec: float) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        try:
+            return tuple(await asyncio.wait_for(asyncio.gather(ta, tb), timeout=timeout_sec))
+        except asyncio.TimeoutError:
+            log.warning("duel.timeout", {"task_id": task_id, "timeout_sec": timeout_sec})
+            # cancel any still-running tasks
+            for t in (ta, tb):
+                if not t.done(): t.cancel()
+            # gather partials
+            done = []
+            for t in (ta, tb):
+                try:
+                    done.append(await t)
+                except asyncio.CancelledError:
+                    done.append(self._duel_outcome(t, names[t], timeout_sec))
+            return done[0], done[1]
+
+    async def _race_duel(
+        self, task_id: str, ta: asyncio.Task, tb: asyncio.Task, names: Dict[asyncio.Task, str], timeout_sec: float,
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[asyncio.Task], Dict[asyncio.Task, Dict[str, Any]]]:
+        """Wait until one candidate qualifies (see ``_race_qualifies``).
+
+        Returns ``(winner, loser_task, finished)``. If nobody qualified, ``winner`` is None and
+        ``finished`` holds both results (timed-out candidates are cancelled first).
+        """
+        pending = {ta, tb}
+        finished: Dict[asyncio.Task, Dict[str, Any]] = {}
+        deadline = time.monotonic() + timeout_sec
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            if self._job_canceled(task_id, *done):
+                for t in pending:
+                    t.cancel()
+                raise asyncio.CancelledError()
+            for t in (ta, tb):
+                if t in done:
+                    finished[t] = self._duel_outcome(t, names[t], timeout_sec)
+                    if _race_qualifies(finished[t]):
+                        loser_task = tb if t is ta else ta
+                        log.info("duel.race.won", {"task_id": task_id, "winner": names[t], "loser_pending": not loser_task.done()})
+                        return finished[t], loser_task, finished
+        if pending:
+            log.warning("duel.timeout", {"task_id": task_id, "timeout_sec": timeout_sec, "strategy": "race"})
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for t in pending:
+                finished[t] = self._duel_outcome(t, names[t], timeout_sec)
+        return None, None, finished
+
+    @staticmethod
+    def _absent_candidate(name: str, tool: str, latency_ms: int) -> Dict[str, Any]:
+        """Placeholder metrics for a duel candidate whose result is not (yet) known."""
+        return {"model": name, "success": False, "latency_ms": latency_ms, "compile_pass": False, "test_pass": False, "tool": tool}
+
+    async def _finish_race(
+        self, eng, task_id: str, job: dict, fh: str, cfg: Dict[str, Any],
+        winner: Dict[str, Any], loser_task: asyncio.Task, loser_name: str, timeout_sec: float, mode: str = "race",
+    ) -> None:
+        """Deliver the race winner now; cancel the loser or let it finish in the background for bandit rewards."""
+        policy = _race_loser_policy(job, cfg)
+        loser_stub = self._absent_candidate(loser_name, "race-" + ("running" if policy == "finish" else "canceled"), winner["latency_ms"])
+        if loser_task.done():
+            loser_res = self._duel_outcome(loser_task, loser_name, timeout_sec)
+            await self._record_duel_rewards(eng, task_id, fh, cfg, winner, loser_res)
+        elif policy == "finish":
+            self._shadow.add((task_id, loser_name))
+            bg = asyncio.create_task(self._await_race_loser(eng, task_id, fh, cfg, winner, loser_task, loser_name, timeout_sec))
+            self._background.add(bg)
+            bg.add_done_callback(self._background.discard)
+        else:
+            loser_task.cancel()
+            await self._record_solo_outcome(eng, task_id, fh, winner, loser_name, "race-canceled")
+        await self._finish_duel(eng, job["id"], task_id, job, cfg, winner, loser_stub, latency_ms=winner["latency_ms"], mode=mode)
+
+    async def _await_race_loser(
+        self, eng, task_id: str, fh: str, cfg: Dict[str, Any],
+        winner: Dict[str, Any], loser_task: asyncio.Task, loser_name: str, timeout_sec: float,
+    ) -> None:
+        try:
+            await asyncio.wait({loser_task}, timeout=timeout_sec)
+            if not loser_task.done():
+                loser_task.cancel()
+                await asyncio.gather(loser_task, return_exceptions=True)
+            loser_res = self._duel_outcome(loser_task, loser_name, timeout_sec)
+            await self._record_duel_rewards(eng, task_id, fh, cfg, winner, loser_res)
+        except Exception as exc:
+            log.warning("duel.race.loser_failed", {"task_id": task_id, "loser": loser_name, "error": str(exc)})
+        finally:
+            self._shadow.discard((task_id, loser_name))
+
+    async def _hedge_duel(
+        self, task_id: str, job: dict, a_meta: Dict[str, Any], b_meta: Dict[str, Any], a_name: str, b_name: str,
+    ) -> Tuple[asyncio.Task, Optional[asyncio.Task]]:
+        """Run the top-ranked candidate alone and start the second only if the first looks like losing.
+
+        The second candidate is launched when the first has no token within its learned p90 first-token
+        latency, is still generating past its p90 generation latency, or finishes without qualifying
+        (``_race_qualifies``). Returns ``(ta, tb)``; ``tb`` is None when the first candidate sufficed.
+        """
+        progress = CandidateProgress()
+        ta = asyncio.create_task(self._run_candidate(job, a_meta, task_id, progress=progress))
+        self._track(task_id, ta)
+        first_limit, gen_limit = _hedge_thresholds(a_name)
+        reason = await self._hedge_trigger(task_id, ta, a_name, progress, first_limit, gen_limit)
+        duel_hedge_total.labels(outcome=reason or "not_needed").inc()
+        if reason is None:
+            return ta, None
+        log.info("duel.hedge.launch", {"task_id": task_id, "primary": a_name, "hedge": b_name, "reason": reason,
+                                       "first_token_limit_ms": int(first_limit * 1000),
+                                       "generation_limit_ms": int(gen_limit * 1000) if gen_limit is not None else None})
+        await self._publish_status(task_id, f"Bringing in {b_name} for a second opinion…", stage="generating")
+        tb = asyncio.create_task(self._run_candidate(job, b_meta, task_id))
+        self._track(task_id, tb)
+        if self._job_canceled(task_id, ta):
+            # canceled while the hedge was being announced: it must not run for nobody
+            tb.cancel()
+            raise asyncio.CancelledError()
+        return ta, tb
+
+    async def _hedge_trigger(
+        self, task_id: str, ta: asyncio.Task, name: str, progress: CandidateProgress, first_limit: float, gen_limit: Optional[float],
+    ) -> Optional[str]:
+        t0 = time.monotonic()
+
+        async def reached(event: asyncio.Event, limit: float) -> bool:
+            waiter = asyncio.create_task(event.wait())
+            try:
+                done, _ = await asyncio.wait({ta, waiter}, timeout=max(0.0, limit), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            if self._job_canceled(task_id, ta):
+                raise asyncio.CancelledError()  # a cancelled primary is not a reason to hedge
+            return bool(done)
+
+        if not await reached(progress.first_token, first_limit):
+            return "slow_first_token"
+        if gen_limit is not None and not await reached(progress.generated, gen_limit - (time.monotonic() - t0)):
+            return "slow_generation"
+        await asyncio.wait({ta})  # build/tests; bounded by the candidate timeout
+        if self._job_canceled(task_id, ta):
+            raise asyncio.CancelledError()
+        return None if _race_qualifies(self._duel_outcome(ta, name, CANDIDATE_TIMEOUT_SEC)) else "failed"
+
+    async def _publish_duel_candidate(self, task_id: str, res: Dict[str, Any]) -> None:
+        await self._publish(task_id, json.dumps({
+            "phase":"duel","candidate":res["model"],"status":"done",
+            "metrics":{"success":res["success"],"latency_ms":res["latency_ms"],"compile_pass":res["compile_pass"],"test_pass":res["test_pass"]},
+            "tool":res["tool"], "artifact":res["artifact"], "logs":res["logs"],
+            "content": res.get("content"),
+            "zip_url": res.get("zip_url"),
+            "zip_notes": res.get("zip_notes"),
+            "pending_final": bool(res.get("pending_final")),
+        }))
+
+    async def _record_duel_rewards(
+        self, eng, task_id: str, fh: str, cfg: Dict[str, Any], winner: Dict[str, Any], loser: Dict[str, Any],
+    ) -> None:
+        """Metrics, bandit events, rewards rows and bandit stats for a decided duel (both results known)."""
+        duel_selection_decisions_total.labels(winner=winner["model"], loser=loser["model"]).inc()
+        duel_rule_decisions_total.labels(rule_version=str(cfg.get("rule_version","v1"))).inc()
+        scored = [(winner, True, loser["model"]), (loser, False, winner["model"])]
+        for res, won, opponent in scored:
+            # bandit: persist duel outcome
+            try:
+                bandit_record(res.get('model') or 'unknown', _candidate_reward(res), won, task_type='duel')
+            except Exception:
+                pass
+            # bandit: log duel reward
+            try:
+                bandit_record_event(res.get("model") or "unknown", _candidate_reward(res), {"src":"queue","task_id": task_id,"mode":"duel","role":"winner" if won else "loser","opponent": opponent})
+            except Exception:
+                pass
+        await self._store_rewards(eng, task_id, fh, [winner, loser])
+
+    async def _record_solo_outcome(self, eng, task_id: str, fh: str, res: Dict[str, Any], opponent: str, reason: str) -> None:
+        """Score the only finished candidate of a duel that was never decided (hedge skipped, loser canceled).
+
+        The other side's outcome is unknown, so there is no duel decision and no win for the bandit:
+        only the candidate's own reward is kept.
+        """
+        try:
+            bandit_record_event(res.get("model") or "unknown", _candidate_reward(res), {"src":"queue","task_id": task_id,"mode":"duel","role":"solo","opponent": opponent,"reason": reason})
+        except Exception:
+            pass
+        await self._store_rewards(eng, task_id, fh, [res])
+
+    async def _store_rewards(self, eng, task_id: str, fh: str, results: List[Dict[str, Any]]) -> None:
+        async with eng.begin() as conn:
+            for res in results:
+                await conn.execute(text("""INSERT INTO rewards (id, task_id, model, success, latency_ms, human_score)
+                                           VALUES (gen_random_uuid(), :tid, :m, :s, :l, NULL)"""),
+                                   dict(tid=task_id, m=res["model"], s=bool(res["success"]), l=int(res["latency_ms"])))
+            for res in results:
+                await upsert_stat(conn, res["model"], fh, _candidate_reward(res))
+
+    async def _finish_duel(
+        self, eng, id, task_id: str, job: dict, cfg: Dict[str, Any],
+        winner: Dict[str, Any], loser: Dict[str, Any], latency_ms: int, mode: str = "duel",
+    ) -> None:
+        """Mark the task done and publish the winner (artifact, SSE, workspace memory)."""
+        async with eng.begin() as conn:
+            await update_task_status(conn, id, "done", model_used=winner["model"], latency_ms=latency_ms)
+
+        winner_has_final = bool(str(winner.get("content") or "").strip()) or bool(winner.get("zip_url")) or bool(winner.get("artifact"))
+        summary = {
+            "winner": winner["model"], "loser": loser["model"],
+            "rule_version": str(cfg.get("rule_version","v1")),
+            "winner_metrics":{"success":winner["success"], "latency_ms":winner["latency_ms"],
+                              "compile_pass":winner["compile_pass"], "test_pass":winner["test_pass"], "tool":winner["tool"]},
+            "loser_metrics":{"success":loser["success"], "latency_ms":loser["latency_ms"],
+                             "compile_pass":loser["compile_pass"], "test_pass":loser["test_pass"], "tool":loser["tool"]},
+            "content": winner.get("content"),
+            "zip_url": winner.get("zip_url"),
+            "zip_notes": winner.get("zip_notes"),
+            "follow_up_steps": winner.get("follow_up_steps"),
+        }
+        if mode != "duel":
+            summary["duel_strategy"] = mode
+
+        # artifact for duel completion
+        self._write_artifact_safely(task_id, {"status":"done","mode":"duel", **summary})
+
+        await self._publish(task_id, json.dumps({"status":"done", **summary, "pending_final": not winner_has_final}))
+        try:
+            winner_payload = dict(winner)
+            winner_payload.setdefault("status", "done")
+            winner_payload.setdefault("mode", "duel")
+            winner_payload.setdefault("pending_final", not winner_has_final)
+            await self._record_completion(task_id, job, winner_payload)
+        except Exception:
+            pass
+
+    async def _record_completion(self, task_id: str, job: dict, res: Dict[str, Any]) -> None:
+        """Workspace memory for a delivered result, and the chat turn it answered."""
+        turn = res.get("_chat_turn")
+        if turn:
+            chat_sessions.commit(turn["session_id"], turn["user"], turn["assistant"])
+        await record_completion(task_id, job, res)
+
     def _score(self, r: Dict[str, Any], cfg: Dict[str, Any]) -> float:
         base = (cfg["success_weight"] * (1.0 if r["success"] else 0.0))
         test_bonus = float(cfg.get("test_pass_weight", 0.5)) * (1.0 if r.get("test_pass") else 0.0)
         return base + test_bonus - (cfg["latency_penalty_ms"] * float(r["latency_ms"])) + (cfg["human_score_weight"] * float(r.get("human_score", 0) or 0))
 
-    async def _runner(self):
+    async def _runner(self, worker_id: int = 0):
         eng = await get_engine()
         while True:
+            await self._refresh_residency()
             job = await self.queue.get()
-            id = job['id']
-            task_id = str(id)
-            set_task_id(task_id)
-            input_block = job.get('input') or {}
-            language = str(input_block.get('language') or 'general').lower()
-            mode = _infer_mode(job)
-            job["_mode"] = mode
-            meta_for_log = job.get("metadata") or {}
-            mem_entries = meta_for_log.get("memory_context") or []
-            log.info(
-                "job.start",
-                {
-                    "task_id": task_id,
-                    "mode": mode,
-                    "memory_count": len(mem_entries),
-                    "has_repo": bool((input_block.get("repo") or {}).get("path")),
-                },
-            )
-            self._inflight[task_id] = []
-            self._start_times[task_id] = time.time()
-            await self.hub.publish(task_id, json.dumps({"status":"running", "mode": mode}))
-            await self._publish_status(task_id, "Thinking through your request…", stage="thinking")
+            self._busy_workers += 1
+            self._refresh_gauges()
+            self._last_position.pop(str(job.get("id")), None)
+            await self._publish_queue_positions()
+            error: Optional[str] = None
+            job_t0 = time.time()
+            skipped = str(job.get("id")) in self._canceled
+            try:
+                await self._process_job(job, eng)
+                if not skipped:
+                    self._note_duration(job.get("_lane"), time.time() - job_t0)
+                    self._record_deadline(job)
+            except asyncio.CancelledError:
+                error = "worker_cancelled"
+                raise
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+                log.exception("worker.unexpected_error", {"worker": worker_id, "error": str(exc)})
+                # SSE subscribers only learn a task ended from what is pushed to them
+                await self._publish(str(job.get("id")), json.dumps({"status": "error", "error": error}))
+            finally:
+                self._busy_workers -= 1
+                if self.durable:
+                    await self._settle_lease(job, error)
+                if job.get("_coalesce_key"):
+                    try:
+                        await self._settle_followers(job, eng)
+                    except Exception as exc:
+                        log.warning("task.coalesced.settle_failed", {"task_id": str(job.get("id")), "error": str(exc)})
+                self.hub.close(str(job.get("id")))  # events stay replayable for SSE_FINISHED_TTL_SEC
+                self.queue.task_done()
+                self._refresh_gauges()
+
+    def _record_deadline(self, job: dict) -> None:
+        deadline = job.get("_deadline")
+        if not deadline:
+            return
+        outcome = "hit" if time.time() <= float(deadline) else "miss"
+        task_deadline_total.labels(outcome=outcome).inc()
+        if outcome == "miss":
+            log.info("deadline.missed", {"task_id": str(job.get("id")), "late_sec": round(time.time() - float(deadline), 1)})
+
+    async def _settle_lease(self, job: dict, error: Optional[str]) -> None:
+        """Finish a durable lease: ack handled jobs, retry crashed ones, hand back on shutdown."""
+        try:
+            if error is None:
+                await self.queue.ack(job)
+            elif error == "worker_cancelled":
+                await self.queue.release(job)
+            else:
+                await self.queue.nack(job, error)
+        except Exception as exc:
+            # The lease simply expires and another worker re-claims the job.
+            log.warning("queue.settle_failed", {"task_id": str(job.get("id")), "error": str(exc)})
+
+    async def _process_job(self, job: dict, eng) -> None:
+        id = job['id']
+        task_id = str(id)
+        set_task_id(task_id)
+        self._queued.discard(task_id)
+        if task_id in self._canceled:
+            self._canceled.discard(task_id)
+            log.info("job.skipped_canceled", {"task_id": task_id})
+            return
+        input_block = job.get('input') or {}
+        language = str(input_block.get('language') or 'general').lower()
+        mode = _infer_mode(job)
+        job["_mode"] = mode
+        meta_for_log = job.get("metadata") or {}
+        mem_entries = meta_for_log.get("memory_context") or []
+        log.info(
+            "job.start",
+            {
+                "task_id": task_id,
+                "mode": mode,
+                "memory_count": len(mem_entries),
+                "has_repo": bool((input_block.get("repo") or {}).get("path")),
+            },
+        )
+        self._inflight[task_id] = []
+        self._start_times[task_id] = time.time()
+        await self._publish(task_id, json.dumps({"status":"running", "mode": mode}))
+        await self._publish_status(task_id, "Thinking through your request…", stage="thinking")
+
+        if mode == "clarify":
+            question = _clarify_message(job)
+            self._write_artifact_safely(task_id, {
+                "status": "done",
+                "mode": "clarify",
+                "model": "router-clarify",
+                "content": question
+            })
+            try:
+                async with eng.begin() as conn:
+                    await update_task_status(conn, id, "done", model_used="router-clarify", latency_ms=0)
+            except Exception:
+                pass
+            await self._publish(task_id, json.dumps({
+                "status": "done",
+                "mode": "clarify",
+                "message": question,
+                "content": question,
+                "model": "router-clarify"
+            }))
+            self._inflight.pop(task_id, None)
+            self._start_times.pop(task_id, None)
+            return
+
+        feats = extract_features(job)
+        fh = feature_hash(feats)
+
+        duel_cfg = (job.get("routing_hints") or {})
+        is_duel = bool(duel_cfg.get("duel") or duel_cfg.get("duel_candidates"))
+        if mode in {"chat", "docs", "planner"}:
+            is_duel = False
+
+        force_duel = bool((job.get("metadata") or {}).get("force_duel")) or FORCE_DUEL
+        if mode == "chat":
+            force_duel = False
+        if force_duel:
+            is_duel = True
+
+        strategy = str((meta_for_log.get("strategy") or (job.get("routing_hints") or {}).get("strategy") or "")).strip().lower()
+        deadline_plan = await self._apply_deadline_plan(job, task_id, is_duel, strategy)
+        degraded = deadline_plan.get("degraded") or []
+        if "single" in degraded:
+            is_duel = False
+        if "skip_search" in degraded:
+            strategy = ""
 
-            if mode == "clarify":
-                question = _clarify_message(job)
-                self._write_artifact_safely(task_id, {
-                    "status": "done",
-                    "mode": "clarify",
-                    "model": "router-clarify",
-                    "content": question
-                })
+        try:
+            if not is_duel:
+                base = routed_models(mode, language)
+                async with eng.connect() as conn:
+                    ordered = await rank_models(conn, base, fh)
+                if not ordered:
+                    raise RuntimeError("no available models")
+                if "fast_model" in degraded:
+                    ordered = sorted(ordered, key=lambda m: int(m.get("speed_rank", 999)))
+                res: Optional[Dict[str, Any]] = None
+                result_mode = "single"
+                if strategy == "tiered_refine" and mode == "code":
+                    res = await self._run_tiered_refine(job, ordered, task_id)
+                    if res is not None:
+                        result_mode = "tiered"
+                    else:
+                        log.info("tiered_refine.fallback", {"task_id": task_id})
+                if res is None:
+                    m = ordered[0]
+                    if not m:
+                        raise RuntimeError("no available models")
+                    if strategy == "tot_beam" and mode == "code":
+                        result_mode = "tot"
+                        await self._publish_status(task_id, f"Searching tree of edits with {_format_model_name(m)}…", stage="tot-search")
+                        tot_task = asyncio.create_task(self._run_tot_beam(job, m, task_id))
+                        self._track(task_id, tot_task)
+                        res = await tot_task
+                        if res is None:
+                            result_mode = "single"
+                            await self._publish_status(task_id, f"Tree search fallback: generating answer with {_format_model_name(m)}…", stage="generating")
+                            fallback_task = asyncio.create_task(self._run_candidate(job, m, task_id))
+                            self._track(task_id, fallback_task)
+                            res = await fallback_task
+                    else:
+                        await self._publish_status(task_id, f"Generating answer with {_format_model_name(m)}…", stage="generating")
+                        t = asyncio.create_task(self._run_candidate(job, m, task_id))
+                        self._track(task_id, t)
+                        res = await t
+                if res is None:
+                    raise RuntimeError("strategy execution returned no result")
+                reward = 1.0 if res.get("test_pass") else (0.5 if res.get("compile_pass") else 0.0)
+
+                # bandit: log real single-run reward
                 try:
-                    async with eng.begin() as conn:
-                        await update_task_status(conn, id, "done", model_used="router-clarify", latency_ms=0)
+                    bandit_record_event(res.get("model") or "unknown", float(reward), {"src":"queue","task_id": task_id,"mode": result_mode})
                 except Exception:
                     pass
-                await self.hub.publish(task_id, json.dumps({
-                    "status": "done",
-                    "mode": "clarify",
-                    "message": question,
-                    "content": question,
-                    "model": "router-clarify"
-                }))
-                self.queue.task_done()
-                self._inflight.pop(task_id, None)
-                self._start_times.pop(task_id, None)
-                continue
-
-            feats = extract_features(job)
-            fh = feature_hash(feats)
-
-            duel_cfg = (job.get("routing_hints") or {})
-            is_duel = bool(duel_cfg.get("duel") or duel_cfg.get("duel_candidates"))
-            if mode in {"chat", "docs", "planner"}:
-                is_duel = False
 
-            language_hint: str | None = language
-            if mode == "chat":
-                language_hint = None
-            elif mode == "docs":
-                language_hint = "docs"
-            elif mode == "planner":
-                language_hint = "planner"
+                async with eng.begin() as conn:
+                    await update_task_status(conn, id, "done", model_used=res.get("model"), latency_ms=res.get("latency_ms"))
+                    await upsert_stat(conn, res["model"], fh, reward)
 
-            force_duel = bool((job.get("metadata") or {}).get("force_duel")) or FORCE_DUEL
-            if mode == "chat":
-                force_duel = False
-            if force_duel:
-                is_duel = True
+                # artifact for SSE completion
+                self._write_artifact_safely(task_id, {
+                    "status":"done","mode": result_mode,
+                    "model":res.get("model"), "latency_ms":res.get("latency_ms"),
+                    "compile_pass":res.get("compile_pass"), "test_pass":res.get("test_pass"),
+                    "lint_pass":res.get("lint_pass"), "smoke_pass":res.get("smoke_pass"),
+                    "tool":res.get("tool"), "artifact":res.get("artifact"), "logs":res.get("logs"),
+                    "content": res.get("content"),
+                    "zip_url": res.get("zip_url"),
+                    "zip_notes": res.get("zip_notes"),
+                    "follow_up_steps": res.get("follow_up_steps"),
+                    "tier_history": res.get("tier_history"),
+                    "tier_best_score": res.get("tier_best_score"),
+                })
 
-            try:
-                if not is_duel:
-                    base_models = available_models(language_hint)
-                    base = _order_models_for_mode(mode, base_models, language)
-                    async with eng.connect() as conn:
-                        ordered = await rank_models(conn, base, fh)
-                    if not ordered:
-                        raise RuntimeError("no available models")
-                    strategy = str((meta_for_log.get("strategy") or (job.get("routing_hints") or {}).get("strategy") or "")).strip().lower()
-                    res: Optional[Dict[str, Any]] = None
-                    result_mode = "single"
-                    if strategy == "tiered_refine" and mode == "code":
-                        res = await self._run_tiered_refine(job, ordered, task_id)
-                        if res is not None:
-                            result_mode = "tiered"
-                        else:
-                            log.info("tiered_refine.fallback", {"task_id": task_id})
-                    if res is None:
-                        m = ordered[0]
-                        if not m:
-                            raise RuntimeError("no available models")
-                        if strategy == "tot_beam" and mode == "code":
-                            result_mode = "tot"
-                            await self._publish_status(task_id, f"Searching tree of edits with {_format_model_name(m)}…", stage="tot-search")
-                            tot_task = asyncio.create_task(self._run_tot_beam(job, m, task_id))
-                            self._inflight[task_id].append(tot_task)
-                            res = await tot_task
-                            if res is None:
-                                result_mode = "single"
-                                await self._publish_status(task_id, f"Tree search fallback: generating answer with {_format_model_name(m)}…", stage="generating")
-                                fallback_task = asyncio.create_task(self._run_candidate(job, m, task_id))
-                                self._inflight[task_id].append(fallback_task)
-                                res = await fallback_task
-                        else:
-                            await self._publish_status(task_id, f"Generating answer with {_format_model_name(m)}…", stage="generating")
-                            t = asyncio.create_task(self._run_candidate(job, m, task_id))
-                            self._inflight[task_id].append(t)
-                            res = await t
-                    if res is None:
-                        raise RuntimeError("strategy execution returned no result")
+                await self._publish(task_id, json.dumps({
+                    "status":"done",
+                    "mode": result_mode,
+                    "model":res.get("model"), "latency_ms":res.get("latency_ms"),
+                    "compile_pass":res.get("compile_pass"), "test_pass":res.get("test_pass"),
+                    "lint_pass":res.get("lint_pass"), "smoke_pass":res.get("smoke_pass"),
+                    "tool":res.get("tool"), "artifact":res.get("artifact"), "logs":res.get("logs"),
+                    "content": res.get("content"),
+                    "zip_url": res.get("zip_url"),
+                    "zip_notes": res.get("zip_notes"),
+                    "follow_up_steps": res.get("follow_up_steps"),
+                    "prompt_tokens": res.get("prompt_tokens"),
+                    "completion_tokens": res.get("completion_tokens"),
+                    "ctx_limit": res.get("ctx_limit"),
+                    "tier_history": res.get("tier_history"),
+                    "tier_best_score": res.get("tier_best_score"),
+                    "pending_final": bool(res.get("pending_final")),
+                }))
+                try:
+                    res["status"] = res.get("status") or "done"
+                except Exception:
+                    pass
+                try:
+                    await self._record_completion(task_id, job, res)
+                except Exception:
+                    pass
+            else:
+                cand_names: List[str] = duel_cfg.get("duel_candidates") or []
+                reg_models = routed_models(mode, language)
+                name_map = { _format_model_name(m): m for m in reg_models }
+                candidates = [name_map[s] for s in cand_names if s in name_map] if cand_names else reg_models[:2]
+                async with eng.connect() as conn:
+                    ordered = await rank_models(conn, candidates, fh)
+                if len(ordered) < 2:
+                    # fallback to single
+                    m = ordered[0] if ordered else (reg_models[0] if reg_models else None)
+                    await self._publish_status(task_id, f"Generating answer with {_format_model_name(m)}…", stage="generating")
+                    t = asyncio.create_task(self._run_candidate(job, m, task_id))
+                    self._track(task_id, t)
+                    res = await t
                     reward = 1.0 if res.get("test_pass") else (0.5 if res.get("compile_pass") else 0.0)
-
-                    # bandit: log real single-run reward
-                    try:
-                        bandit_record_event(res.get("model") or "unknown", float(reward), {"src":"queue","task_id": task_id,"mode": result_mode})
-                    except Exception:
-                        pass
-
                     async with eng.begin() as conn:
                         await update_task_status(conn, id, "done", model_used=res.get("model"), latency_ms=res.get("latency_ms"))
                         await upsert_stat(conn, res["model"], fh, reward)
 
-                    # artifact for SSE completion
+                    # artifact
                     self._write_artifact_safely(task_id, {
-                        "status":"done","mode": result_mode,
+                        "status":"done","mode":"single",
                         "model":res.get("model"), "latency_ms":res.get("latency_ms"),
                         "compile_pass":res.get("compile_pass"), "test_pass":res.get("test_pass"),
-                        "lint_pass":res.get("lint_pass"), "smoke_pass":res.get("smoke_pass"),
                         "tool":res.get("tool"), "artifact":res.get("artifact"), "logs":res.get("logs"),
                         "content": res.get("content"),
                         "zip_url": res.get("zip_url"),
                         "zip_notes": res.get("zip_notes"),
                         "follow_up_steps": res.get("follow_up_steps"),
-                        "tier_history": res.get("tier_history"),
-                        "tier_best_score": res.get("tier_best_score"),
                     })
 
-                    await self.hub.publish(task_id, json.dumps({
+                    await self._publish(task_id, json.dumps({
                         "status":"done",
-                        "mode": result_mode,
-                        "model":res.get("model"), "latency_ms":res.get("latency_ms"),
-                        "compile_pass":res.get("compile_pass"), "test_pass":res.get("test_pass"),
-                        "lint_pass":res.get("lint_pass"), "smoke_pass":res.get("smoke_pass"),
-                        "tool":res.get("tool"), "artifact":res.get("artifact"), "logs":res.get("logs"),
+                        "model":res.get("model"),
+                        "latency_ms":res.get("latency_ms"),
+                        "compile_pass":res.get("compile_pass"),
+                        "test_pass":res.get("test_pass"),
+                        "tool":res.get("tool"),
+                        "artifact":res.get("artifact"),
+                        "logs":res.get("logs"),
                         "content": res.get("content"),
                         "zip_url": res.get("zip_url"),
                         "zip_notes": res.get("zip_notes"),
                         "follow_up_steps": res.get("follow_up_steps"),
-                        "prompt_tokens": res.get("prompt_tokens"),
-                        "completion_tokens": res.get("completion_tokens"),
-                        "ctx_limit": res.get("ctx_limit"),
-                        "tier_history": res.get("tier_history"),
-                        "tier_best_score": res.get("tier_best_score"),
                         "pending_final": bool(res.get("pending_final")),
                     }))
                     try:
@@ -2405,220 +3583,91 @@ class JobQueue:
                     except Exception:
                         pass
                     try:
-                        await record_completion(task_id, job, res)
+                        await self._record_completion(task_id, job, res)
                     except Exception:
                         pass
+                    return
+
+                a_meta, b_meta = ordered[0], ordered[1]
+                a_name, b_name = _format_model_name(a_meta), _format_model_name(b_meta)
+                router_route_count.labels(model=a_name, language=language).inc()
+                router_route_count.labels(model=b_name, language=language).inc()
+                await self._publish(task_id, json.dumps({"phase":"duel","candidate":a_name,"status":"running","message":f"Pairing with {a_name}…"}))
+                await self._publish(task_id, json.dumps({"phase":"duel","candidate":b_name,"status":"running","message":f"Pairing with {b_name}…"}))
+
+                cfg = get_duel_config()
+                duel_strategy = _duel_strategy(job, cfg)
+                duel_timeout = self._candidate_timeout(job, DUEL_TIMEOUT_SEC)
+                duel_t0 = time.monotonic()
+                if duel_strategy == "hedge":
+                    await self._publish_status(task_id, f"Generating answer with {a_name}…", stage="generating")
+                    ta, tb = await self._hedge_duel(task_id, job, a_meta, b_meta, a_name, b_name)
+                    if tb is None:
+                        a_res = self._duel_outcome(ta, a_name, duel_timeout)
+                        await self._publish_duel_candidate(task_id, a_res)
+                        await self._record_solo_outcome(eng, task_id, fh, a_res, b_name, "hedge-skipped")
+                        await self._finish_duel(eng, id, task_id, job, cfg, a_res, self._absent_candidate(b_name, "hedge-skipped", 0),
+                                                latency_ms=a_res["latency_ms"], mode="hedge")
+                        return
                 else:
-                    cand_names: List[str] = duel_cfg.get("duel_candidates") or []
-                    reg_models = _order_models_for_mode(mode, available_models(language_hint), language)
-                    name_map = { _format_model_name(m): m for m in reg_models }
-                    candidates = [name_map[s] for s in cand_names if s in name_map] if cand_names else reg_models[:2]
-                    async with eng.connect() as conn:
-                        ordered = await rank_models(conn, candidates, fh)
-                    if len(ordered) < 2:
-                        # fallback to single
-                        m = ordered[0] if ordered else (reg_models[0] if reg_models else None)
-                        await self._publish_status(task_id, f"Generating answer with {_format_model_name(m)}…", stage="generating")
-                        t = asyncio.create_task(self._run_candidate(job, m, task_id))
-                        self._inflight[task_id].append(t)
-                        res = await t
-                        reward = 1.0 if res.get("test_pass") else (0.5 if res.get("compile_pass") else 0.0)
-                        async with eng.begin() as conn:
-                            await update_task_status(conn, id, "done", model_used=res.get("model"), latency_ms=res.get("latency_ms"))
-                            await upsert_stat(conn, res["model"], fh, reward)
-
-                        # artifact
-                        self._write_artifact_safely(task_id, {
-                            "status":"done","mode":"single",
-                            "model":res.get("model"), "latency_ms":res.get("latency_ms"),
-                            "compile_pass":res.get("compile_pass"), "test_pass":res.get("test_pass"),
-                            "tool":res.get("tool"), "artifact":res.get("artifact"), "logs":res.get("logs"),
-                            "content": res.get("content"),
-                            "zip_url": res.get("zip_url"),
-                            "zip_notes": res.get("zip_notes"),
-                            "follow_up_steps": res.get("follow_up_steps"),
-                        })
-
-                        await self.hub.publish(task_id, json.dumps({
-                            "status":"done",
-                            "model":res.get("model"),
-                            "latency_ms":res.get("latency_ms"),
-                            "compile_pass":res.get("compile_pass"),
-                            "test_pass":res.get("test_pass"),
-                            "tool":res.get("tool"),
-                            "artifact":res.get("artifact"),
-                            "logs":res.get("logs"),
-                            "content": res.get("content"),
-                            "zip_url": res.get("zip_url"),
-                            "zip_notes": res.get("zip_notes"),
-                            "follow_up_steps": res.get("follow_up_steps"),
-                            "pending_final": bool(res.get("pending_final")),
-                        }))
-                        try:
-                            res["status"] = res.get("status") or "done"
-                        except Exception:
-                            pass
-                        try:
-                            await record_completion(task_id, job, res)
-                        except Exception:
-                            pass
-                        self.queue.task_done()
-                        self._inflight.pop(task_id, None)
-                        self._start_times.pop(task_id, None)
-                        continue
-
-                    a_meta, b_meta = ordered[0], ordered[1]
-                    a_name, b_name = _format_model_name(a_meta), _format_model_name(b_meta)
-                    router_route_count.labels(model=a_name, language=language).inc()
-                    router_route_count.labels(model=b_name, language=language).inc()
-                    await self.hub.publish(task_id, json.dumps({"phase":"duel","candidate":a_name,"status":"running","message":f"Pairing with {a_name}…"}))
-                    await self.hub.publish(task_id, json.dumps({"phase":"duel","candidate":b_name,"status":"running","message":f"Pairing with {b_name}…"}))
-
-                    # run both with a global duel timeout
-                    await self._publish_status(task_id, "Generating duel candidates…", stage="generating")
+                    stage_msg = "Racing duel candidates…" if duel_strategy == "race" else "Generating duel candidates…"
+                    await self._publish_status(task_id, stage_msg, stage="generating")
                     ta = asyncio.create_task(self._run_candidate(job, a_meta, task_id))
                     tb = asyncio.create_task(self._run_candidate(job, b_meta, task_id))
-                    self._inflight[task_id].extend([ta, tb])
-
-                    try:
-                        a_res, b_res = await asyncio.wait_for(asyncio.gather(ta, tb), timeout=DUEL_TIMEOUT_SEC)
-                    except asyncio.TimeoutError:
-                        log.warning("duel.timeout", {"task_id": task_id, "timeout_sec": DUEL_TIMEOUT_SEC})
-                        # cancel any still-running tasks
-                        for t in (ta, tb):
-                            if not t.done(): t.cancel()
-                        # gather partials
-                        done = []
-                        for t in (ta, tb):
-                            try:
-                                done.append(await t)
-                            except asyncio.CancelledError:
-                                done.append({"model": a_name if t is ta else b_name, "success": False, "latency_ms": DUEL_TIMEOUT_SEC*1000,
-                                             "compile_pass": False, "test_pass": False, "tool": "timeout", "logs": {"build_stdout_tail":"","build_stderr_tail":"duel timed out"}, "artifact": ""})
-                        a_res, b_res = done
-
-                    await self._publish_status(task_id, f"Comparing {a_name} vs {b_name}…", stage="evaluating")
-
-                    await self.hub.publish(task_id, json.dumps({
-                        "phase":"duel","candidate":a_res["model"],"status":"done",
-                        "metrics":{"success":a_res["success"],"latency_ms":a_res["latency_ms"],"compile_pass":a_res["compile_pass"],"test_pass":a_res["test_pass"]},
-                        "tool":a_res["tool"], "artifact":a_res["artifact"], "logs":a_res["logs"],
-                        "content": a_res.get("content"),
-                        "zip_url": a_res.get("zip_url"),
-                        "zip_notes": a_res.get("zip_notes"),
-                        "pending_final": bool(a_res.get("pending_final")),
-                    }))
-                    await self.hub.publish(task_id, json.dumps({
-                        "phase":"duel","candidate":b_res["model"],"status":"done",
-                        "metrics":{"success":b_res["success"],"latency_ms":b_res["latency_ms"],"compile_pass":b_res["compile_pass"],"test_pass":b_res["test_pass"]},
-                        "tool":b_res["tool"], "artifact":b_res["artifact"], "logs":b_res["logs"],
-                        "content": b_res.get("content"),
-                        "zip_url": b_res.get("zip_url"),
-                        "zip_notes": b_res.get("zip_notes"),
-                        "pending_final": bool(b_res.get("pending_final")),
-                    }))
-
-                    cfg = get_duel_config()
-                    def score(r):
-                        base = (cfg["success_weight"] * (1.0 if r["success"] else 0.0))
-                        test_bonus = float(cfg.get("test_pass_weight", 0.5)) * (1.0 if r.get("test_pass") else 0.0)
-                        return base + test_bonus - (cfg["latency_penalty_ms"] * float(r["latency_ms"])) + (cfg["human_score_weight"] * float(r.get("human_score",0) or 0))
-                    winner, loser = (a_res, b_res) if score(a_res) >= score(b_res) else (b_res, a_res)
-
-                    duel_selection_decisions_total.labels(winner=winner["model"], loser=loser["model"]).inc()
-                    duel_rule_decisions_total.labels(rule_version=str(cfg.get("rule_version","v1"))).inc()
-
-                    reward_w = 1.0 if winner.get("test_pass") else (0.5 if winner.get("compile_pass") else 0.0)
-                    reward_l = 1.0 if loser.get("test_pass") else (0.5 if loser.get("compile_pass") else 0.0)
-                    # bandit: persist duel outcome (winner & loser)
-                    try:
-                        bandit_record(winner.get('model') or 'unknown', float(reward_w), True,  task_type='duel')
-                        bandit_record(loser.get('model')  or 'unknown', float(reward_l), False, task_type='duel')
-                    except Exception:
-                        pass
+                    self._track(task_id, ta, tb)
+                names = {ta: a_name, tb: b_name}
+
+                if duel_strategy in ("race", "hedge"):
+                    # a hedged pair is raced: whichever qualifies first answers the task
+                    remaining = max(0.0, duel_timeout - (time.monotonic() - duel_t0))
+                    winner, loser_task, finished = await self._race_duel(task_id, ta, tb, names, remaining)
+                    if winner is not None:
+                        await self._publish_duel_candidate(task_id, winner)
+                        await self._finish_race(eng, task_id, job, fh, cfg, winner, loser_task, names[loser_task], remaining, mode=duel_strategy)
+                        return
+                    # nobody qualified: both are finished, score them like a regular duel
+                    a_res, b_res = finished[ta], finished[tb]
+                else:
+                    a_res, b_res = await self._gather_duel(task_id, ta, tb, names, duel_timeout)
 
-                    # bandit: log duel rewards (winner & loser)
-                    try:
-                        bandit_record_event(winner.get("model") or "unknown", float(reward_w), {"src":"queue","task_id": task_id,"mode":"duel","role":"winner","opponent": (loser.get("model") or "unknown")})
-                        bandit_record_event(loser.get("model") or "unknown", float(reward_l), {"src":"queue","task_id": task_id,"mode":"duel","role":"loser","opponent": (winner.get("model") or "unknown")})
-                    except Exception:
-                        pass
+                await self._publish_status(task_id, f"Comparing {a_name} vs {b_name}…", stage="evaluating")
+                await self._publish_duel_candidate(task_id, a_res)
+                await self._publish_duel_candidate(task_id, b_res)
 
-                    async with eng.begin() as conn:
-                        await update_task_status(conn, id, "done", model_used=winner["model"], latency_ms=min(a_res["latency_ms"], b_res["latency_ms"]))
-                        await conn.execute(text("""INSERT INTO rewards (id, task_id, model, success, latency_ms, human_score)
-                                                   VALUES (gen_random_uuid(), :tid, :m1, :s1, :l1, NULL)"""),
-                                           dict(tid=task_id, m1=winner["model"], s1=bool(winner["success"]), l1=int(winner["latency_ms"])))
-                        await conn.execute(text("""INSERT INTO rewards (id, task_id, model, success, latency_ms, human_score)
-                                                   VALUES (gen_random_uuid(), :tid, :m2, :s2, :l2, NULL)"""),
-                                           dict(tid=task_id, m2=loser["model"], s2=bool(loser["success"]), l2=int(loser["latency_ms"])))
-                        await upsert_stat(conn, winner["model"], fh, reward_w)
-                        await upsert_stat(conn, loser["model"], fh, reward_l)
-
-                    winner_has_final = bool(str(winner.get("content") or "").strip()) or bool(winner.get("zip_url")) or bool(winner.get("artifact"))
-
-                    # artifact for duel completion
-                    self._write_artifact_safely(task_id, {
-                        "status":"done","mode":"duel",
-                        "winner": winner["model"], "loser": loser["model"],
-                        "rule_version": str(cfg.get("rule_version","v1")),
-                        "winner_metrics":{"success":winner["success"], "latency_ms":winner["latency_ms"],
-                                          "compile_pass":winner["compile_pass"], "test_pass":winner["test_pass"], "tool":winner["tool"]},
-                        "loser_metrics":{"success":loser["success"], "latency_ms":loser["latency_ms"],
-                                         "compile_pass":loser["compile_pass"], "test_pass":loser["test_pass"], "tool":loser["tool"]},
-                        "content": winner.get("content"),
-                        "zip_url": winner.get("zip_url"),
-                        "zip_notes": winner.get("zip_notes"),
-                        "follow_up_steps": winner.get("follow_up_steps"),
-                    })
-
-                    await self.hub.publish(task_id, json.dumps({
-                        "status":"done",
-                        "winner": winner["model"], "loser": loser["model"],
-                        "rule_version": str(cfg.get("rule_version","v1")),
-                        "winner_metrics":{"success":winner["success"], "latency_ms":winner["latency_ms"],
-                                          "compile_pass":winner["compile_pass"], "test_pass":winner["test_pass"], "tool":winner["tool"]},
-                        "loser_metrics":{"success":loser["success"], "latency_ms":loser["latency_ms"],
-                                         "compile_pass":loser["compile_pass"], "test_pass":loser["test_pass"], "tool":loser["tool"]},
-                        "content": winner.get("content"),
-                        "zip_url": winner.get("zip_url"),
-                        "zip_notes": winner.get("zip_notes"),
-                        "follow_up_steps": winner.get("follow_up_steps"),
-                        "pending_final": not winner_has_final,
-                    }))
-                    try:
-                        winner_payload = dict(winner)
-                        winner_payload.setdefault("status", "done")
-                        winner_payload.setdefault("mode", "duel")
-                        winner_payload.setdefault("pending_final", not winner_has_final)
-                        await record_completion(task_id, job, winner_payload)
-                    except Exception:
-                        pass
-            except asyncio.CancelledError:
-                # task canceled
-                async with eng.begin() as conn:
-                    await update_task_status(conn, id, "canceled", model_used=None)
-                await self.hub.publish(task_id, json.dumps({"status":"canceled"}))
-                log.info("task.cancelled", {"id": task_id})
-            except Exception as e:
-                err_summary = (str(e) or "").strip()
-                if not err_summary:
-                    err_summary = " ".join(str(x) for x in (getattr(e, "args", []) or []) if x) or e.__class__.__name__
-                trace_txt = "".join(traceback.format_exception(type(e), e, e.__traceback__)).strip()
-                if len(trace_txt) > 6000:
-                    trace_txt = trace_txt[-6000:]
-                async with eng.begin() as conn:
-                    await update_task_status(conn, id, "error", model_used=None, error=err_summary)
-                await self.hub.publish(task_id, json.dumps({
-                    "status":"error",
-                    "error": err_summary,
-                    "traceback": trace_txt
-                }))
-                log.exception("task.error", {"id": task_id, "error": err_summary})
-            finally:
-                self._inflight.pop(task_id, None)
-                self._start_times.pop(task_id, None)
-                self.queue.task_done()
+                winner, loser = (a_res, b_res) if self._score(a_res, cfg) >= self._score(b_res, cfg) else (b_res, a_res)
+                await self._record_duel_rewards(eng, task_id, fh, cfg, winner, loser)
+                await self._finish_duel(eng, id, task_id, job, cfg, winner, loser,
+                                        latency_ms=min(a_res["latency_ms"], b_res["latency_ms"]))
+        except asyncio.CancelledError:
+            if task_id in self._inflight:
+                # not cancel(): the worker itself is stopping, so the job goes back to the queue
+                for t in self._inflight[task_id]:
+                    if not t.done():
+                        t.cancel()
+                raise
+            # task canceled
+            async with eng.begin() as conn:
+                await update_task_status(conn, id, "canceled", model_used=None)
+            await self._publish(task_id, json.dumps({"status":"canceled"}))
+            log.info("task.cancelled", {"id": task_id})
+        except Exception as e:
+            err_summary = (str(e) or "").strip()
+            if not err_summary:
+                err_summary = " ".join(str(x) for x in (getattr(e, "args", []) or []) if x) or e.__class__.__name__
+            trace_txt = "".join(traceback.format_exception(type(e), e, e.__traceback__)).strip()
+            if len(trace_txt) > 6000:
+                trace_txt = trace_txt[-6000:]
+            async with eng.begin() as conn:
+                await update_task_status(conn, id, "error", model_used=None, error=err_summary)
+            await self._publish(task_id, json.dumps({
+                "status":"error",
+                "error": err_summary,
+                "traceback": trace_txt
+            }))
+            log.exception("task.error", {"id": task_id, "error": err_summary})
+        finally:
+            self._inflight.pop(task_id, None)
+            self._start_times.pop(task_id, None)
 
 
 # --- Bandit autolog helper (call this where you compute duel results) ---
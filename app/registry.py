@@ -1,14 +1,23 @@
 from __future__ import annotations
-import os, time, re, json
-from typing import List, Dict, Any, Tuple
-import httpx
+import asyncio, copy, os, time, re, json, threading
+from dataclasses import dataclass, field
+from typing import Callable, List, Dict, Any, Optional, Tuple
 import yaml
 import subprocess, shutil
 
+from .llm.http_pool import async_client, sync_client, timeout, traced, traced_sync
+from .llm.backends import backend_pool
+from .logging_setup import get_logger
+
+log = get_logger("registry")
+
 # ---------- Config ----------
 DEFAULT_CTX = 8192
 DISCOVERY_REFRESH_SEC = int(os.getenv("OLLAMA_DISCOVERY_REFRESH_SEC", "60"))
-OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_HOST = backend_pool.primary
+PARALLEL_SESSIONS_DEFAULT = int(os.getenv("OLLAMA_PARALLEL_SESSIONS_DEFAULT", "1") or "1")
+# How often the background refresher checks models.yaml's mtime (discovery has its own interval).
+REGISTRY_POLL_SEC = float(os.getenv("REGISTRY_POLL_SEC", "5") or "5")
 
 # ---------- Helpers ----------
 _SIZE_RX = re.compile(r":\s*([0-9]+[bk])", re.IGNORECASE)  # e.g., ":8b", ":7b", ":70b"
@@ -41,15 +50,41 @@ def _parse_name_size_quant(model_str: str) -> Tuple[str,str,str]:
     quant = quant_match.group(1).lower() if quant_match else ""
     return name, size_tag, quant
 
+_FILE_CACHE: Dict[str, Any] = {"path": None, "mtime": None, "data": {"models": []}}
+
+def _registry_path() -> str:
+    return os.getenv("MODEL_REGISTRY_PATH", "./config/models.yaml")
+
+def _registry_mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
 def _load_file_registry() -> Dict[str, Any]:
-    path = os.getenv("MODEL_REGISTRY_PATH", "./config/models.yaml")
+    """config/models.yaml, re-parsed only when its mtime changes."""
+    path = _registry_path()
+    mtime = _registry_mtime(path)
+    if _FILE_CACHE["path"] == path and _FILE_CACHE["mtime"] == mtime:
+        return _FILE_CACHE["data"]
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f) or {}
+            data = yaml.safe_load(f) or {}
     except FileNotFoundError:
-        return {"models": []}
+        data = {"models": []}
+    _FILE_CACHE.update(path=path, mtime=mtime, data=data)
+    return data
+
+_VRAM_GB: Optional[float] = None
 
 def _probe_vram_gb() -> float:
+    """GPU memory, probed once per process (nvidia-smi is slow and the answer does not change)."""
+    global _VRAM_GB
+    if _VRAM_GB is None:
+        _VRAM_GB = _probe_vram_gb_uncached()
+    return _VRAM_GB
+
+def _probe_vram_gb_uncached() -> float:
     manual = os.getenv("GPU_VRAM_GB")
     if manual:
         try:
@@ -71,41 +106,58 @@ def _probe_vram_gb() -> float:
 # ---------- Discovery (cached) ----------
 _DISC_CACHE: Dict[str, Any] = {"ts": 0.0, "models": []}
 
+def _parse_ollama_tags(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Newer Ollama returns {"models":[{"model":"llama3.1:8b", ...}, ...]}
+    models = data.get("models") or []
+    out = []
+    for m in models:
+        # prefer "model", fallback to f"{name}:{tag}"
+        model_str = m.get("model")
+        if not model_str:
+            name = m.get("name")
+            tag = m.get("tag") or ""
+            model_str = f"{name}:{tag}" if name and tag else (name or "")
+        if not model_str:
+            continue
+        name, size, quant = _parse_name_size_quant(model_str)
+        out.append({
+            "name": name,
+            "size": size or "",             # may be empty
+            "quant": quant or "",           # may be empty
+            "tag": model_str,               # keep the exact tag for downstream callers
+            "ctx_size": DEFAULT_CTX,
+            "min_vram_gb": _heuristic_min_vram_gb(size or "7b"),
+            "speed_rank": 5,                # mid default; config can override
+            "langs": ["java", "python", "docs", "planner"],
+            "_source": "ollama",
+        })
+    return out
+
 def _fetch_ollama_tags() -> List[Dict[str, Any]]:
     url = f"{OLLAMA_HOST.rstrip('/')}/api/tags"
     try:
-        with httpx.Client(timeout=5.0) as cx:
-            r = cx.get(url)
-            r.raise_for_status()
-            data = r.json()
-            # Newer Ollama returns {"models":[{"model":"llama3.1:8b", ...}, ...]}
-            models = data.get("models") or []
-            out = []
-            for m in models:
-                # prefer "model", fallback to f"{name}:{tag}"
-                model_str = m.get("model")
-                if not model_str:
-                    name = m.get("name")
-                    tag = m.get("tag") or ""
-                    model_str = f"{name}:{tag}" if name and tag else (name or "")
-                if not model_str:
-                    continue
-                name, size, quant = _parse_name_size_quant(model_str)
-                out.append({
-                    "name": name,
-                    "size": size or "",             # may be empty
-                    "quant": quant or "",           # may be empty
-                    "tag": model_str,               # keep the exact tag for downstream callers
-                    "ctx_size": DEFAULT_CTX,
-                    "min_vram_gb": _heuristic_min_vram_gb(size or "7b"),
-                    "speed_rank": 5,                # mid default; config can override
-                    "langs": ["java", "python", "docs", "planner"],
-                    "_source": "ollama",
-                })
-            return out
+        r = sync_client().get(url, timeout=timeout(5.0), extensions=traced_sync("tags"))
+        r.raise_for_status()
+        return _parse_ollama_tags(r.json())
     except Exception:
         return []
 
+async def _fetch_ollama_tags_async() -> List[Dict[str, Any]]:
+    """Tags from every configured backend (a model on any host is routable; others pull on demand)."""
+    async def one(host: str) -> List[Dict[str, Any]]:
+        try:
+            r = await async_client().get(f"{host}/api/tags", timeout=timeout(5.0), extensions=traced("tags"))
+            r.raise_for_status()
+            return _parse_ollama_tags(r.json())
+        except Exception:
+            return []
+
+    seen: Dict[str, Dict[str, Any]] = {}
+    for models in await asyncio.gather(*(one(b.url) for b in backend_pool.backends)):
+        for m in models:
+            seen.setdefault(m["tag"], m)
+    return list(seen.values())
+
 def _discovered_models() -> List[Dict[str, Any]]:
     now = time.time()
     if now - _DISC_CACHE["ts"] > DISCOVERY_REFRESH_SEC:
@@ -133,26 +185,158 @@ def _merge_models(config_models: List[Dict[str, Any]], discovered: List[Dict[str
     items.sort(key=lambda x: x.get("speed_rank", 999))
     return items
 
-# ---------- Public API ----------
-def available_models(language: str | None = None) -> List[Dict[str, Any]]:
+# ---------- Snapshot ----------
+RouteKey = Tuple[str, Optional[str]]
+
+
+@dataclass(frozen=True)
+class RegistrySnapshot:
+    """Immutable view of the merged registry; routing reads it without I/O."""
+    models: List[Dict[str, Any]]
+    by_language: Dict[str, List[Dict[str, Any]]]
+    defaults: Dict[str, Any]
+    parallel_sessions: Dict[str, int]
+    file_mtime: Optional[float]
+    discovered_at: float
+    min_vram: Dict[str, float] = field(default_factory=dict)
+
+
+_SNAPSHOT: Optional[RegistrySnapshot] = None
+_ROUTE_BUILDER: Optional[Callable[[str, Optional[str]], List[Dict[str, Any]]]] = None
+# Ordered candidates per (mode, language) for one snapshot, built by the route builder the queue
+# registers. Replaced as a whole (copy-on-write) so readers never see a dict being filled, and
+# rebuilt for the same keys whenever a new snapshot is installed.
+_ROUTES: Tuple[Optional[RegistrySnapshot], Dict[RouteKey, List[Dict[str, Any]]]] = (None, {})
+_ROUTES_LOCK = threading.Lock()
+
+
+def _build_snapshot(discovered: List[Dict[str, Any]], discovered_at: float) -> RegistrySnapshot:
     reg = _load_file_registry()
-    discovered = _discovered_models()
-    all_models = _merge_models(reg.get("models", []), discovered)
     vram = _probe_vram_gb()
+    models = [
+        m for m in _merge_models(copy.deepcopy(reg.get("models", []) or []), copy.deepcopy(discovered))
+        if vram <= 0 or vram >= float(m.get("min_vram_gb", 0))
+    ]
+    by_language: Dict[str, List[Dict[str, Any]]] = {}
+    for m in models:
+        for lang in m.get("langs", []) or []:
+            # same membership test as before: only plain string entries match a language
+            if isinstance(lang, str):
+                by_language.setdefault(lang, []).append(m)
+    sessions: Dict[str, int] = {}
+    for m in reg.get("models", []) or []:
+        try:
+            n = max(1, int(m.get("num_parallel_sessions") or PARALLEL_SESSIONS_DEFAULT))
+        except (TypeError, ValueError):
+            n = max(1, PARALLEL_SESSIONS_DEFAULT)
+        for name in (m.get("tag"), m.get("name")):
+            if name:
+                sessions.setdefault(str(name).lower(), n)
+    min_vram: Dict[str, float] = {}
+    for m in models:
+        try:
+            gb = float(m.get("min_vram_gb") or 0)
+        except (TypeError, ValueError):
+            continue
+        for name in (m.get("tag"), f"{m.get('name')}:{m.get('size')}-{m.get('quant')}" if m.get("size") else None):
+            if name:
+                min_vram.setdefault(str(name).lower(), gb)
+    return RegistrySnapshot(
+        models=models,
+        by_language=by_language,
+        defaults=reg.get("defaults", {}) or {},
+        parallel_sessions=sessions,
+        file_mtime=_FILE_CACHE["mtime"],
+        discovered_at=discovered_at,
+        min_vram=min_vram,
+    )
+
+
+def _install(snap: RegistrySnapshot, previous: Optional[RegistrySnapshot]) -> RegistrySnapshot:
+    global _SNAPSHOT, _ROUTES
+    _SNAPSHOT = snap
+    if _ROUTE_BUILDER is not None and previous is not None:
+        routes: Dict[RouteKey, List[Dict[str, Any]]] = {}
+        for mode, language in list(_ROUTES[1]):
+            try:
+                routes[(mode, language)] = _ROUTE_BUILDER(mode, language)
+            except Exception:
+                pass
+        with _ROUTES_LOCK:
+            if _SNAPSHOT is snap:
+                _ROUTES = (snap, routes)
+    return snap
+
+
+def registry_snapshot() -> RegistrySnapshot:
+    """Current snapshot; built synchronously only the first time (scripts, tests, cold start)."""
+    snap = _SNAPSHOT
+    if snap is None:
+        snap = _install(_build_snapshot(_discovered_models(), time.time()), None)
+    return snap
+
+
+async def refresh_registry(force_discovery: bool = False) -> RegistrySnapshot:
+    """Rebuild the snapshot off the loop when models.yaml changed or discovery is due."""
+    prev = _SNAPSHOT
+    now = time.time()
+    discover = force_discovery or prev is None or now - prev.discovered_at >= DISCOVERY_REFRESH_SEC
+    file_changed = prev is None or _registry_mtime(_registry_path()) != prev.file_mtime
+    if not discover and not file_changed:
+        return prev
+    if discover:
+        discovered = await _fetch_ollama_tags_async()
+        _DISC_CACHE.update(models=discovered, ts=now)
+        discovered_at = now
+    else:
+        discovered, discovered_at = _DISC_CACHE["models"], prev.discovered_at
+    snap = await asyncio.to_thread(_build_snapshot, discovered, discovered_at)
+    return _install(snap, prev)
+
+
+async def run_registry_refresher() -> None:
+    """Background task started with the app: keeps the snapshot fresh so requests never block."""
+    while True:
+        try:
+            await refresh_registry()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            log.warning("registry.refresh_failed", {"error": str(exc)})
+        await asyncio.sleep(REGISTRY_POLL_SEC)
+
+
+def set_route_builder(builder: Callable[[str, Optional[str]], List[Dict[str, Any]]]) -> None:
+    global _ROUTE_BUILDER
+    _ROUTE_BUILDER = builder
 
-    filtered: List[Dict[str, Any]] = []
-    for m in all_models:
-        vram_ok = True if vram <= 0 else (vram >= float(m.get("min_vram_gb", 0)))
-        lang_ok = True if language is None else (language in m.get("langs", []))
-        if vram_ok and lang_ok:
-            filtered.append(m)
-    filtered.sort(key=lambda x: x.get("speed_rank", 999))
-    return filtered
+
+def routed_models(mode: str, language: Optional[str]) -> List[Dict[str, Any]]:
+    """Ordered candidates for (mode, language): a dict read once the current snapshot has seen the key."""
+    global _ROUTES
+    snap = registry_snapshot()
+    key = (mode, language)
+    owner, routes = _ROUTES
+    ordered = routes.get(key) if owner is snap else None
+    if ordered is None:
+        if _ROUTE_BUILDER is None:
+            raise RuntimeError("no route builder registered")
+        ordered = _ROUTE_BUILDER(mode, language)
+        with _ROUTES_LOCK:
+            owner, routes = _ROUTES
+            if _SNAPSHOT is snap:
+                _ROUTES = (snap, {**(routes if owner is snap else {}), key: ordered})
+    return list(ordered)
+
+
+# ---------- Public API ----------
+def available_models(language: str | None = None) -> List[Dict[str, Any]]:
+    snap = registry_snapshot()
+    return list(snap.models if language is None else snap.by_language.get(language, []))
 
 
 def get_mode_defaults(mode: str, language: str | None = None) -> list[str]:
-    reg = _load_file_registry()
-    defaults = reg.get("defaults", {})
+    defaults = registry_snapshot().defaults
     keys = [mode]
     if language:
         lang = str(language).lower()
@@ -167,3 +351,24 @@ def get_mode_defaults(mode: str, language: str | None = None) -> list[str]:
         if isinstance(raw, list):
             out.extend(str(item) for item in raw)
     return out
+
+
+def model_parallel_sessions(tag: str) -> int:
+    """Concurrent generations allowed for `tag` (``num_parallel_sessions`` in the registry)."""
+    wanted = str(tag or "").strip().lower()
+    return registry_snapshot().parallel_sessions.get(wanted, max(1, PARALLEL_SESSIONS_DEFAULT)) if wanted else max(1, PARALLEL_SESSIONS_DEFAULT)
+
+
+def model_min_vram_gb(tag: str) -> float:
+    """VRAM `tag` needs resident: ``min_vram_gb`` from the registry, else the size heuristic."""
+    wanted = str(tag or "").strip().lower()
+    known = registry_snapshot().min_vram.get(wanted)
+    if known is not None:
+        return known
+    _, size, _ = _parse_name_size_quant(wanted)
+    return float(_heuristic_min_vram_gb(size or "7b"))
+
+
+def vram_gb() -> float:
+    """Total GPU memory (``GPU_VRAM_GB`` or nvidia-smi); 0 when unknown."""
+    return _probe_vram_gb()
@@ -0,0 +1,246 @@
+from __future__ import annotations
+import asyncio, math, os, time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Collection, Dict, List, Set, Tuple
+
+from .bandit import _format_model_name
+from .bandit_store import get_stats as bandit_stats
+from .llm.backends import backend_pool
+from .llm.ollama_client import OllamaError, load_model, set_keep_alive, unload_model
+from .logging_setup import get_logger
+from .metrics import model_preload_seconds, model_residency_actions_total
+from .model_slots import model_slots
+from .registry import model_min_vram_gb, routed_models, vram_gb
+from .settings import settings
+
+log = get_logger("residency")
+
+RESIDENCY_ENABLED = (os.getenv("RESIDENCY_ENABLED", "1") or "1").lower() not in {"0", "false", "no", "off"}
+RESIDENCY_TOP_N = int(os.getenv("RESIDENCY_TOP_N", "1") or "1")
+RESIDENCY_MODES = [m.strip().lower() for m in (os.getenv("RESIDENCY_MODES", "chat,code") or "chat,code").split(",") if m.strip()]
+RESIDENCY_INTERVAL_SEC = float(os.getenv("RESIDENCY_INTERVAL_SEC", "60") or "60")
+RESIDENCY_KEEP_ALIVE = os.getenv("RESIDENCY_KEEP_ALIVE", "30m") or "30m"
+# Per-backend VRAM budget; 0 = GPU_VRAM_GB / nvidia-smi, and if that is unknown too, no eviction.
+RESIDENCY_VRAM_GB = float(os.getenv("RESIDENCY_VRAM_GB", "0") or "0")
+RESIDENCY_TRAFFIC_HALF_LIFE_SEC = float(os.getenv("RESIDENCY_TRAFFIC_HALF_LIFE_SEC", "900") or "900")
+
+
+@dataclass
+class ResidencyPlan:
+    loads: List[Tuple[str, str]] = field(default_factory=list)    # (model, backend url)
+    unloads: List[Tuple[str, str]] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)              # wanted but no backend has room
+
+
+def plan_residency(
+    desired: List[str],
+    resident: Dict[str, Set[str]],
+    need_gb: Callable[[str], float],
+    budget_gb: float,
+    heat: Callable[[str], float],
+    busy: Collection[str] = (),
+) -> ResidencyPlan:
+    """Which models to load where, and which cold ones to evict to make room.
+
+    ``desired`` is in priority order; a model resident on any backend counts as satisfied.
+    Only models that are neither desired nor ``busy`` (generating right now) are evicted,
+    coldest first, and only from a backend over ``budget_gb`` or one picked to host a preload.
+    A non-positive budget means VRAM is unknown: nothing is evicted and every preload goes ahead.
+    """
+    plan = ResidencyPlan()
+    resident = {url: set(models) for url, models in resident.items()}
+    want = set(desired)
+    keep = want | set(busy)
+
+    def used(url: str) -> float:
+        return sum(need_gb(m) for m in resident[url])
+
+    def floor(url: str) -> float:
+        # memory still taken once every evictable model is gone
+        return sum(need_gb(m) for m in resident[url] if m in keep)
+
+    def evict(url: str, incoming: float) -> None:
+        for m in sorted((m for m in resident[url] if m not in keep), key=heat):
+            if used(url) + incoming <= budget_gb:
+                break
+            resident[url].discard(m)
+            plan.unloads.append((m, url))
+
+    if budget_gb > 0:
+        for url in resident:
+            evict(url, 0.0)
+    for model in desired:
+        if any(model in models for models in resident.values()):
+            continue
+        if not resident:
+            plan.skipped.append(model)
+            continue
+        size = need_gb(model)
+        if budget_gb <= 0:
+            url = min(resident, key=lambda u: len(resident[u]))
+        else:
+            fits = [u for u in resident if floor(u) + size <= budget_gb]
+            if not fits:
+                plan.skipped.append(model)
+                continue
+            # least eviction needed, then most headroom left
+            url = min(fits, key=lambda u: (max(0.0, used(u) + size - budget_gb), used(u)))
+            evict(url, size)
+        resident[url].add(model)
+        plan.loads.append((model, url))
+    return plan
+
+
+class ResidencyManager:
+    """Keeps the models traffic is about to need loaded in Ollama, and evicts cold ones.
+
+    Every ``interval_sec`` it ranks each mode's routed candidates by recent traffic (an
+    exponentially decayed use count), then bandit mean reward, then registry order, takes the
+    top ``top_n`` per mode (plus the default chat model) and reconciles that against ``/api/ps``:
+    missing models are preloaded with an empty prompt and ``keep_alive``, and undesired residents
+    are unloaded when a backend would exceed its VRAM budget (``min_vram_gb`` per model).
+    """
+
+    def __init__(
+        self,
+        modes: List[str] = RESIDENCY_MODES,
+        top_n: int = RESIDENCY_TOP_N,
+        keep_alive: str = RESIDENCY_KEEP_ALIVE,
+        vram_budget_gb: float = RESIDENCY_VRAM_GB,
+        half_life_sec: float = RESIDENCY_TRAFFIC_HALF_LIFE_SEC,
+    ):
+        self.modes = list(modes)
+        self.top_n = max(0, int(top_n))
+        self.keep_alive = keep_alive
+        self.vram_budget_gb = vram_budget_gb
+        self.half_life_sec = max(1.0, half_life_sec)
+        self._traffic: Dict[str, Tuple[float, float]] = {}  # model -> (decayed count, monotonic ts)
+        self._pinned: Set[str] = set()
+        self._lock = asyncio.Lock()
+        self._last: Dict[str, Any] = {}
+
+    def note_use(self, model: str) -> None:
+        self._traffic[model] = (self.traffic(model) + 1.0, time.monotonic())
+
+    def traffic(self, model: str) -> float:
+        count, ts = self._traffic.get(model, (0.0, 0.0))
+        if not count:
+            return 0.0
+        return count * math.pow(0.5, (time.monotonic() - ts) / self.half_life_sec)
+
+    def budget_gb(self) -> float:
+        return self.vram_budget_gb if self.vram_budget_gb > 0 else vram_gb()
+
+    async def desired(self) -> List[Dict[str, Any]]:
+        """Models to keep resident, highest priority first, with why each was chosen."""
+        try:
+            means = {m: float(s.get("avg") or 0.0) for m, s in (await asyncio.to_thread(bandit_stats)).items()}
+        except Exception:
+            means = {}
+        ranked: Dict[str, List[str]] = {}
+        for mode in self.modes:
+            try:
+                names = list(dict.fromkeys(_format_model_name(m) for m in routed_models(mode, None)))
+            except Exception as exc:
+                log.debug("residency.route_failed", {"mode": mode, "error": str(exc)})
+                continue
+            order = sorted(range(len(names)), key=lambda i: (-self.traffic(names[i]), -means.get(names[i], 0.0), i))
+            ranked[mode] = [names[i] for i in order[: self.top_n]]
+        out: Dict[str, Dict[str, Any]] = {}
+        primary = (settings.chat_mode_default or "").strip()
+        if primary:
+            out[primary] = {"model": primary, "reason": "default"}
+        for rank in range(self.top_n):
+            for mode, names in ranked.items():
+                if rank < len(names) and names[rank] not in out:
+                    out[names[rank]] = {"model": names[rank], "reason": mode, "rank": rank}
+        for entry in out.values():
+            entry["traffic"] = round(self.traffic(entry["model"]), 3)
+            entry["bandit_mean"] = round(means[entry["model"]], 3) if entry["model"] in means else None
+            entry["min_vram_gb"] = model_min_vram_gb(entry["model"])
+        return list(out.values())
+
+    async def reconcile(self) -> Dict[str, Any]:
+        async with self._lock:
+            started = time.time()
+            await backend_pool.refresh()
+            desired = await self.desired()
+            wanted = [d["model"] for d in desired]
+            resident = {b.url: set(b.loaded) for b in backend_pool.backends if b.healthy}
+            busy = {m for m, s in model_slots.snapshot().items() if s["in_use"] or s["waiting"]}
+            budget = self.budget_gb()
+            plan = plan_residency(wanted, resident, model_min_vram_gb, budget, self.traffic, busy)
+
+            for model in self._pinned - set(wanted):
+                set_keep_alive(model, None)
+            for model in wanted:
+                set_keep_alive(model, self.keep_alive)
+            self._pinned = set(wanted)
+
+            actions: List[Dict[str, Any]] = []
+            for model, url in plan.unloads:
+                try:
+                    await unload_model(model, url)
+                except OllamaError as exc:
+                    log.warning("residency.unload_failed", {"model": model, "backend": url, "error": str(exc)})
+                    continue
+                b = backend_pool.get(url)
+                if b is not None:
+                    backend_pool.note_unloaded(b, model)
+                model_residency_actions_total.labels(action="unload").inc()
+                actions.append({"action": "unload", "model": model, "backend": url})
+                log.info("residency.unloaded", {"model": model, "backend": url})
+            for model, url in plan.loads:
+                t0 = time.perf_counter()
+                try:
+                    await load_model(model, url, self.keep_alive)
+                except OllamaError as exc:
+                    log.warning("residency.load_failed", {"model": model, "backend": url, "error": str(exc)})
+                    continue
+                took = time.perf_counter() - t0
+                b = backend_pool.get(url)
+                if b is not None:
+                    backend_pool.note_loaded(b, model)
+                model_preload_seconds.labels(model=model).observe(took)
+                model_residency_actions_total.labels(action="load").inc()
+                actions.append({"action": "load", "model": model, "backend": url, "seconds": round(took, 2)})
+                log.info("residency.loaded", {"model": model, "backend": url, "seconds": round(took, 2)})
+            for model in plan.skipped:
+                model_residency_actions_total.labels(action="skipped").inc()
+                actions.append({"action": "skipped", "model": model, "reason": "no_vram"})
+                log.info("residency.skipped", {"model": model, "budget_gb": budget})
+
+            self._last = {"at": started, "desired": desired, "actions": actions, "budget_gb": budget}
+            return self.snapshot()
+
+    def snapshot(self) -> Dict[str, Any]:
+        budget = self._last.get("budget_gb", self.budget_gb())
+        return {
+            "enabled": RESIDENCY_ENABLED,
+            "keep_alive": self.keep_alive,
+            "vram_budget_gb": budget,
+            "desired": self._last.get("desired", []),
+            "backends": [
+                {
+                    **b.as_dict(),
+                    "used_vram_gb": round(sum(model_min_vram_gb(m) for m in b.loaded), 1),
+                }
+                for b in backend_pool.backends
+            ],
+            "last_reconcile_at": self._last.get("at"),
+            "last_actions": self._last.get("actions", []),
+        }
+
+    async def run(self, interval_sec: float = RESIDENCY_INTERVAL_SEC) -> None:
+        """Background task started with the app; the first pass replaces the old pull-only warm-up."""
+        while True:
+            try:
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.warning("residency.reconcile_failed", {"error": str(exc)})
+            await asyncio.sleep(interval_sec)
+
+
+residency = ResidencyManager()
@@ -83,8 +83,10 @@ async def create_task(body: TaskCreate, request: Request):
     if job_queue is None:
         raise HTTPException(status_code=503, detail="job queue not ready")
     try:
-        await job_queue.submit(task_payload)
+        leader = await job_queue.submit(task_payload)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Queue submit error: {e}")
 
+    if leader is not None:
+        return {"task_id": tid, "coalesced_with": leader}
     return {"task_id": tid}
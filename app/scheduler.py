@@ -0,0 +1,218 @@
+from __future__ import annotations
+import asyncio, heapq, itertools, json, os, time
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from .metrics import scheduler_picks_total
+from .logging_setup import get_logger
+
+log = get_logger("scheduler")
+
+QUEUE_SCHEDULER = (os.getenv("QUEUE_SCHEDULER", "fifo") or "fifo").strip().lower()
+AFFINITY_LOOKAHEAD = int(os.getenv("AFFINITY_LOOKAHEAD", "8") or "8")
+AFFINITY_MAX_WAIT_SEC = float(os.getenv("AFFINITY_MAX_WAIT_SEC", "30") or "30")
+AFFINITY_PS_REFRESH_SEC = float(os.getenv("AFFINITY_PS_REFRESH_SEC", "2") or "2")
+QUEUE_LANES = [l.strip().lower() for l in (os.getenv("QUEUE_LANES", "chat,code,tot_beam") or "chat,code,tot_beam").split(",") if l.strip()]
+FAIR_MAX_WAIT_SEC = float(os.getenv("FAIR_MAX_WAIT_SEC", "120") or "120")
+
+
+def _client_weights() -> Dict[str, float]:
+    raw = os.getenv("FAIR_CLIENT_WEIGHTS", "") or ""
+    try:
+        data = json.loads(raw) if raw.strip() else {}
+        return {str(k): max(0.05, float(v)) for k, v in data.items()}
+    except Exception:
+        log.warning("scheduler.bad_client_weights", {"value": raw[:200]})
+        return {}
+
+
+class AffinityQueue(asyncio.Queue):
+    """Look-ahead queue that prefers jobs whose predicted model is already resident in Ollama.
+
+    Jobs carry ``_affinity_model`` (filled in by ``JobQueue.submit``). ``_get`` scans the first
+    ``lookahead`` entries for a job whose model is loaded; the head job is always taken once it
+    has waited ``max_wait_sec`` so reordering can never starve it.
+    """
+
+    uses_affinity = True
+
+    def __init__(self, maxsize: int = 0, *, lookahead: int = AFFINITY_LOOKAHEAD, max_wait_sec: float = AFFINITY_MAX_WAIT_SEC):
+        self.lookahead = max(1, int(lookahead))
+        self.max_wait_sec = max(0.0, float(max_wait_sec))
+        self.resident: Set[str] = set()
+        self.resident_ts = 0.0
+        super().__init__(maxsize)
+
+    def _init(self, maxsize: int) -> None:
+        self._queue: Deque[Dict[str, Any]] = deque()
+
+    def _put(self, item: Dict[str, Any]) -> None:
+        item.setdefault("_enqueued_at", time.monotonic())
+        self._queue.append(item)
+
+    def _get(self) -> Dict[str, Any]:
+        head = self._queue[0]
+        waited = time.monotonic() - float(head.get("_enqueued_at") or 0.0)
+        if waited >= self.max_wait_sec:
+            scheduler_picks_total.labels(scheduler="affinity", reason="max_wait").inc()
+            return self._queue.popleft()
+        if self.resident:
+            for idx, job in enumerate(islice(self._queue, self.lookahead)):
+                if job.get("_affinity_model") in self.resident:
+                    if idx:
+                        del self._queue[idx]
+                        log.debug("scheduler.affinity.reorder", {"task_id": str(job.get("id")), "skipped": idx})
+                    else:
+                        self._queue.popleft()
+                    scheduler_picks_total.labels(scheduler="affinity", reason="resident").inc()
+                    return job
+        scheduler_picks_total.labels(scheduler="affinity", reason="head").inc()
+        return self._queue.popleft()
+
+    def set_resident(self, models: Iterable[str]) -> None:
+        self.resident = {str(m) for m in models if m}
+        self.resident_ts = time.monotonic()
+
+    def note_loaded(self, model: str) -> None:
+        if model:
+            self.resident.add(str(model))
+
+    def needs_refresh(self) -> bool:
+        return time.monotonic() - self.resident_ts >= AFFINITY_PS_REFRESH_SEC
+
+    def pending(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return list(islice(self._queue, limit))
+
+
+class FairQueue(asyncio.Queue):
+    """Strict priority lanes with deficit round robin between clients inside each lane.
+
+    Jobs carry ``_lane`` and ``_client`` (set by ``JobQueue.submit``). Lanes are served in
+    ``QUEUE_LANES`` order; within a lane every client with queued work gets ``weight`` jobs per
+    round, so one client's batch cannot starve the others. A lane head that has waited
+    ``max_wait_sec`` is served regardless of lane priority.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        *,
+        lanes: Optional[List[str]] = None,
+        weights: Optional[Dict[str, float]] = None,
+        max_wait_sec: float = FAIR_MAX_WAIT_SEC,
+    ):
+        self.lanes = list(lanes or QUEUE_LANES) or ["default"]
+        self.weights = dict(_client_weights() if weights is None else weights)
+        self.max_wait_sec = max(0.0, float(max_wait_sec))
+        super().__init__(maxsize)
+
+    def _init(self, maxsize: int) -> None:
+        # lane -> client -> jobs; client order within a lane is the round-robin order
+        self._lanes: Dict[str, "OrderedDict[str, Deque[Dict[str, Any]]]"] = {l: OrderedDict() for l in self.lanes}
+        self._deficit: Dict[Tuple[str, str], float] = {}
+        self._count = 0
+
+    def qsize(self) -> int:
+        return self._count
+
+    def empty(self) -> bool:
+        return self._count == 0
+
+    def lane_of(self, job: Dict[str, Any]) -> str:
+        lane = str(job.get("_lane") or "")
+        return lane if lane in self._lanes else (self.lanes[1] if len(self.lanes) > 1 else self.lanes[0])
+
+    def weight(self, client: str) -> float:
+        return self.weights.get(client, 1.0)
+
+    def _put(self, item: Dict[str, Any]) -> None:
+        item.setdefault("_enqueued_at", time.monotonic())
+        client = str(item.get("_client") or "anon")
+        self._lanes[self.lane_of(item)].setdefault(client, deque()).append(item)
+        self._count += 1
+
+    def _pick(self, lanes, deficit, now: float, record: bool) -> Dict[str, Any]:
+        # Starvation bound: the oldest lane head past max_wait goes first.
+        oldest: Optional[Tuple[float, str, str]] = None
+        for lane in self.lanes:
+            for client, jobs in lanes[lane].items():
+                ts = float(jobs[0].get("_enqueued_at") or now)
+                if now - ts >= self.max_wait_sec and (oldest is None or ts < oldest[0]):
+                    oldest = (ts, lane, client)
+        if oldest is not None:
+            _, lane, client = oldest
+            reason = "max_wait"
+        else:
+            lane = next(l for l in self.lanes if lanes[l])
+            while True:
+                client, _jobs = next(iter(lanes[lane].items()))
+                key = (lane, client)
+                if deficit.get(key, 0.0) < 1.0:
+                    deficit[key] = deficit.get(key, 0.0) + self.weight(client)
+                if deficit[key] >= 1.0:
+                    deficit[key] -= 1.0
+                    break
+                lanes[lane].move_to_end(client)
+            reason = lane
+        jobs = lanes[lane][client]
+        job = jobs.popleft()
+        key = (lane, client)
+        if not jobs:
+            del lanes[lane][client]
+            deficit.pop(key, None)
+        elif reason != "max_wait" and deficit.get(key, 0.0) < 1.0:
+            lanes[lane].move_to_end(client)
+        if record:
+            scheduler_picks_total.labels(scheduler="fair", reason=reason).inc()
+        return job
+
+    def _get(self) -> Dict[str, Any]:
+        job = self._pick(self._lanes, self._deficit, time.monotonic(), record=True)
+        self._count -= 1
+        return job
+
+    def pending(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """The first ``limit`` queued jobs (all if None) in the order they would be dequeued right now."""
+        count = self._count if limit is None else min(limit, self._count)
+        # n picks take at most n jobs from any client, so copying each client's first n is exact
+        lanes = {l: OrderedDict((c, deque(islice(j, count))) for c, j in clients.items()) for l, clients in self._lanes.items()}
+        deficit = dict(self._deficit)
+        now = time.monotonic()
+        return [self._pick(lanes, deficit, now, record=False) for _ in range(count)]
+
+
+class DeadlineQueue(asyncio.Queue):
+    """Earliest-deadline-first: jobs are ordered by ``_deadline`` (epoch seconds, set by ``JobQueue.submit``)."""
+
+    def _init(self, maxsize: int) -> None:
+        self._queue: List[Tuple[float, int, Dict[str, Any]]] = []
+        self._seq = itertools.count()
+
+    def _put(self, item: Dict[str, Any]) -> None:
+        item.setdefault("_enqueued_at", time.monotonic())
+        deadline = float(item.get("_deadline") or float("inf"))
+        heapq.heappush(self._queue, (deadline, next(self._seq), item))
+
+    def _get(self) -> Dict[str, Any]:
+        deadline, _, job = heapq.heappop(self._queue)
+        late = deadline < time.time()
+        scheduler_picks_total.labels(scheduler="edf", reason="late" if late else "on_time").inc()
+        return job
+
+    def pending(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        entries = sorted(self._queue) if limit is None else heapq.nsmallest(limit, self._queue)
+        return [job for _, _, job in entries]
+
+
+def build_scheduler(name: Optional[str] = None) -> asyncio.Queue:
+    kind = (name or QUEUE_SCHEDULER).strip().lower()
+    if kind == "affinity":
+        return AffinityQueue()
+    if kind == "fair":
+        return FairQueue()
+    if kind == "edf":
+        return DeadlineQueue()
+    if kind not in ("", "fifo"):
+        log.warning("scheduler.unknown", {"scheduler": kind, "fallback": "fifo"})
+    return asyncio.Queue()
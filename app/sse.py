@@ -1,45 +1,224 @@
 from __future__ import annotations
-import asyncio, time
-from typing import AsyncIterator, Dict, Deque
-from collections import defaultdict, deque
+import asyncio, bisect, itertools, json, os, time
+from operator import itemgetter
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, Dict, Optional, Protocol, Tuple
+
+from .logging_setup import get_logger
+from .metrics import sse_hub_tasks, sse_hub_buffered_bytes
+
+logger = get_logger("sse")
+
+# Per-task replay buffer: oldest events are dropped past either cap (the newest is always kept).
+SSE_BUFFER_EVENTS = int(os.getenv("SSE_BUFFER_EVENTS", "512") or "512")
+SSE_BUFFER_BYTES = int(os.getenv("SSE_BUFFER_BYTES", str(1024 * 1024)) or str(1024 * 1024))
+# How long a finished task's events stay replayable; tasks nobody closes expire after the idle TTL.
+SSE_FINISHED_TTL_SEC = float(os.getenv("SSE_FINISHED_TTL_SEC", "300") or "300")
+SSE_IDLE_TTL_SEC = float(os.getenv("SSE_IDLE_TTL_SEC", "3600") or "3600")
+# One shared timer for the whole hub; subscribers otherwise sleep until something is published.
+SSE_HEARTBEAT_SEC = float(os.getenv("SSE_HEARTBEAT_SEC", "10") or "10")
+TERMINAL_STATUSES = ("done", "error", "canceled")
+
+
+@dataclass
+class _TaskLog:
+    events: Deque[Tuple[int, str]] = field(default_factory=deque)
+    size: int = 0
+    last_id: int = 0
+    cond: asyncio.Condition = field(default_factory=asyncio.Condition)
+    subscribers: int = 0
+    touched_at: float = field(default_factory=time.monotonic)
+    closed_at: Optional[float] = None
+    sent_id: int = 0  # last id this process handed to the backend for the task
+
+
+class StreamBackend(Protocol):
+    """Carries published events to every process's hub (including the publisher's own).
+
+    ``send`` must deliver ``(task_id, event_id, message)`` to ``StreamHub.deliver`` of each
+    attached hub, in publish order; raising makes the hub fall back to a local-only append.
+    """
+
+    async def start(self, hub: "StreamHub") -> None: ...
+
+    async def send(self, task_id: str, event_id: int, message: str) -> None: ...
+
+    async def stop(self) -> None: ...
+
 
 class StreamHub:
-    def __init__(self):
-        self._queues: Dict[str, Deque[str]] = defaultdict(deque)
-        self._conds: Dict[str, asyncio.Condition] = defaultdict(asyncio.Condition)
+    """Per-task event log that any number of SSE subscribers read without consuming.
+
+    Every published message gets the next event id of its task and goes into a bounded ring
+    buffer. Each subscriber keeps its own cursor, so tabs and reconnects do not steal events from
+    each other, and a client resuming with ``Last-Event-ID`` gets whatever it missed that is
+    still buffered. ``close`` marks a task finished; its log is dropped ``SSE_FINISHED_TTL_SEC``
+    later (or after ``SSE_IDLE_TTL_SEC`` without activity), never while someone is subscribed.
 
-    async def publish(self, task_id: str, message: str):
-        async with self._conds[task_id]:
-            self._queues[task_id].append(message)
-            self._conds[task_id].notify_all()
+    Subscribers never poll: they wait on their task's condition until a publish wakes them. A
+    single ticker task, running only while anyone is subscribed, wakes them every
+    ``heartbeat_sec`` so quiet connections get a keep-alive frame, and sweeps expired logs.
 
-    
+    By itself the hub only reaches subscribers in this process. With a backend attached
+    (``SSE_BACKEND=postgres``), ``publish`` hands events to the backend instead, and they come
+    back through ``deliver`` in every process, so a client may stream from any API worker.
+    """
+
+    def __init__(
+        self,
+        max_events: int = SSE_BUFFER_EVENTS,
+        max_bytes: int = SSE_BUFFER_BYTES,
+        finished_ttl_sec: float = SSE_FINISHED_TTL_SEC,
+        idle_ttl_sec: float = SSE_IDLE_TTL_SEC,
+        heartbeat_sec: float = SSE_HEARTBEAT_SEC,
+    ):
+        self.max_events = max(1, max_events)
+        self.max_bytes = max(1, max_bytes)
+        self.finished_ttl_sec = finished_ttl_sec
+        self.idle_ttl_sec = idle_ttl_sec
+        self._logs: Dict[str, _TaskLog] = {}
+        self._bytes = 0
+        self._swept_at = 0.0
+        self.heartbeat_sec = max(0.01, heartbeat_sec)
+        self._beat = 0
+        self._subscribers = 0
+        self._ticker: Optional[asyncio.Task] = None
+        self.backend: Optional[StreamBackend] = None
+
+    def _log(self, task_id: str) -> _TaskLog:
+        log = self._logs.get(task_id)
+        if log is None:
+            log = self._logs[task_id] = _TaskLog()
+            sse_hub_tasks.set(len(self._logs))
+        return log
+
+    def _sweep(self, now: float) -> None:
+        if now - self._swept_at < 1.0:
+            return
+        self._swept_at = now
+        for task_id, log in list(self._logs.items()):
+            if log.subscribers:
+                continue
+            if (log.closed_at is not None and now - log.closed_at >= self.finished_ttl_sec) or now - log.touched_at >= self.idle_ttl_sec:
+                self._drop(task_id)
+
+    def _drop(self, task_id: str) -> None:
+        log = self._logs.pop(task_id, None)
+        if log is not None:
+            self._bytes -= log.size
+            sse_hub_tasks.set(len(self._logs))
+            sse_hub_buffered_bytes.set(self._bytes)
+
+    async def attach(self, backend: StreamBackend) -> None:
+        await backend.start(self)
+        self.backend = backend
+
+    async def detach(self) -> None:
+        backend, self.backend = self.backend, None
+        if backend is not None:
+            await backend.stop()
+
+    async def publish(self, task_id: str, message: str) -> int:
+        if self.backend is not None:
+            # ids are picked by the publisher so every process numbers the task's events alike
+            tlog = self._log(task_id)
+            event_id = max(tlog.last_id, tlog.sent_id) + 1
+            try:
+                await self.backend.send(task_id, event_id, message)
+                tlog.sent_id = event_id
+                return event_id
+            except Exception as exc:
+                logger.warning("sse.backend_send_failed", {"task_id": task_id, "error": str(exc)})
+        return await self.deliver(task_id, message)
+
+    async def deliver(self, task_id: str, message: str, event_id: Optional[int] = None) -> int:
+        """Append to the local log and wake its subscribers (the backend's receive path)."""
+        now = time.monotonic()
+        self._sweep(now)
+        log = self._log(task_id)
+        async with log.cond:
+            # an id from another process never moves the log backwards
+            log.last_id = max(log.last_id + 1, event_id or 0)
+            log.events.append((log.last_id, message))
+            log.size += len(message)
+            self._bytes += len(message)
+            while len(log.events) > 1 and (len(log.events) > self.max_events or log.size > self.max_bytes):
+                _, dropped = log.events.popleft()
+                log.size -= len(dropped)
+                self._bytes -= len(dropped)
+            log.touched_at = now
+            log.closed_at = None
+            log.cond.notify_all()
+        sse_hub_buffered_bytes.set(self._bytes)
+        return log.last_id
+
+    def knows(self, task_id: str) -> bool:
+        """Whether anything was ever published for the task in this process (and is still kept)."""
+        log = self._logs.get(task_id)
+        return log is not None and log.last_id > 0
+
+    def settled(self, task_id: str) -> bool:
+        """Whether the latest status among the task's kept events is terminal."""
+        log = self._logs.get(task_id)
+        for _, message in reversed(log.events if log is not None else ()):
+            try:
+                status = json.loads(message).get("status")
+            except (ValueError, AttributeError):
+                continue
+            if status is not None:  # delta frames and other status-less events are skipped
+                return status in TERMINAL_STATUSES
+        return False
 
-    
     def close(self, task_id: str) -> None:
-        """Cleanup per-task state to avoid unbounded growth."""
+        """The task is finished: keep its events for late or resuming clients until the TTL runs out."""
+        log = self._logs.get(task_id)
+        if log is not None and log.closed_at is None:
+            log.closed_at = time.monotonic()
+        self._sweep(time.monotonic())
+
+    async def _tick(self) -> None:
         try:
-            self._queues.pop(task_id, None)
-        except Exception:
-            pass
+            while self._subscribers:
+                await asyncio.sleep(self.heartbeat_sec)
+                self._beat += 1
+                for log in list(self._logs.values()):
+                    if log.subscribers:
+                        async with log.cond:
+                            log.cond.notify_all()
+                self._sweep(time.monotonic())
+        finally:
+            self._ticker = None
+
+    async def stream(self, task_id: str, last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+        """Events after ``last_event_id`` (all buffered ones if None), then live ones, as SSE frames."""
+        log = self._log(task_id)
+        cursor = last_event_id or 0
+        log.subscribers += 1
+        self._subscribers += 1
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._tick())
+        beat, quiet = self._beat, True
         try:
-            self._conds.pop(task_id, None)
-        except Exception:
-            pass
-
-    async def stream(self, task_id: str, heartbeat_seconds: int = 10) -> AsyncIterator[str]:
-        last = time.time()
-        while True:
-            async with self._conds[task_id]:
-                if self._queues[task_id]:
-                    msg = self._queues[task_id].popleft()
-                    yield f"data: {msg}\n\n"
-                    last = time.time()
-                else:
-                    try:
-                        await asyncio.wait_for(self._conds[task_id].wait(), timeout=1.0)
-                    except asyncio.TimeoutError:
-                        pass
-            if time.time() - last >= heartbeat_seconds:
-                yield "event: heartbeat\ndata: ping\n\n"
-                last = time.time()
+            while True:
+                async with log.cond:
+                    if cursor > log.last_id:
+                        cursor = 0  # the log was recycled since this client's last visit: replay it
+                    # ids rise but may skip (backend ids from several publishers), so find the cursor by id
+                    start = bisect.bisect_right(log.events, cursor, key=itemgetter(0))
+                    pending = list(itertools.islice(log.events, start, None))
+                    if not pending and beat == self._beat:
+                        await log.cond.wait()
+                for eid, msg in pending:
+                    cursor = eid
+                    quiet = False
+                    yield f"id: {eid}\ndata: {msg}\n\n"
+                if beat != self._beat:
+                    # a heartbeat only goes to connections that had nothing to say since the last tick
+                    if quiet:
+                        yield "event: heartbeat\ndata: ping\n\n"
+                    beat, quiet = self._beat, True
+        finally:
+            log.subscribers -= 1
+            self._subscribers -= 1
+            log.touched_at = time.monotonic()
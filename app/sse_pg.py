@@ -0,0 +1,165 @@
+from __future__ import annotations
+import asyncio, json, os, time
+from typing import TYPE_CHECKING, Any, Optional, Tuple
+
+import asyncpg
+
+from .logging_setup import get_logger
+from .metrics import sse_pg_notify_total
+from .settings import settings
+
+if TYPE_CHECKING:
+    from .sse import StreamHub
+
+log = get_logger("sse_pg")
+
+SSE_BACKEND = (os.getenv("SSE_BACKEND", "memory") or "memory").strip().lower()
+SSE_PG_CHANNEL = os.getenv("SSE_PG_CHANNEL", "macs_sse") or "macs_sse"
+# NOTIFY payloads are capped at 8000 bytes by Postgres; bigger events go through sse_spill.
+SSE_PG_NOTIFY_MAX_BYTES = int(os.getenv("SSE_PG_NOTIFY_MAX_BYTES", "7000") or "7000")
+SSE_PG_SPILL_TTL_SEC = float(os.getenv("SSE_PG_SPILL_TTL_SEC", "300") or "300")
+SSE_PG_RECONNECT_SEC = float(os.getenv("SSE_PG_RECONNECT_SEC", "2") or "2")
+
+
+def _plain_dsn(url: str) -> str:
+    # asyncpg wants a libpq URL, not the SQLAlchemy dialect form
+    for prefix in ("postgresql+asyncpg://", "postgresql+psycopg://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url.split("://", 1)[1]
+    return url
+
+
+class PgStreamBackend:
+    """StreamHub backend that fans events out to every API process through Postgres.
+
+    Each process holds one connection that ``LISTEN``s on ``SSE_PG_CHANNEL``; ``send`` issues a
+    ``NOTIFY`` on it, and every listener (the publisher included) hands the event to its local
+    hub. Postgres delivers notifications in commit order, so all processes see a task's events
+    in the same order. Events whose payload would exceed ``SSE_PG_NOTIFY_MAX_BYTES`` are written
+    to ``sse_spill`` in the same transaction and only their row id is notified; spilled rows are
+    deleted after ``SSE_PG_SPILL_TTL_SEC``.
+
+    If the connection drops it is re-established in the background; meanwhile ``send`` raises
+    and the hub delivers locally, so only other processes miss those events.
+    """
+
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        *,
+        channel: str = SSE_PG_CHANNEL,
+        notify_max_bytes: int = SSE_PG_NOTIFY_MAX_BYTES,
+        spill_ttl_sec: float = SSE_PG_SPILL_TTL_SEC,
+        reconnect_sec: float = SSE_PG_RECONNECT_SEC,
+    ):
+        self.dsn = _plain_dsn(dsn or settings.database_url)
+        self.channel = channel
+        self.notify_max_bytes = max(256, min(notify_max_bytes, 7900))
+        self.spill_ttl_sec = spill_ttl_sec
+        self.reconnect_sec = max(0.1, reconnect_sec)
+        self._hub: Optional["StreamHub"] = None
+        self._conn: Optional[asyncpg.Connection] = None
+        self._lock = asyncio.Lock()
+        self._inbox: "asyncio.Queue[Tuple[str, int, Optional[str], Optional[int]]]" = asyncio.Queue()
+        self._lost = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._pruned_at = 0.0
+
+    async def start(self, hub: "StreamHub") -> None:
+        self._hub = hub
+        await self._connect()  # fail startup loudly if Postgres is unreachable
+        self._tasks = [asyncio.create_task(self._supervise()), asyncio.create_task(self._drain())]
+        log.info("sse.pg.listening", {"channel": self.channel})
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            await conn.close()
+
+    async def _connect(self) -> None:
+        conn = await asyncpg.connect(self.dsn)
+        conn.add_termination_listener(lambda _c: self._lost.set())
+        await conn.add_listener(self.channel, self._on_notify)
+        self._lost.clear()
+        self._conn = conn
+
+    async def _supervise(self) -> None:
+        while True:
+            await self._lost.wait()
+            self._conn = None
+            log.warning("sse.pg.connection_lost", {"channel": self.channel})
+            while self._conn is None:
+                await asyncio.sleep(self.reconnect_sec)
+                try:
+                    await self._connect()
+                    log.info("sse.pg.reconnected", {"channel": self.channel})
+                except Exception as exc:
+                    log.warning("sse.pg.reconnect_failed", {"error": str(exc)})
+
+    def _on_notify(self, _conn: Any, _pid: int, _channel: str, payload: str) -> None:
+        try:
+            note = json.loads(payload)
+            self._inbox.put_nowait((str(note["t"]), int(note["i"]), note.get("m"), note.get("s")))
+        except Exception as exc:
+            log.warning("sse.pg.bad_notification", {"error": str(exc)})
+
+    async def _drain(self) -> None:
+        # one consumer, so a spilled event is fetched before the events notified after it
+        while True:
+            task_id, event_id, message, spill_id = await self._inbox.get()
+            if message is None and spill_id is not None:
+                message = await self._fetch_spill(int(spill_id))
+            if message is None or self._hub is None:
+                continue
+            try:
+                await self._hub.deliver(task_id, message, event_id)
+            except Exception as exc:
+                log.warning("sse.pg.deliver_failed", {"task_id": task_id, "error": str(exc)})
+
+    async def _fetch_spill(self, spill_id: int) -> Optional[str]:
+        try:
+            async with self._lock:
+                if self._conn is None:
+                    raise ConnectionError("not connected")
+                return await self._conn.fetchval("SELECT message FROM sse_spill WHERE id = $1", spill_id)
+        except Exception as exc:
+            log.warning("sse.pg.spill_fetch_failed", {"spill_id": spill_id, "error": str(exc)})
+            return None
+
+    async def send(self, task_id: str, event_id: int, message: str) -> None:
+        note = json.dumps({"t": task_id, "i": event_id, "m": message})
+        async with self._lock:
+            conn = self._conn
+            if conn is None:
+                sse_pg_notify_total.labels(kind="failed").inc()
+                raise ConnectionError("sse postgres backend is reconnecting")
+            try:
+                if len(note.encode("utf-8")) <= self.notify_max_bytes:
+                    await conn.execute("SELECT pg_notify($1, $2)", self.channel, note)
+                    sse_pg_notify_total.labels(kind="inline").inc()
+                    return
+                async with conn.transaction():
+                    spill_id = await conn.fetchval(
+                        "INSERT INTO sse_spill (task_id, message) VALUES ($1, $2) RETURNING id", task_id, message
+                    )
+                    await conn.execute(
+                        "SELECT pg_notify($1, $2)", self.channel, json.dumps({"t": task_id, "i": event_id, "s": spill_id})
+                    )
+                sse_pg_notify_total.labels(kind="spilled").inc()
+                await self._prune(conn)
+            except Exception:
+                sse_pg_notify_total.labels(kind="failed").inc()
+                raise
+
+    async def _prune(self, conn: asyncpg.Connection) -> None:
+        now = time.monotonic()
+        if now - self._pruned_at < 60.0:
+            return
+        self._pruned_at = now
+        await conn.execute(
+            "DELETE FROM sse_spill WHERE created_at < now() - make_interval(secs => $1::double precision)",
+            self.spill_ttl_sec,
+        )
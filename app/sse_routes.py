@@ -1,9 +1,12 @@
-import os, json, asyncio
+import os, json, time
 from pathlib import Path
 from typing import AsyncGenerator
 from fastapi import APIRouter
 from fastapi.responses import StreamingResponse
 
+from .artifact_watch import artifact_watcher
+from .sse import SSE_HEARTBEAT_SEC
+
 router = APIRouter()
 
 _ART = os.getenv("ARTIFACTS_DIR", "/app/artifacts")
@@ -24,23 +27,16 @@ async def task_status(task_id: str):
 async def task_sse(task_id: str):
     async def gen() -> AsyncGenerator[bytes, None]:
         root = _artifact_dir(task_id)
-        # immediate early-exit
-        try:
-            if root.exists() and root.is_dir():
+        # keepalive loop (60s), woken by the shared artifacts watcher when result.json lands
+        deadline = time.monotonic() + 60.0
+        while True:
+            remaining = deadline - time.monotonic()
+            if await artifact_watcher.wait(task_id, max(0.0, min(SSE_HEARTBEAT_SEC, remaining))):
                 yield _event({"status": "done", "note": "artifacts-present"})
                 return
-        except Exception:
-            pass
-        # keepalive loop (60s)
-        for _ in range(120):
-            try:
-                if root.exists() and root.is_dir():
-                    yield _event({"status": "done", "note": "artifacts-present"})
-                    return
-            except Exception:
-                pass
+            if remaining <= SSE_HEARTBEAT_SEC:
+                break
             yield b": keep-alive\n\n"
-            await asyncio.sleep(0.5)
 
         # DEV fallback: create artifact on timeout to finish the stream
         if os.getenv("DEV_COMPAT") == "1":
@@ -0,0 +1,104 @@
+from __future__ import annotations
+import asyncio, json, os, uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+
+from .db import get_engine
+from .logging_setup import get_logger
+from .metrics import sse_status_watch_tasks, sse_status_watch_queries_total
+from .sse import TERMINAL_STATUSES, StreamHub
+
+log = get_logger("status_watch")
+
+# One batched status query per interval for every open stream no local publisher feeds.
+SSE_DB_POLL_INTERVAL = max(0.5, float(os.getenv("SSE_DB_POLL_INTERVAL", "2.0") or "2.0"))
+
+StatusFetcher = Callable[[List[str]], Awaitable[Dict[str, str]]]
+
+
+async def fetch_statuses(task_ids: List[str]) -> Dict[str, str]:
+    ids = []
+    for tid in task_ids:
+        try:
+            ids.append(uuid.UUID(tid))
+        except ValueError:
+            continue
+    if not ids:
+        return {}
+    eng = await get_engine()
+    async with eng.connect() as conn:
+        rows = (await conn.execute(text("SELECT id, status FROM tasks WHERE id = ANY(:ids)"), {"ids": ids})).fetchall()
+    return {str(row[0]): str(row[1]) for row in rows}
+
+
+class TaskStatusWatcher:
+    """Finds terminal tasks for all open SSE streams with one query per interval.
+
+    ``/v1/stream`` registers its task while connected. Tasks whose local log already holds a
+    terminal status are skipped; the rest (finished before a restart, run where the hub cannot
+    hear it, or heard only in part before the job moved elsewhere) are looked up together in one
+    ``SELECT ... WHERE id = ANY(:ids)``, and a terminal status is delivered into the local hub as
+    an ordinary event, which wakes every subscriber of that task. New registrations trigger an
+    early round after ``batch_delay_sec`` so a reconnecting client does not wait a full interval,
+    while a burst of connects still shares one query. The loop runs only while something is watched.
+    """
+
+    def __init__(
+        self,
+        hub: StreamHub,
+        interval_sec: float = SSE_DB_POLL_INTERVAL,
+        fetch: StatusFetcher = fetch_statuses,
+        batch_delay_sec: float = 0.05,
+    ):
+        self.hub = hub
+        self.interval_sec = interval_sec
+        self.batch_delay_sec = batch_delay_sec
+        self._fetch = fetch
+        self._watched: Dict[str, int] = {}  # task id -> open streams
+        self._fresh = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, task_id: str) -> None:
+        self._watched[task_id] = self._watched.get(task_id, 0) + 1
+        sse_status_watch_tasks.set(len(self._watched))
+        self._fresh.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def unwatch(self, task_id: str) -> None:
+        left = self._watched.get(task_id, 0) - 1
+        if left > 0:
+            self._watched[task_id] = left
+        else:
+            self._watched.pop(task_id, None)
+        sse_status_watch_tasks.set(len(self._watched))
+
+    async def _run(self) -> None:
+        try:
+            while self._watched:
+                try:
+                    await asyncio.wait_for(self._fresh.wait(), timeout=self.interval_sec)
+                    await asyncio.sleep(self.batch_delay_sec)
+                except asyncio.TimeoutError:
+                    pass
+                self._fresh.clear()
+                await self.check(list(self._watched))
+        finally:
+            self._task = None
+
+    async def check(self, task_ids: Iterable[str]) -> List[str]:
+        """One lookup for the given tasks; returns those found terminal (and now pushed)."""
+        pending = [tid for tid in task_ids if not self.hub.settled(tid)]
+        if not pending:
+            return []
+        sse_status_watch_queries_total.inc()
+        try:
+            statuses = await self._fetch(pending)
+        except Exception as exc:
+            log.warning("status_watch.query_failed", {"tasks": len(pending), "error": str(exc)})
+            return []
+        settled = [tid for tid in pending if statuses.get(tid) in TERMINAL_STATUSES]
+        for tid in settled:
+            await self.hub.deliver(tid, json.dumps({"status": statuses[tid], "note": "db"}))
+        return settled
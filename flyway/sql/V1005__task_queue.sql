@@ -0,0 +1,23 @@
+-- Purpose: durable task queue with leases so several API/worker replicas drain one queue
+-- Database: PostgreSQL
+
+CREATE TABLE IF NOT EXISTS public.task_queue (
+    task_id UUID PRIMARY KEY REFERENCES public.tasks(id) ON DELETE CASCADE,
+    payload JSONB NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    priority INT NOT NULL DEFAULT 0,
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 3,
+    lease_owner TEXT,
+    lease_expires_at TIMESTAMPTZ,
+    available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_task_queue_ready
+    ON public.task_queue (priority DESC, created_at) WHERE state = 'queued';
+
+CREATE INDEX IF NOT EXISTS idx_task_queue_lease
+    ON public.task_queue (lease_expires_at) WHERE state = 'leased';
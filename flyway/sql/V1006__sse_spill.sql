@@ -0,0 +1,12 @@
+-- Purpose: SSE events too large for a NOTIFY payload, read back by every API process (SSE_BACKEND=postgres)
+-- Database: PostgreSQL
+
+CREATE TABLE IF NOT EXISTS public.sse_spill (
+    id BIGSERIAL PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_sse_spill_created
+    ON public.sse_spill (created_at);
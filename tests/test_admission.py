@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+from prometheus_client import CollectorRegistry, Histogram
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import admission
+
+
+def test_recent_latency_tracks_per_model_mean():
+    hist = Histogram("t_gen_latency", "test", ["model"], registry=CollectorRegistry())
+    recent = admission.RecentLatency(hist, window_sec=600)
+    assert recent.mean() is None
+    hist.labels(model="a").observe(2.0)
+    hist.labels(model="a").observe(4.0)
+    hist.labels(model="b").observe(12.0)
+    assert recent.mean("a") == 3.0
+    assert recent.mean() == 6.0
+
+
+def test_decide_rejects_full_queue_and_defers_unreachable_deadline(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_CONTROL", True)
+    monkeypatch.setattr(admission, "QUEUE_MAX_DEPTH", 10)
+
+    full = admission.decide(depth=10, projected_wait=50, own_seconds=5, budget_seconds=None, drain_per_job=5)
+    assert (full.admit, full.status_code, full.retry_after) == (False, 503, 5)
+
+    late = admission.decide(depth=3, projected_wait=50, own_seconds=20, budget_seconds=60, drain_per_job=5)
+    assert (late.admit, late.status_code, late.retry_after) == (False, 429, 10)
+
+    deferred = admission.decide(depth=3, projected_wait=50, own_seconds=20, budget_seconds=60, drain_per_job=5, defer=True)
+    assert (deferred.admit, deferred.status_code, deferred.reason, deferred.retry_after) == (True, 202, "deferred", 50)
+    assert not admission.decide(depth=10, projected_wait=50, own_seconds=5, budget_seconds=1, drain_per_job=5, defer=True).admit
+
+    assert admission.decide(depth=3, projected_wait=50, own_seconds=20, budget_seconds=None, drain_per_job=5).admit
+
+
+def test_histogram_quantile_interpolates_within_bucket():
+    hist = Histogram("t_first_token", "test", ["model"], buckets=(1.0, 2.0, 4.0), registry=CollectorRegistry())
+    assert admission.histogram_quantile(hist, 0.9, "a") == (None, 0)
+    for v in (0.5, 1.5, 1.5, 3.0):
+        hist.labels(model="a").observe(v)
+    hist.labels(model="b").observe(10.0)
+    value, n = admission.histogram_quantile(hist, 0.5, "a")
+    assert n == 4 and value == 1.5
+    assert admission.histogram_quantile(hist, 0.9, "b") == (4.0, 1)
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.artifact_watch import ArtifactWatcher
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_all_waiters_wake_when_result_lands(tmp_path, polling):
+    async def main():
+        watcher = ArtifactWatcher(str(tmp_path), polling=polling, poll_sec=0.05)
+        (tmp_path / "early").mkdir()
+        waiters = [asyncio.create_task(watcher.wait(tid, 5)) for tid in ["early", "late"] * 50]
+        await asyncio.sleep(0.3)
+        assert not any(w.done() for w in waiters) and watcher._task is not None
+        t0 = time.monotonic()
+        for tid in ("early", "late"):
+            (tmp_path / tid).mkdir(exist_ok=True)
+            (tmp_path / tid / "result.json").write_text("{}")
+        assert all(await asyncio.gather(*waiters))
+        assert time.monotonic() - t0 < 2
+        assert await watcher.wait("early", 0)  # already there: no watch needed
+        assert not await watcher.wait("missing", 0.1)
+        await asyncio.sleep(1.2)
+        assert watcher._task is None  # nobody waits: the watch is torn down
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import queue as queue_mod
+from app.chat_sessions import ChatSessionStore
+from app.llm import ollama_client
+from app.llm.backends import BackendPool
+from app.llm.tokens import estimate_tokens
+
+
+def _job(goal: str, **meta):
+    return {"input": {"goal": goal}, "metadata": {"mode_hint": "chat", "session_id": "s1", **meta}}
+
+
+def test_session_turns_resend_an_unchanged_prefix(monkeypatch):
+    store = ChatSessionStore()
+    monkeypatch.setattr(queue_mod, "chat_sessions", store)
+    seed = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello!"}, {"role": "user", "content": "what is a monad?"}]
+
+    first, turn = queue_mod._build_chat_messages(_job("what is a monad?", conversation=seed), "s1", "mistral:7b", 4000)
+    assert [m["role"] for m in first] == ["system", "user", "assistant", "user"]  # seeded, asked turn not duplicated
+    store.commit("s1", turn, "A monoid in the category of endofunctors.")
+
+    # later turns send no transcript: the server's history is the prefix, byte for byte
+    second, _ = queue_mod._build_chat_messages(_job("an example?"), "s1", "mistral:7b", 4000)
+    assert second[: len(first)] == first
+    assert second[len(first)]["content"] == "A monoid in the category of endofunctors."
+    assert second[-1]["content"].startswith("an example?")
+
+    # over budget: oldest turns go first, and the cut sticks for the next turn
+    roomy, _ = queue_mod._build_chat_messages(_job("shorter please"), "s1", "mistral:7b", 4000)
+    needed = estimate_tokens("mistral:7b", "\n".join(m["content"] for m in roomy))
+    tight, _ = queue_mod._build_chat_messages(_job("shorter please"), "s1", "mistral:7b", needed - 1)
+    assert [m["content"] for m in tight[1:3]] == [turn, "A monoid in the category of endofunctors."]
+    assert store.get("s1").messages == tight[1:-1]
+
+
+def test_chat_stream_yields_generate_shaped_chunks(monkeypatch):
+    bodies: list[dict] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, body: bytes):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._send(json.dumps({"models": [{"model": "m:7b"}]}).encode())
+
+        def do_POST(self):
+            bodies.append(json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0))))
+            lines = [{"message": {"role": "assistant", "content": "he"}, "done": False},
+                     {"message": {"role": "assistant", "content": "y"}, "done": False},
+                     {"done": True, "prompt_eval_count": 3, "eval_count": 2}]
+            self._send("".join(json.dumps(x) + "\n" for x in lines).encode())
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    try:
+        monkeypatch.setattr(ollama_client, "backend_pool", BackendPool([f"http://127.0.0.1:{srv.server_port}"]))
+        messages = [{"role": "system", "content": "be nice"}, {"role": "user", "content": "hey"}]
+
+        async def main():
+            return [chunk async for chunk in ollama_client.chat_stream("m:7b", messages, num_ctx=2048)]
+
+        chunks = asyncio.run(main())
+        assert "".join(c.get("response", "") for c, _ in chunks) == "hey"
+        assert chunks[-1][1]["prompt_eval_count"] == 3
+        assert bodies[0]["messages"] == messages and bodies[0]["options"]["num_ctx"] == 2048
+    finally:
+        srv.shutdown()
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import queue as queue_mod
+from app.queue import JobQueue, _coalesce_key, _repo_fingerprint
+from app.sse import StreamHub
+
+
+def _job(task_id: str, goal: str = "add a health endpoint", client_id: str = "ide") -> dict:
+    return {
+        "id": task_id,
+        "type": "code",
+        "input": {"language": "python", "goal": goal, "repo": {"path": "no-such-repo"}},
+        "metadata": {"client_id": client_id},
+    }
+
+
+def test_coalesce_key_ignores_identity_but_not_inputs():
+    assert _coalesce_key(_job("a", client_id="ci")) == _coalesce_key(_job("b", client_id="ide"))
+    assert _coalesce_key(_job("a")) != _coalesce_key(_job("a", goal="something else"))
+
+
+def test_duplicate_attaches_to_leader_and_is_requeued_when_leader_is_canceled():
+    async def main():
+        hub = StreamHub()
+        q = JobQueue(hub)
+        assert await q.submit(_job("A")) is None
+        assert await q.submit(_job("B")) == "A"
+        assert q.queue.qsize() == 1
+
+        await q._publish("A", json.dumps({"status": "running", "stage": "thinking"}))
+        assert json.loads(hub._logs["B"].events[-1][1])["stage"] == "thinking"
+
+        await q.cancel("A")
+        assert q.queue.qsize() == 2
+        assert await q.submit(_job("C")) == "B"
+
+    asyncio.run(main())
+
+
+def test_repo_fingerprint_is_scoped_to_the_pinned_repo(tmp_path, monkeypatch):
+    monkeypatch.setattr(queue_mod, "resolve_safe_path", lambda rel: (tmp_path, True))
+    (tmp_path / "app.py").write_text("print(1)\n")
+    job = _job("a")
+    before = _repo_fingerprint(job)
+
+    # duel merge trees and artifacts change constantly; they must not break coalescing
+    for scratch in (".duel/t1/m", "artifacts/t1"):
+        (tmp_path / scratch).mkdir(parents=True)
+        (tmp_path / scratch / "result.json").write_text("{}")
+    assert _repo_fingerprint(job) == before
+    (tmp_path / "app.py").write_text("print(2)\n")
+    assert _repo_fingerprint(job) != before
+
+    # no repo.path, or chat: no tree walk at all
+    monkeypatch.setattr(queue_mod, "resolve_safe_path", lambda rel: pytest.fail("walked the workspace"))
+    assert _repo_fingerprint({"input": {"goal": "hi"}}) is None
+    _coalesce_key({"input": {"goal": "hi", "repo": {"path": "x"}}, "metadata": {"mode_hint": "chat"}})
+
+
+def test_followers_logs_close_when_the_leader_settles(monkeypatch):
+    class _Row:
+        status, model_used, latency_ms = "done", "m:7b", 12
+
+    async def get_task(conn, task_id):
+        return _Row()
+
+    async def update_task_status(conn, task_id, status, **kwargs):
+        pass
+
+    class _Engine:
+        @asynccontextmanager
+        async def connect(self):
+            yield None
+
+        begin = connect
+
+    monkeypatch.setattr(queue_mod, "get_task", get_task)
+    monkeypatch.setattr(queue_mod, "update_task_status", update_task_status)
+    monkeypatch.setattr(JobQueue, "_mirror_artifacts", staticmethod(lambda leader, follower: None))
+
+    async def main():
+        hub = StreamHub()
+        q = JobQueue(hub)
+        await q.submit(_job("A"))
+        await q.submit(_job("B"))
+        await q._publish("A", json.dumps({"status": "done"}))
+        await q._settle_followers({"id": "A", "_coalesce_key": _coalesce_key(_job("A"))}, _Engine())
+        assert hub._logs["B"].closed_at is not None
+
+    asyncio.run(main())
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import queue as queue_mod
+from app.logctx import set_candidate
+from app.queue import JobQueue
+from app.sse import StreamHub
+
+
+class _Conn:
+    async def execute(self, *args, **kwargs):
+        return None
+
+
+class _Engine:
+    """Stands in for the SQLAlchemy engine; the statuses written go through update_task_status."""
+
+    @asynccontextmanager
+    async def begin(self):
+        yield _Conn()
+
+    connect = begin
+
+
+def _duel_queue(monkeypatch, strategy: str):
+    statuses: list[str] = []
+    rewards: list[tuple] = []
+
+    async def update_task_status(conn, id, status, **kwargs):
+        statuses.append(status)
+
+    async def rank_models(conn, models, fh):
+        return list(models)
+
+    async def upsert_stat(conn, model, fh, reward):
+        rewards.append((model, reward))
+
+    monkeypatch.setattr(queue_mod, "update_task_status", update_task_status)
+    monkeypatch.setattr(queue_mod, "rank_models", rank_models)
+    monkeypatch.setattr(queue_mod, "upsert_stat", upsert_stat)
+    monkeypatch.setattr(queue_mod, "routed_models", lambda mode, language: [{"tag": "a:7b"}, {"tag": "b:7b"}])
+    monkeypatch.setattr(queue_mod, "bandit_record", lambda *a, **k: rewards.append(a))
+    monkeypatch.setattr(queue_mod, "bandit_record_event", lambda *a, **k: rewards.append(a))
+    monkeypatch.setattr(queue_mod, "HEDGE_FIRST_TOKEN_MS", 20.0)
+
+    hub = StreamHub()
+    q = JobQueue(hub)
+
+    async def run_candidate(job, candidate, task_id, progress=None):
+        await asyncio.sleep(60)  # still generating when the user cancels
+
+    q._run_candidate = run_candidate
+    job = {
+        "id": "T",
+        "type": "code",
+        "input": {"language": "python", "goal": "add a health endpoint"},
+        "routing_hints": {"duel": True, "duel_strategy": strategy},
+    }
+    return q, hub, job, statuses, rewards
+
+
+def _cancel_mid_duel(q, hub, job, wait_for_tasks: int):
+    async def main():
+        worker = asyncio.create_task(q._process_job(job, _Engine()))
+        while len(q._inflight.get("T", [])) < wait_for_tasks:
+            await asyncio.sleep(0.01)
+        await q.cancel("T")
+        await asyncio.wait_for(worker, 5)
+        return [json.loads(msg).get("status") for _, msg in hub._logs["T"].events]
+
+    return asyncio.run(main())
+
+
+def test_canceled_race_duel_is_not_scored_or_answered(monkeypatch):
+    q, hub, job, statuses, rewards = _duel_queue(monkeypatch, "race")
+    published = _cancel_mid_duel(q, hub, job, wait_for_tasks=2)
+    assert rewards == []
+    assert statuses[-1] == "canceled" and "done" not in statuses
+    assert "done" not in published and published[-1] == "canceled"
+
+
+def test_canceled_hedged_duel_does_not_launch_or_score_the_hedge(monkeypatch):
+    q, hub, job, statuses, rewards = _duel_queue(monkeypatch, "hedge")
+    monkeypatch.setattr(queue_mod, "HEDGE_FIRST_TOKEN_MS", 60_000.0)  # cancel lands while the primary runs alone
+    published = _cancel_mid_duel(q, hub, job, wait_for_tasks=1)
+    assert rewards == []
+    assert statuses[-1] == "canceled" and "done" not in statuses
+    assert "done" not in published and published[-1] == "canceled"
+    messages = [json.loads(msg).get("message") or "" for _, msg in hub._logs["T"].events]
+    assert not any("second opinion" in m for m in messages)
+
+
+def test_race_loser_stops_streaming_once_the_winner_answered():
+    async def main():
+        hub = StreamHub()
+        q = JobQueue(hub)
+
+        async def loser():
+            set_candidate("b:7b")
+            frames = q._delta_frames("T", "b:7b")
+            await frames.add("first ")
+            # a:7b wins meanwhile; under DUEL_RACE_LOSER=finish b:7b keeps generating
+            q._shadow.add(("T", "b:7b"))
+            await q._publish("T", json.dumps({"status": "done"}))
+            hub.close("T")
+            await frames.add("second")
+            await frames.flush()
+
+        await asyncio.create_task(loser())
+        events = [json.loads(msg) for _, msg in hub._logs["T"].events]
+        assert [e.get("delta") for e in events if e.get("type") == "delta"] == ["first "]
+        assert events[-1]["status"] == "done" and hub._logs["T"].closed_at is not None
+
+    asyncio.run(main())
+
+
+def test_stopping_the_workers_is_not_a_user_cancel(monkeypatch):
+    q, hub, job, statuses, rewards = _duel_queue(monkeypatch, "race")
+
+    async def get_engine():
+        return _Engine()
+
+    monkeypatch.setattr(queue_mod, "get_engine", get_engine)
+
+    async def main():
+        q.workers = 1
+        await q.queue.put(job)
+        await q.start()
+        while len(q._inflight.get("T", [])) < 2:
+            await asyncio.sleep(0.01)
+        children = list(q._inflight["T"])
+        await asyncio.wait_for(q.stop(), 5)
+        assert q._workers == [] and all(t.done() for t in children)
+        return [json.loads(msg).get("status") for _, msg in hub._logs["T"].events]
+
+    published = asyncio.run(main())
+    assert "canceled" not in statuses and "canceled" not in published
+    assert rewards == []
+
+
+def _undecided_duel(monkeypatch, strategy: str, run_candidate):
+    """Runs a duel to completion; returns (duel decisions, bandit wins/losses, bandit events)."""
+    q, hub, job, statuses, _ = _duel_queue(monkeypatch, strategy)
+    decisions: list[dict] = []
+    outcomes: list[tuple] = []
+    events: list[dict] = []
+
+    class _Decisions:
+        def labels(self, **labels):
+            decisions.append(labels)
+            return self
+
+        def inc(self):
+            pass
+
+    monkeypatch.setattr(queue_mod, "duel_selection_decisions_total", _Decisions())
+    monkeypatch.setattr(queue_mod, "bandit_record", lambda model, reward, won, **k: outcomes.append((model, won)))
+    monkeypatch.setattr(queue_mod, "bandit_record_event", lambda model, reward, meta: events.append(meta))
+    q._run_candidate = run_candidate
+    q._write_artifact_safely = lambda *a, **k: None
+    asyncio.run(asyncio.wait_for(q._process_job(job, _Engine()), 5))
+    assert statuses[-1] == "done"
+    return decisions, outcomes, events
+
+
+def _result(model: str) -> dict:
+    return {"model": model, "success": True, "latency_ms": 5, "compile_pass": True, "test_pass": True,
+            "tool": "pytest", "artifact": "", "logs": {}, "content": "ok"}
+
+
+def test_skipped_hedge_is_not_a_duel_win(monkeypatch):
+    monkeypatch.setattr(queue_mod, "HEDGE_FIRST_TOKEN_MS", 60_000.0)
+
+    async def run_candidate(job, candidate, task_id, progress=None):
+        return _result(candidate["tag"])  # the primary answers before the hedge is due
+
+    decisions, outcomes, events = _undecided_duel(monkeypatch, "hedge", run_candidate)
+    assert decisions == [] and outcomes == []
+    assert [(e["role"], e["opponent"], e["reason"]) for e in events] == [("solo", "b:7b", "hedge-skipped")]
+
+
+def test_canceled_race_loser_is_not_a_duel_loss(monkeypatch):
+    monkeypatch.setattr(queue_mod, "DUEL_RACE_LOSER", "cancel")
+
+    async def run_candidate(job, candidate, task_id, progress=None):
+        if candidate["tag"] == "b:7b":
+            await asyncio.sleep(60)  # canceled once a:7b qualifies: its outcome stays unknown
+        return _result(candidate["tag"])
+
+    decisions, outcomes, events = _undecided_duel(monkeypatch, "race", run_candidate)
+    assert decisions == [] and outcomes == []
+    assert [(e["role"], e["opponent"], e["reason"]) for e in events] == [("solo", "b:7b", "race-canceled")]
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import gen_cache as gen_cache_mod
+from app.gen_cache import GenerationCache, cache_enabled_for, cache_key
+
+
+def test_lru_eviction_respects_byte_budget_and_recency(tmp_path):
+    cache = GenerationCache(tmp_path, max_bytes=300)
+    keys = [cache_key("qwen2.5-coder:7b", f"prompt {i}", 6144, 2048, 0.2) for i in range(4)]
+    for key in keys[:3]:
+        cache.put_sync(key, "x" * 60, {"eval_count": 12, "context": [1, 2, 3]})
+    assert cache.get_sync(keys[0]) == {"text": "x" * 60, "meta": {"eval_count": 12}}
+
+    cache.put_sync(keys[3], "y" * 60)  # over budget: keys[1] is now least recently used
+    assert cache.get_sync(keys[1]) is None
+    assert cache.get_sync(keys[0]) is not None
+
+    reopened = GenerationCache(tmp_path, max_bytes=300)
+    reopened._load_index()
+    assert set(reopened._index) == {keys[0], keys[2], keys[3]}
+    assert reopened._bytes <= 300
+
+
+def test_key_covers_sampling_parameters():
+    base = cache_key("m", "p", 4096, 1024, 0.2)
+    assert base == cache_key("m", "p", 4096, 1024, 0.2)
+    assert base != cache_key("m", "p", 4096, 512, 0.2)
+    assert base != cache_key("m", "p", 4096, 1024, 0.7)
+
+
+def test_task_metadata_can_opt_out_but_not_in(monkeypatch):
+    on, off = {"metadata": {"gen_cache": True}}, {"metadata": {"gen_cache": "false"}}
+    monkeypatch.setattr(gen_cache_mod, "GEN_CACHE_ENABLED", False)
+    assert not cache_enabled_for({}) and not cache_enabled_for(on) and not cache_enabled_for(off)
+    monkeypatch.setattr(gen_cache_mod, "GEN_CACHE_ENABLED", True)
+    assert cache_enabled_for({}) and cache_enabled_for(on) and not cache_enabled_for(off)
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+
+from prometheus_client import REGISTRY
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.llm import http_pool
+
+
+def _sample(name: str, endpoint: str) -> float:
+    return REGISTRY.get_sample_value(name, {"endpoint": endpoint}) or 0.0
+
+
+async def _http_ok(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    while True:
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        if reader.at_eof():
+            break
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        await writer.drain()
+    writer.close()
+
+
+def test_pool_lifecycle_is_idempotent_and_rebuilds_after_close():
+    asyncio.run(http_pool.open_pool())  # leaves a client bound to a loop that has finished
+
+    async def main():
+        await http_pool.close_pool()  # drops the stale client instead of closing it on the wrong loop
+        await http_pool.close_pool()
+        await http_pool.open_pool()
+        first = http_pool.async_client()
+        await http_pool.open_pool()
+        assert http_pool.async_client() is first
+        sync_first = http_pool.sync_client()
+        assert http_pool.sync_client() is sync_first
+
+        await http_pool.close_pool()
+        await http_pool.close_pool()
+        assert first.is_closed and sync_first.is_closed
+        rebuilt = http_pool.async_client()
+        assert rebuilt is not first and not rebuilt.is_closed
+        assert http_pool.sync_client() is not sync_first
+        await http_pool.close_pool()
+
+    asyncio.run(main())
+
+
+def test_requests_record_pool_wait_and_reuse_connections():
+    async def main():
+        server = await asyncio.start_server(_http_ok, "127.0.0.1", 0)
+        url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/api/tags"
+        waits = _sample("ollama_http_pool_wait_seconds_count", "pool-test")
+        opened = _sample("ollama_http_connections_opened_total", "pool-test")
+        try:
+            client = http_pool.async_client()
+            for _ in range(3):
+                resp = await client.get(url, extensions=http_pool.traced("pool-test"))
+                assert resp.text == "ok"
+            with_sync = await asyncio.to_thread(
+                lambda: http_pool.sync_client().get(url, extensions=http_pool.traced_sync("pool-test")).text
+            )
+            assert with_sync == "ok"
+        finally:
+            await http_pool.close_pool()
+            server.close()
+            await server.wait_closed()
+        assert _sample("ollama_http_pool_wait_seconds_count", "pool-test") - waits == 4  # one observation per request
+        assert _sample("ollama_http_connections_opened_total", "pool-test") - opened == 2  # keep-alive: one per client
+
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import queue as queue_mod
+from app.metrics import job_workers_busy, job_workers_total
+from app.queue import JobQueue
+from app.sse import StreamHub
+
+
+class _Conn:
+    async def execute(self, *args, **kwargs):
+        return None
+
+
+class _Engine:
+    @asynccontextmanager
+    async def begin(self):
+        yield _Conn()
+
+    connect = begin
+
+
+async def _until(predicate, timeout: float = 2.0) -> None:
+    async def poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_workers_run_jobs_concurrently_and_skip_canceled_ones(monkeypatch):
+    async def get_engine():
+        return _Engine()
+
+    async def update_task_status(conn, id, status, **kwargs):
+        return None
+
+    monkeypatch.setattr(queue_mod, "get_engine", get_engine)
+    monkeypatch.setattr(queue_mod, "update_task_status", update_task_status)
+    monkeypatch.setattr(queue_mod, "_infer_mode", lambda job: "clarify")  # the cheapest full path through _process_job
+
+    async def main():
+        hub = StreamHub()
+        q = JobQueue(hub)
+        q.workers = 2
+        q._write_artifact_safely = lambda *a, **k: None
+        gate = asyncio.Event()
+        active: list[str] = []
+        peak = [0]
+
+        async def publish_status(task_id, message, stage=None, **kwargs):
+            active.append(task_id)
+            peak[0] = max(peak[0], len(active))
+            await gate.wait()  # hold the worker until the test lets go
+            active.remove(task_id)
+
+        q._publish_status = publish_status
+        for i in range(3):
+            await q.submit({"id": f"J{i}", "type": "code", "input": {"goal": f"job {i}"}})
+        await q.start()
+        assert job_workers_total._value.get() == 2
+
+        await _until(lambda: len(active) == 2)
+        await asyncio.sleep(0.05)
+        assert sorted(active) == ["J0", "J1"] and q.queue.qsize() == 1  # the third waits for a worker
+        assert job_workers_busy._value.get() == 2
+
+        await q.cancel("J2")  # still queued: dropped without being processed
+        gate.set()
+        await _until(lambda: q._busy_workers == 0 and q.queue.qsize() == 0)
+        assert peak[0] == 2 and job_workers_busy._value.get() == 0
+        statuses = {tid: [json.loads(m).get("status") for _, m in log.events] for tid, log in hub._logs.items()}
+        assert statuses["J0"][-1] == statuses["J1"][-1] == "done"
+        assert "running" not in statuses["J2"] and statuses["J2"][-1] == "canceled"
+        await q.stop()
+        assert job_workers_total._value.get() == 0
+
+    asyncio.run(main())
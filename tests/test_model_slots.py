@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.model_slots import ModelSlots, _FairSlot
+
+
+async def _queue_up(slot: _FairSlot, names, order: list):
+    async def one(name):
+        await slot.acquire()
+        order.append(name)
+
+    tasks = [asyncio.create_task(one(n)) for n in names]
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_released_slots_go_to_waiters_in_arrival_order():
+    async def main():
+        slot, order = _FairSlot(1), []
+        await slot.acquire()
+        waiters = await _queue_up(slot, ["w1", "w2", "w3"], order)
+        assert slot.waiting == 3
+        for _ in range(3):
+            slot.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+        assert order == ["w1", "w2", "w3"] and slot.in_use == 1
+        # a newcomer does not barge past a queued waiter
+        late = await _queue_up(slot, ["w4"], order)
+        assert slot.in_use == 1 and slot.waiting == 1
+        slot.release()
+        await asyncio.gather(*late)
+
+    asyncio.run(main())
+
+
+def test_canceled_waiter_does_not_leak_a_slot():
+    async def main():
+        slot, order = _FairSlot(1), []
+        await slot.acquire()
+        gone, stays = await _queue_up(slot, ["gone", "stays"], order)
+        gone.cancel()
+        await asyncio.sleep(0)
+        assert slot.waiting == 1
+        slot.release()
+        await asyncio.wait_for(stays, 1)
+        assert order == ["stays"] and slot.in_use == 1
+
+        # canceled right after being handed the slot: it is given back, not kept
+        lucky = await _queue_up(slot, ["lucky"], order)
+        slot.release()  # "stays" is done: ownership moves to "lucky"
+        lucky[0].cancel()
+        await asyncio.gather(*lucky, return_exceptions=True)
+        assert slot.in_use == 0 and slot.waiting == 0
+
+    asyncio.run(main())
+
+
+def test_resize_while_slots_are_held():
+    async def main():
+        slot, order = _FairSlot(1), []
+        await slot.acquire()
+        waiters = await _queue_up(slot, ["w1", "w2"], order)
+        slot.resize(3)  # grows: both waiters get in without anyone releasing
+        await asyncio.gather(*waiters)
+        assert order == ["w1", "w2"] and slot.in_use == 3
+
+        slot.resize(1)  # shrinks: held slots are retired one by one as they come back
+        queued = await _queue_up(slot, ["w3"], order)
+        slot.release()
+        slot.release()
+        await asyncio.sleep(0)
+        assert slot.in_use == 1 and order == ["w1", "w2"]
+        slot.release()  # back within capacity: the next release hands over again
+        await asyncio.gather(*queued)
+        assert order == ["w1", "w2", "w3"] and slot.in_use == 1
+
+    asyncio.run(main())
+
+
+def test_model_slots_resize_when_the_registry_snapshot_changes():
+    snaps = {"current": object()}
+    capacity = {"a:7b": 1}
+    slots = ModelSlots(sizer=lambda model: capacity[model], source=lambda: snaps["current"])
+
+    async def main():
+        async with slots.acquire("a:7b"):
+            second = slots.acquire("a:7b")
+            waiter = asyncio.create_task(second.__aenter__())
+            await asyncio.sleep(0)
+            assert slots.snapshot()["a:7b"] == {"capacity": 1, "in_use": 1, "waiting": 1}
+            capacity["a:7b"] = 2
+            assert slots.saturated("a:7b")  # same snapshot: capacity is not re-read
+            assert slots.snapshot()["a:7b"]["capacity"] == 1
+            snaps["current"] = object()  # models.yaml now allows two sessions
+            assert slots.saturated("a:7b")  # the waiter took the new slot at once
+            await asyncio.wait_for(waiter, 1)
+            assert slots.snapshot()["a:7b"] == {"capacity": 2, "in_use": 2, "waiting": 0}
+            capacity["a:7b"], snaps["current"] = 1, object()
+            slots.saturated("a:7b")
+        # the shrink retires the released slot instead of keeping two in use
+        assert slots.snapshot()["a:7b"]["in_use"] == 1
+        await second.__aexit__(None, None, None)
+        assert slots.snapshot()["a:7b"]["in_use"] == 0
+
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.llm import ollama_client
+from app.llm.backends import BackendPool
+
+
+def _stand_in(loaded: list[str]):
+    """Minimal Ollama: /api/ps, /api/tags and a two-chunk streaming /api/generate."""
+    hits: list[str] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, body: bytes, ctype: str = "application/json"):
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            models = [{"model": m} for m in loaded]
+            self._send(json.dumps({"models": models}).encode())
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            hits.append(self.path)
+            lines = [{"response": "hi", "done": False}, {"done": True, "eval_count": 1}]
+            self._send("".join(json.dumps(x) + "\n" for x in lines).encode(), "application/x-ndjson")
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_port}", hits
+
+
+def _dead_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+
+def test_routes_to_backend_with_model_resident_then_least_loaded():
+    cold, cold_url, _ = _stand_in([])
+    warm, warm_url, _ = _stand_in(["m:7b"])
+    try:
+        pool = BackendPool([cold_url, warm_url])
+
+        async def main():
+            assert (await pool.pick("m:7b")).url == warm_url
+            warm_backend = pool.backends[1]
+            async with pool.using(warm_backend):
+                assert (await pool.pick("other:1b")).url == cold_url
+
+        asyncio.run(main())
+    finally:
+        cold.shutdown()
+        warm.shutdown()
+
+
+def test_generation_fails_over_from_unreachable_backend(monkeypatch):
+    live, live_url, hits = _stand_in(["m:7b"])
+    try:
+        dead_url = _dead_url()
+        pool = BackendPool([dead_url, live_url])
+        pool._probed_once = True  # skip probing so the dead host is picked first
+        monkeypatch.setattr(ollama_client, "backend_pool", pool)
+
+        async def main():
+            return [chunk async for chunk, _ in ollama_client.generate_stream("m:7b", "hello")]
+
+        chunks = asyncio.run(main())
+        assert chunks[0]["response"] == "hi" and hits == ["/api/generate"]
+        assert not pool.backends[0].healthy and pool.backends[1].healthy
+    finally:
+        live.shutdown()
+
+
+def test_concurrent_ensure_model_shares_one_pull_and_caches_presence():
+    calls: list[str] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, body: bytes):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            calls.append(self.path)
+            self._send(b'{"models": []}')
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            calls.append(self.path)
+            time.sleep(0.2)  # long enough for the second caller to join
+            lines = [{"status": "pulling manifest"}, {"status": "downloading", "total": 10, "completed": 10}, {"status": "success"}]
+            self._send("".join(json.dumps(x) + "\n" for x in lines).encode())
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{srv.server_port}"
+    try:
+        seen: list[list[str]] = [[], []]
+
+        def listener(i):
+            async def on_progress(p):
+                seen[i].append(p["status"])
+            return on_progress
+
+        async def main():
+            await asyncio.gather(*(ollama_client.ensure_model("m:7b", host, listener(i)) for i in range(2)))
+            before = len(calls)
+            await ollama_client.ensure_model("m:7b", host)
+            return before
+
+        before = asyncio.run(main())
+        assert calls.count("/api/pull") == 1
+        assert len(calls) == before  # presence is cached: no tags lookup
+        assert all("success" in s for s in seen)
+    finally:
+        srv.shutdown()
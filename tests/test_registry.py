@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import registry
+
+
+def _snapshot() -> registry.RegistrySnapshot:
+    return registry.RegistrySnapshot(
+        models=[], by_language={}, defaults={}, parallel_sessions={}, file_mtime=None, discovered_at=0.0,
+    )
+
+
+def test_routes_are_memoized_per_snapshot_and_rebuilt_on_swap(monkeypatch):
+    calls: list[tuple] = []
+
+    def build(mode, language):
+        calls.append((mode, language))
+        return [{"tag": f"{mode}-{len(calls)}"}]
+
+    old = _snapshot()
+    monkeypatch.setattr(registry, "_SNAPSHOT", old)
+    monkeypatch.setattr(registry, "_ROUTES", (None, {}))
+    monkeypatch.setattr(registry, "_ROUTE_BUILDER", build)
+
+    assert registry.routed_models("code", "python") == [{"tag": "code-1"}]
+    assert registry.routed_models("code", "python") == [{"tag": "code-1"}]
+    assert calls == [("code", "python")]
+
+    new = registry._install(_snapshot(), old)
+    assert registry._ROUTES == (new, {("code", "python"): [{"tag": "code-2"}]})
+    assert registry.routed_models("code", "python") == [{"tag": "code-2"}]
+    assert not hasattr(old, "routes")
+
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import residency as residency_mod
+from app.llm import ollama_client
+from app.llm.backends import BackendPool
+from app.residency import ResidencyManager, plan_residency
+
+
+def _stand_in(loaded: set[str], pulled: list[str]):
+    """Minimal Ollama that tracks residency: empty-prompt generate loads, keep_alive 0 unloads."""
+    calls: list[tuple[str, object]] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            names = sorted(loaded) if self.path == "/api/ps" else pulled
+            self._send({"models": [{"model": m} for m in names]})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            calls.append((body["model"], body.get("keep_alive")))
+            if body.get("keep_alive") == 0:
+                loaded.discard(body["model"])
+            else:
+                loaded.add(body["model"])
+            self._send({"done": True})
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_port}", calls
+
+
+def test_plan_evicts_coldest_undesired_model_and_never_busy_ones():
+    need = {"a": 5.0, "b": 5.0, "cold": 5.0, "colder": 5.0, "busy": 5.0}.get
+    heat = {"cold": 2.0, "colder": 1.0}.get
+    plan = plan_residency(["a"], {"h1": {"cold", "colder", "busy"}}, need, 15.0, lambda m: heat(m) or 0.0, busy={"busy"})
+    assert plan.loads == [("a", "h1")]
+    assert plan.unloads == [("colder", "h1")]
+
+    # nothing evictable leaves room: the preload is skipped rather than evicting a busy model
+    plan = plan_residency(["a", "b"], {"h1": {"busy", "a"}}, need, 10.0, lambda m: 0.0, busy={"busy"})
+    assert plan.skipped == ["b"] and not plan.unloads
+
+
+def test_reconcile_preloads_hot_models_and_evicts_cold_under_vram_pressure(monkeypatch):
+    loaded = {"cold:7b"}
+    srv, url, calls = _stand_in(loaded, ["a:7b", "b:7b", "cold:7b"])
+    try:
+        routes = {"chat": ["a:7b", "b:7b"], "code": ["b:7b", "a:7b"]}
+        monkeypatch.setattr(residency_mod, "backend_pool", BackendPool([url]))
+        monkeypatch.setattr(residency_mod, "routed_models", lambda mode, language: [{"tag": t} for t in routes[mode]])
+        monkeypatch.setattr(residency_mod, "bandit_stats", lambda: {})
+        monkeypatch.setattr(residency_mod, "settings", SimpleNamespace(chat_mode_default=""))
+        manager = ResidencyManager(modes=["chat", "code"], top_n=1, keep_alive="30m", vram_budget_gb=12.0)
+        manager.note_use("b:7b")  # recent traffic outranks registry order for chat too
+
+        state = asyncio.run(manager.reconcile())
+        assert [d["model"] for d in state["desired"]] == ["b:7b"]
+        assert loaded == {"b:7b", "cold:7b"}  # 10 of 12 GB: no pressure, nothing evicted
+
+        manager.note_use("a:7b")
+        manager.note_use("a:7b")
+        manager.top_n = 2
+        state = asyncio.run(manager.reconcile())
+        assert loaded == {"a:7b", "b:7b"}
+        assert ("cold:7b", 0) in calls and ("a:7b", "30m") in calls
+        assert state["backends"][0]["used_vram_gb"] == 10.0
+        assert ollama_client._KEEP_ALIVE.get("a:7b") == "30m"
+    finally:
+        srv.shutdown()
+        for model in ("a:7b", "b:7b"):
+            ollama_client.set_keep_alive(model, None)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.scheduler import AffinityQueue, DeadlineQueue, FairQueue
+
+
+def _drain(q):
+    async def main():
+        return [(await q.get())["id"] for _ in range(q.qsize())]
+    return asyncio.run(main())
+
+
+def test_affinity_prefers_resident_model_within_lookahead():
+    q = AffinityQueue(lookahead=4, max_wait_sec=30)
+    for i, model in enumerate(["a", "b", "a", "b"]):
+        q.put_nowait({"id": i, "_affinity_model": model})
+    q.set_resident(["b"])
+    assert _drain(q) == [1, 3, 0, 2]
+
+
+def test_affinity_serves_head_after_max_wait():
+    q = AffinityQueue(lookahead=4, max_wait_sec=0)
+    q.put_nowait({"id": 0, "_affinity_model": "a"})
+    q.put_nowait({"id": 1, "_affinity_model": "b"})
+    q.set_resident(["b"])
+    assert _drain(q) == [0, 1]
+
+
+def test_fair_queue_lanes_and_weighted_round_robin():
+    q = FairQueue(lanes=["chat", "code", "tot_beam"], weights={"b": 2}, max_wait_sec=60)
+    for i in range(3):
+        q.put_nowait({"id": f"A{i}", "_lane": "code", "_client": "a"})
+    for i in range(4):
+        q.put_nowait({"id": f"B{i}", "_lane": "code", "_client": "b"})
+    q.put_nowait({"id": "T", "_lane": "tot_beam", "_client": "b"})
+    q.put_nowait({"id": "C", "_lane": "chat", "_client": "a"})
+    expected = ["C", "A0", "B0", "B1", "A1", "B2", "B3", "A2", "T"]
+    assert [j["id"] for j in q.pending()] == expected
+    assert [j["id"] for j in q.pending(4)] == expected[:4]
+    assert _drain(q) == expected
+
+
+def test_deadline_queue_is_earliest_deadline_first():
+    q = DeadlineQueue()
+    q.put_nowait({"id": "late", "_deadline": 300.0})
+    q.put_nowait({"id": "soon", "_deadline": 100.0})
+    q.put_nowait({"id": "none"})
+    q.put_nowait({"id": "mid", "_deadline": 200.0})
+    assert [j["id"] for j in q.pending()] == ["soon", "mid", "late", "none"]
+    assert [j["id"] for j in q.pending(2)] == ["soon", "mid"]
+    assert _drain(q) == ["soon", "mid", "late", "none"]
+
+
+def test_deadline_plan_degrades_in_order_of_tightness():
+    from app.queue import _plan_for_deadline
+
+    assert _plan_for_deadline(100, 20, is_duel=True, strategy="tot_beam")["degraded"] == []
+    assert _plan_for_deadline(40, 20, is_duel=True, strategy="tot_beam")["degraded"] == ["skip_search"]
+    assert _plan_for_deadline(25, 20, is_duel=True, strategy="")["degraded"] == ["single"]
+    tight = _plan_for_deadline(10, 20, is_duel=False, strategy="")
+    assert tight["degraded"] == ["fast_model", "short_output"] and tight["num_predict_scale"] == 0.5
+
+
+def test_queue_positions_cover_the_head_and_skip_unchanged(monkeypatch):
+    import json
+
+    from app import queue as queue_mod
+    from app.sse import StreamHub
+
+    monkeypatch.setattr(queue_mod, "QUEUE_POSITION_LIMIT", 2)
+    monkeypatch.setattr(queue_mod, "QUEUE_POSITION_INTERVAL_SEC", 0.05)
+
+    async def main():
+        hub = StreamHub()
+        q = queue_mod.JobQueue(hub)
+        q.queue = DeadlineQueue()
+        for i in range(4):
+            q.queue.put_nowait({"id": f"J{i}", "_deadline": 100.0 + i})
+        await q._publish_queue_positions()
+        await q._publish_queue_positions()  # within the interval: folded into one deferred pass
+        await asyncio.sleep(0.1)
+        positions = {tid: [json.loads(m)["queue_position"] for _, m in log.events] for tid, log in hub._logs.items()}
+        assert positions == {"J0": [1], "J1": [2]}
+
+    asyncio.run(main())
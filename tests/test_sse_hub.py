@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import asyncio
+import time
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.sse import StreamHub
+
+
+async def _take(hub: StreamHub, n: int, last_event_id=None) -> list[str]:
+    out: list[str] = []
+    frames = hub.stream("t", last_event_id=last_event_id)
+    async for frame in frames:
+        out.append(frame)
+        if len(out) == n:
+            break
+    await frames.aclose()
+    return out
+
+
+def test_subscribers_each_see_every_event_and_can_resume():
+    async def main():
+        hub = StreamHub()
+        tabs = [asyncio.create_task(_take(hub, 3)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for i in range(3):
+            await hub.publish("t", f"m{i}")
+        first, second = await asyncio.gather(*tabs)
+        assert first == second == ["id: 1\ndata: m0\n\n", "id: 2\ndata: m1\n\n", "id: 3\ndata: m2\n\n"]
+
+        await hub.publish("t", "m3")
+        assert await _take(hub, 2, last_event_id=2) == ["id: 3\ndata: m2\n\n", "id: 4\ndata: m3\n\n"]
+
+    asyncio.run(main())
+
+
+def test_resume_and_live_delivery_survive_gaps_in_event_ids():
+    async def main():
+        hub = StreamHub()
+        for eid in (1, 2, 5):
+            await hub.deliver("t", f"m{eid}", event_id=eid)
+        live = asyncio.create_task(_take(hub, 2, last_event_id=5))
+        await asyncio.sleep(0)
+        for eid in (6, 7):
+            await hub.deliver("t", f"m{eid}", event_id=eid)
+        assert await asyncio.wait_for(live, 1) == ["id: 6\ndata: m6\n\n", "id: 7\ndata: m7\n\n"]
+        assert await _take(hub, 2, last_event_id=2) == ["id: 5\ndata: m5\n\n", "id: 6\ndata: m6\n\n"]
+
+    asyncio.run(main())
+
+
+def test_buffer_is_capped_and_finished_tasks_expire():
+    async def main():
+        hub = StreamHub(max_events=3, finished_ttl_sec=0.0)
+        for i in range(10):
+            await hub.publish("t", f"m{i}")
+        # a client resuming from an evicted id gets what is still buffered
+        assert [f.split("\n")[0] for f in await _take(hub, 3, last_event_id=1)] == ["id: 8", "id: 9", "id: 10"]
+
+        hub.close("t")
+        hub._swept_at = 0.0
+        hub.close("t")
+        assert "t" not in hub._logs and hub._bytes == 0
+
+    asyncio.run(main())
+
+
+def test_idle_subscribers_sleep_until_the_shared_heartbeat():
+    async def main():
+        hub = StreamHub(heartbeat_sec=0.05)
+        first = await _take(hub, 1)
+        assert first == ["event: heartbeat\ndata: ping\n\n"]
+        await asyncio.sleep(0.1)
+        assert hub._ticker is None  # nobody subscribed: no timer either
+
+    asyncio.run(main())
+
+
+def test_idle_connection_cpu_load():
+    # 1,000 idle subscribers over one second; the old 1s wait_for loop woke each of them every second
+    conns, window = 1000, 1.0
+
+    async def main():
+        hub = StreamHub(heartbeat_sec=60)
+        subs = [asyncio.create_task(_take(hub, 1)) for _ in range(conns)]
+        await asyncio.sleep(0.2)  # let everyone subscribe
+        cpu0 = time.process_time()
+        await asyncio.sleep(window)
+        idle_cpu = time.process_time() - cpu0
+        await hub.publish("t", "go")
+        assert all(f == ["id: 1\ndata: go\n\n"] for f in await asyncio.gather(*subs))
+        return idle_cpu
+
+    idle_cpu = asyncio.run(main())
+    per_conn_us = idle_cpu / conns / window * 1e6
+    print(f"idle SSE CPU: {per_conn_us:.2f} us/s per connection")
+    assert per_conn_us < 20
+
+
+class _Loopback:
+    """Backend joining hubs in one process, standing in for separate API workers."""
+
+    def __init__(self, hubs):
+        self.hubs = hubs
+
+    async def start(self, hub):
+        pass
+
+    async def send(self, task_id, event_id, message):
+        for hub in self.hubs:
+            await hub.deliver(task_id, message, event_id)
+
+    async def stop(self):
+        pass
+
+
+def test_backend_fans_out_to_other_processes_with_matching_ids():
+    async def main():
+        a, b = StreamHub(), StreamHub()
+        backend = _Loopback([a, b])
+        await a.attach(backend)
+        await b.attach(backend)
+        reader = asyncio.create_task(_take(b, 2))
+        await asyncio.sleep(0)
+        await a.publish("t", "m1")
+        await b.publish("t", "m2")  # e.g. a cancel handled by the worker the client is on
+        assert await reader == ["id: 1\ndata: m1\n\n", "id: 2\ndata: m2\n\n"]
+        assert [e for e in a._logs["t"].events] == [e for e in b._logs["t"].events]
+
+        backend.hubs = None  # broken transport: local subscribers still get the event
+        assert await a.publish("t", "m3") == 3 and a._logs["t"].events[-1] == (3, "m3")
+
+    asyncio.run(main())
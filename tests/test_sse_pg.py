@@ -0,0 +1,52 @@
+"""PgStreamBackend against a real Postgres.
+
+Skipped unless MACS_TEST_PG_DSN points at a scratch database (see tests/test_durable_queue.py).
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+DSN = os.getenv("MACS_TEST_PG_DSN", "")
+pytestmark = pytest.mark.skipif(not DSN, reason="MACS_TEST_PG_DSN not set")
+
+
+def test_events_reach_a_hub_in_another_process_including_spilled_ones():
+    import asyncpg
+    from app import db
+    from app.sse import StreamHub
+    from app.sse_pg import PgStreamBackend, _plain_dsn
+
+    async def main():
+        conn = await asyncpg.connect(_plain_dsn(DSN))
+        for stmt in db.STATEMENTS:
+            if "sse_spill" in stmt:
+                await conn.execute(stmt)
+        await conn.close()
+
+        worker_a, worker_b = StreamHub(), StreamHub()
+        await worker_a.attach(PgStreamBackend(DSN, channel="macs_sse_test"))
+        await worker_b.attach(PgStreamBackend(DSN, channel="macs_sse_test"))
+        try:
+            frames = worker_b.stream("t")
+            reader = asyncio.ensure_future(frames.__anext__())
+            await asyncio.sleep(0.1)
+            big = "x" * 20_000
+            await worker_a.publish("t", "small")
+            await worker_a.publish("t", big)
+            assert await asyncio.wait_for(reader, 5) == "id: 1\ndata: small\n\n"
+            assert await asyncio.wait_for(frames.__anext__(), 5) == f"id: 2\ndata: {big}\n\n"
+            await frames.aclose()
+            # the publisher's own hub gets its events back through LISTEN too
+            assert [eid for eid, _ in worker_a._logs["t"].events] == [1, 2]
+        finally:
+            await worker_a.detach()
+            await worker_b.detach()
+
+    asyncio.run(main())
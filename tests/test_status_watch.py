@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.sse import StreamHub
+from app.status_watch import TaskStatusWatcher
+
+
+def test_one_query_settles_every_open_stream():
+    calls: list[list[str]] = []
+    ids = [str(uuid.uuid4()) for _ in range(300)]
+    statuses = {tid: ("done" if i % 3 == 0 else "running") for i, tid in enumerate(ids)}
+
+    async def fetch(task_ids):
+        calls.append(task_ids)
+        return {tid: statuses[tid] for tid in task_ids}
+
+    async def first_frame(hub, tid):
+        frames = hub.stream(tid)
+        frame = await frames.__anext__()
+        await frames.aclose()
+        return frame
+
+    async def main():
+        hub = StreamHub()
+        watcher = TaskStatusWatcher(hub, interval_sec=0.05, fetch=fetch)
+        fed = ids[0]
+        await hub.publish(fed, '{"status": "done"}')  # a local JobQueue already finished this one
+        readers = [asyncio.create_task(first_frame(hub, tid)) for tid in ids[3::3]]
+        for tid in ids:
+            watcher.watch(tid)
+        done = await asyncio.wait_for(asyncio.gather(*readers), 2)
+        assert all('"status": "done"' in frame for frame in done)
+        assert len(calls[0]) == len(ids) - 1 and fed not in calls[0]  # one batched lookup
+        await asyncio.sleep(0.1)
+        assert len(calls) > 1 and all(tid not in calls[-1] for tid in ids[::3])  # settled tasks are not asked again
+        for tid in ids:
+            watcher.unwatch(tid)
+        await asyncio.sleep(0.1)
+        assert watcher._task is None
+
+    asyncio.run(main())
+
+
+def test_stream_with_only_local_progress_settles_when_the_task_finishes_elsewhere():
+    tid = str(uuid.uuid4())
+
+    async def fetch(task_ids):
+        return {t: "done" for t in task_ids}
+
+    async def main():
+        hub = StreamHub()
+        watcher = TaskStatusWatcher(hub, interval_sec=0.05, fetch=fetch)
+        await hub.publish(tid, '{"status": "running"}')  # heard here, then the job moved to another replica
+        await hub.publish(tid, '{"type": "delta", "delta": "x"}')
+        assert not hub.settled(tid)
+        watcher.watch(tid)
+        frames = hub.stream(tid, last_event_id=2)
+        frame = await asyncio.wait_for(frames.__anext__(), 2)
+        await frames.aclose()
+        assert '"status": "done"' in frame and hub.settled(tid)
+        assert await watcher.check([tid]) == []  # settled now: no further lookups
+        watcher.unwatch(tid)
+
+    asyncio.run(main())
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.llm import tokens
+from app.llm.tokens import estimate_tokens, model_family, plan_context, register_tokenizer
+
+
+def test_ctx_follows_prompt_size_in_buckets_and_stays_under_model_limit():
+    small = plan_context("mistral:7b", "hi " * 100, 1024, 8192)
+    assert small.num_ctx == 2048 and small.num_predict == 1024
+
+    big_prompt = "x" * (3000 * 4)
+    big = plan_context("mistral:7b", big_prompt, 1024, 8192)
+    assert big.num_ctx == 8192 and not big.truncated
+
+    # does not fit even at the model's limit: output shrinks before the prompt gets cut
+    capped = plan_context("mistral:7b", "x" * 15500, 1024, 6144)
+    assert capped.num_ctx == 6144 and capped.num_predict < 1024 and not capped.truncated
+    huge = plan_context("mistral:7b", "x" * 100_000, 1024, 8192)
+    assert huge.truncated and huge.num_predict == 256
+
+
+def test_family_tokenizer_can_be_plugged_in(monkeypatch):
+    monkeypatch.setattr(tokens, "_TOKENIZERS", {})
+    assert model_family("qwen2.5-coder:14b-q4_K_M") == "qwen"
+    assert model_family("library/llama3.1:8b") == "llama3"
+    register_tokenizer("qwen", lambda text: len(text.split()))
+    assert estimate_tokens("qwen2.5:7b", "one two three") == 3
+    assert estimate_tokens("mistral:7b", "one two three") == 4  # 13 chars / 3.3
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import queue as queue_mod
+from app.queue import JobQueue, _candidate_output_names, _ToTBranch, _ToTNode
+from app.sse import StreamHub
+
+
+def _tot_queue(monkeypatch, run_candidate):
+    monkeypatch.setattr(queue_mod, "_TOT_PRUNE_TICK_SEC", 0.01)
+    q = JobQueue(StreamHub())
+    q._inflight["T"] = []
+    q._run_candidate = run_candidate
+
+    async def no_checks(res):
+        return False, False
+
+    q._run_tot_quality_checks = no_checks
+    return q
+
+
+def _branches(n: int):
+    return [
+        _ToTBranch(node=_ToTNode(), plan={}, plan_idx=i, plan_text="", variant={"metadata": {"_tot_suffix": f"tot_0_{i}_{i + 1}"}})
+        for i in range(n)
+    ]
+
+
+def _result(**flags):
+    return {"model": "a:7b", "latency_ms": 0, **flags}
+
+
+def test_branches_of_a_depth_run_concurrently(monkeypatch):
+    monkeypatch.setattr(queue_mod, "TOT_LATENCY_PENALTY", 0.0)
+    started: list[str] = []
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def run_candidate(job, candidate, task_id, progress=None):
+            started.append(job["metadata"]["_tot_suffix"])
+            await gate.wait()  # nobody finishes until every branch has started
+            return _result(compile_pass=True)
+
+        q = _tot_queue(monkeypatch, run_candidate)
+        evaluation = asyncio.create_task(q._evaluate_tot_branches("T", {"tag": "a:7b"}, _branches(3), float("-inf"), 0))
+        while len(started) < 3:
+            await asyncio.sleep(0.01)
+        gate.set()
+        results = await asyncio.wait_for(evaluation, 2)
+        assert sorted(b.plan_idx for b, _, _ in results) == [0, 1, 2]
+        assert all(score == queue_mod.TOT_COMPILE_WEIGHT for _, _, score in results)
+        assert len(q._inflight["T"]) == 3  # tracked, so cancel() reaches them
+
+    asyncio.run(main())
+
+
+def test_running_branch_is_pruned_once_it_cannot_beat_the_incumbent(monkeypatch):
+    # the fast branch scores compile+test; the slow one could add at most lint+smoke, which its
+    # latency penalty eats up after 100 ms
+    headroom = queue_mod.TOT_LINT_WEIGHT + queue_mod.TOT_SMOKE_WEIGHT
+    monkeypatch.setattr(queue_mod, "TOT_LATENCY_PENALTY", headroom / 100.0)
+    canceled: list[int] = []
+
+    async def run_candidate(job, candidate, task_id, progress=None):
+        if job["metadata"]["_tot_suffix"].startswith("tot_0_0"):
+            return _result(compile_pass=True, test_pass=True)
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            canceled.append(1)
+            raise
+
+    async def main():
+        q = _tot_queue(monkeypatch, run_candidate)
+        t0 = time.monotonic()
+        results = await asyncio.wait_for(q._evaluate_tot_branches("T", {"tag": "a:7b"}, _branches(2), float("-inf"), 0), 2)
+        elapsed = time.monotonic() - t0
+        await asyncio.sleep(0)
+        return results, elapsed
+
+    results, elapsed = asyncio.run(main())
+    assert [b.plan_idx for b, _, _ in results] == [0] and canceled == [1]
+    assert 0.09 <= elapsed < 1.0  # not before max_score - spent_ms * penalty reached the incumbent
+
+
+def test_depth_budget_cancels_branches_still_running(monkeypatch):
+    monkeypatch.setattr(queue_mod, "TOT_LATENCY_PENALTY", 0.0)
+    canceled: list[int] = []
+
+    async def run_candidate(job, candidate, task_id, progress=None):
+        if job["metadata"]["_tot_suffix"].startswith("tot_0_0"):
+            return _result(compile_pass=True)
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            canceled.append(1)
+            raise
+
+    async def main():
+        q = _tot_queue(monkeypatch, run_candidate)
+        results = await asyncio.wait_for(q._evaluate_tot_branches("T", {"tag": "a:7b"}, _branches(3), float("-inf"), 0.05), 2)
+        await asyncio.sleep(0)
+        return results
+
+    results = asyncio.run(main())
+    assert [b.plan_idx for b, _, _ in results] == [0]
+    assert canceled == [1, 1]
+
+
+def test_branch_outputs_stay_private_until_the_winner_is_promoted(monkeypatch, tmp_path):
+    suffixes = [b.variant["metadata"]["_tot_suffix"] for b in _branches(3)]
+    names = [_candidate_output_names("T", s) for s in suffixes]
+    own = _candidate_output_names("T")
+    assert own == ("T", "T")
+    assert len({merge for merge, _ in names} | {own[0]}) == 4
+    assert len({zip_name for _, zip_name in names} | {own[1]}) == 4
+    assert _candidate_output_names("T", None, "b:7b")[0] != own[0]
+
+    def ensure_merge_tree(key, stage_rel):
+        root = tmp_path / "runs" / key / "merge"
+        root.mkdir(parents=True, exist_ok=True)
+        return str(root), root
+
+    monkeypatch.setattr(queue_mod, "ensure_merge_tree", ensure_merge_tree)
+    branch_trees = []
+    for i, (merge_key, zip_name) in enumerate(names):
+        (tmp_path / f"{zip_name}.zip").write_text(f"zip {i}")
+        _, tree = ensure_merge_tree(merge_key, "")
+        (tree / "main.py").write_text(f"branch {i}")
+        branch_trees.append(tree)
+
+    res = {"zip_path": str(tmp_path / f"{names[1][1]}.zip"), "merge_root": str(branch_trees[1])}
+    JobQueue(StreamHub())._promote_tot_result("T", res)
+    assert (tmp_path / "T.zip").read_text() == "zip 1" and res["zip_url"] == "/zips/T.zip"
+    assert Path(res["merge_root"], "main.py").read_text() == "branch 1"
+    # the other branches' outputs are untouched
+    assert [(t / "main.py").read_text() for t in branch_trees] == ["branch 0", "branch 1", "branch 2"]
+    assert (tmp_path / f"{names[0][1]}.zip").read_text() == "zip 0"